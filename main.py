@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-import contextlib
+import functools
 import os
 import json
 import re
@@ -16,8 +16,8 @@ import shlex
 from pathlib import Path
 from datetime import datetime, date
 from dataclasses import dataclass
-from typing import Any, Callable, Dict, Iterable, List, Tuple, Optional, Union, Awaitable, Set
-from collections import defaultdict
+from typing import Any, Callable, Deque, Dict, Iterable, List, Tuple, Optional, Union, Awaitable, Set
+from collections import OrderedDict, defaultdict, deque
 import math
 import wave
 from array import array
@@ -32,6 +32,7 @@ import sys
 import types
 from bisect import bisect_left, bisect_right
 import heapq
+import codecs
 
 try:
     import private_settings  # type: ignore
@@ -77,6 +78,7 @@ def _coerce_bool(value: Any, default: bool) -> bool:
 
 from telegram import (
     Update,
+    CallbackQuery,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
@@ -320,6 +322,17 @@ if not ALLOWED_USER_ID:
 # БАЗА ДАННЫХ (SQLite)
 # =========================
 
+# Счётчик записей в БД из этого процесса. Входит в _db_state_token: mtime/размер файла
+# не меняются при UPDATE на месте в пределах одного тика файловой системы.
+_DB_WRITE_GENERATION = 0
+
+
+def _note_db_write() -> None:
+    """Вызывается после каждого коммита с изменениями — сбрасывает кэши, завязанные на _db_state_token."""
+    global _DB_WRITE_GENERATION
+    _DB_WRITE_GENERATION += 1
+
+
 def get_conn() -> sqlite3.Connection:
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
@@ -442,13 +455,56 @@ def db_get_all_compilations() -> List[sqlite3.Row]:
     return rows
 
 
-def db_append_compilation_comment(comp_id: int, new_piece: str) -> None:
+# PMV без оценки: в комментарии нет маркера pmv_rating= (без учёта регистра).
+UNRATED_COMPILATIONS_WHERE = "comments IS NULL OR instr(lower(comments), 'pmv_rating=') = 0"
+
+
+def db_get_unrated_compilations(limit: int = 10) -> List[sqlite3.Row]:
+    """Самые старые PMV без оценки (по дате, затем по id)."""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        SELECT id, video_path, pmv_date, source_ids, comments
+        FROM compilations
+        WHERE {UNRATED_COMPILATIONS_WHERE}
+        ORDER BY COALESCE(pmv_date, '') ASC, id ASC
+        LIMIT ?
+        """,
+        (limit,),
+    )
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def db_count_unrated_compilations() -> int:
     conn = get_conn()
     cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM compilations WHERE {UNRATED_COMPILATIONS_WHERE}")
+    count = int(cur.fetchone()[0])
+    conn.close()
+    return count
+
+
+def db_append_compilation_comment(
+    comp_id: int,
+    new_piece: str,
+    conn: Optional[sqlite3.Connection] = None,
+) -> None:
+    """
+    Дописывает кусок комментария к PMV.
+    Если передан conn — работает внутри чужой транзакции и не коммитит.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_conn()
+    cur = conn.cursor()
     cur.execute("SELECT comments FROM compilations WHERE id = ?", (comp_id,))
     row = cur.fetchone()
     if not row:
-        conn.close()
+        if own_conn:
+            conn.close()
         return
     current = (row["comments"] or "").strip()
     if not current:
@@ -456,8 +512,10 @@ def db_append_compilation_comment(comp_id: int, new_piece: str) -> None:
     else:
         updated = current + " | " + new_piece
     cur.execute("UPDATE compilations SET comments = ? WHERE id = ?", (updated, comp_id))
-    conn.commit()
-    conn.close()
+    if own_conn:
+        conn.commit()
+        _note_db_write()
+        conn.close()
 
 
 def db_append_source_comment(source_id: int, new_piece: str) -> None:
@@ -475,6 +533,7 @@ def db_append_source_comment(source_id: int, new_piece: str) -> None:
         updated = current + " | " + new_piece
     cur.execute("UPDATE sources SET comments = ? WHERE id = ?", (updated, source_id))
     conn.commit()
+    _note_db_write()
     conn.close()
 
 
@@ -566,6 +625,7 @@ def db_add_upload_folder(folder_path: str, ignored: bool = False) -> None:
         (folder_path, date.today().isoformat(), int(ignored)),
     )
     conn.commit()
+    _note_db_write()
     conn.close()
 
 
@@ -600,11 +660,18 @@ def db_insert_source(
     resolution: str,
     size_bytes: Optional[int] = None,
     video_name: Optional[str] = None,
+    conn: Optional[sqlite3.Connection] = None,
 ) -> Optional[int]:
+    """
+    Добавляет исходник и возвращает его id (None, если путь уже есть в базе).
+    Если передан conn — работает внутри чужой транзакции и не коммитит.
+    """
     p = video_path.resolve()
     size_bytes = size_bytes if size_bytes is not None else p.stat().st_size
     video_name = video_name or p.name
-    conn = get_conn()
+    own_conn = conn is None
+    if own_conn:
+        conn = get_conn()
     cur = conn.cursor()
     try:
         cur.execute(
@@ -621,12 +688,15 @@ def db_insert_source(
                 date.today().isoformat(),
             ),
         )
-        conn.commit()
+        if own_conn:
+            conn.commit()
+            _note_db_write()
         return int(cur.lastrowid)
     except sqlite3.IntegrityError:
         return None
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
 
 
 def db_get_unused_sources_grouped() -> Dict[Tuple[str, str], List[sqlite3.Row]]:
@@ -688,6 +758,48 @@ def db_get_all_sources_grouped() -> Dict[Tuple[str, str], List[sqlite3.Row]]:
     return groups
 
 
+def db_color_group_stats(emoji: str) -> List[Tuple[Tuple[str, str], int, int]]:
+    """
+    Количество и суммарный размер исходников с меткой emoji в комментарии по группам (codec, resolution).
+    Считает сама SQLite, без выгрузки всей таблицы sources в Python.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT COALESCE(NULLIF(codec, ''), '?') AS codec,
+               COALESCE(NULLIF(resolution, ''), '??x??') AS resolution,
+               COUNT(*) AS cnt,
+               COALESCE(SUM(size_bytes), 0) AS total_size
+        FROM sources
+        WHERE instr(COALESCE(comments, ''), ?) > 0
+        GROUP BY 1, 2
+        """,
+        (emoji,),
+    )
+    stats = [
+        ((row["codec"], row["resolution"]), int(row["cnt"]), int(row["total_size"] or 0))
+        for row in cur.fetchall()
+    ]
+    conn.close()
+    return stats
+
+
+@functools.lru_cache(maxsize=128)
+def _load_manifest_cached(path_str: str, mtime_ns: int, size: int) -> Dict[str, Any]:
+    return json.loads(Path(path_str).read_text(encoding="utf-8"))
+
+
+def load_manifest_json(path: Union[str, Path]) -> Dict[str, Any]:
+    """
+    Читает manifest.json с кэшем по (путь, mtime, размер): повторный выбор
+    того же проекта не перечитывает и не разбирает файл заново.
+    Возвращаемый словарь общий — его нельзя менять на месте.
+    """
+    st = os.stat(path)
+    return _load_manifest_cached(str(path), st.st_mtime_ns, st.st_size)
+
+
 def load_music_projects() -> List[Dict[str, Any]]:
     projects: List[Dict[str, Any]] = []
     if not MUSIC_PROJECTS_DIR.exists():
@@ -699,14 +811,15 @@ def load_music_projects() -> List[Dict[str, Any]]:
         if not entry.is_dir():
             continue
         manifest_path = entry / "manifest.json"
+        manifest_exists = manifest_path.exists()
         audio_path = entry / "audio.mp3"
         usage_info = usage_map.get(entry.name, {"count": 0, "last_date": None})
         try:
             manifest_data: Dict[str, Any] = {}
             segments_count = 0
             total_duration = None
-            if manifest_path.exists():
-                manifest_data = json.loads(manifest_path.read_text(encoding="utf-8"))
+            if manifest_exists:
+                manifest_data = load_manifest_json(manifest_path)
                 segments = (manifest_data.get("analysis") or {}).get("segments") or []
                 segments_count = len(segments)
                 if segments:
@@ -717,6 +830,7 @@ def load_music_projects() -> List[Dict[str, Any]]:
                     "name": manifest_data.get("name") or entry.name,
                     "dir": entry,
                     "manifest_path": manifest_path,
+                    "manifest_exists": manifest_exists,
                     "audio_path": audio_path if audio_path.exists() else None,
                     "segments_count": segments_count,
                     "duration": total_duration,
@@ -732,6 +846,7 @@ def load_music_projects() -> List[Dict[str, Any]]:
                     "name": f"{entry.name} (ошибка манифеста: {exc})",
                     "dir": entry,
                     "manifest_path": manifest_path,
+                    "manifest_exists": manifest_exists,
                     "audio_path": audio_path if audio_path.exists() else None,
                     "segments_count": 0,
                     "duration": None,
@@ -785,27 +900,16 @@ def _normalize_path_prefix(path_like: Union[str, Path]) -> str:
     return normalized
 
 
-def _is_path_under_prefixes(
-    target_path: Union[str, Path], prefixes: Iterable[str]
-) -> bool:
-    target = _normalize_path_prefix(target_path)
-    for prefix in prefixes:
-        if not prefix:
-            continue
-        check = prefix.rstrip("/")
-        if target == check or target.startswith(check + "/"):
-            return True
-    return False
-
-
-def collect_music_track_usage() -> Dict[str, int]:
+def collect_music_track_usage(
+    input_tracks: Optional[List[Tuple[Path, str]]] = None,
+) -> Dict[str, int]:
     usage: Dict[str, int] = {}
     if not MUSIC_PROJECTS_DIR.exists():
         return usage
 
-    input_by_name: Dict[str, str] = {
-        p.name.lower(): _normalize_path_str(p) for p in list_music_input_files()
-    }
+    if input_tracks is None:
+        input_tracks = list_music_input_tracks()
+    input_by_name: Dict[str, str] = {path.name.lower(): norm for path, norm in input_tracks}
 
     for entry in MUSIC_PROJECTS_DIR.iterdir():
         if not entry.is_dir():
@@ -814,7 +918,7 @@ def collect_music_track_usage() -> Dict[str, int]:
         if not manifest_path.exists():
             continue
         try:
-            data = json.loads(manifest_path.read_text(encoding="utf-8"))
+            data = load_manifest_json(manifest_path)
         except Exception:
             continue
         source_file = data.get("source_file") or data.get("original_audio")
@@ -871,6 +975,7 @@ def slugify_token(value: str) -> str:
     return slug or "project"
 
 
+@functools.cache
 def build_main_reply_keyboard() -> ReplyKeyboardMarkup:
     """
     Постоянное меню снизу с основными командами.
@@ -884,6 +989,7 @@ def build_main_reply_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(rows, resize_keyboard=True, one_time_keyboard=False)
 
 
+@functools.cache
 def build_reports_keyboard() -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton("🟢 + Группы", callback_data="report_group:green")],
@@ -894,6 +1000,7 @@ def build_reports_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+@functools.cache
 def build_newcomp_duration_keyboard() -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton(label, callback_data=f"newcomp_bucket:{key}")]
@@ -968,19 +1075,15 @@ def build_musicprep_track_keyboard(
     def sort_key(token: str) -> Tuple[int, str]:
         info = track_map.get(token) or {}
         count = int(info.get("usage") or 0)
-        path = Path(info.get("path") or "")
-        _, title = extract_track_title_components(path)
-        return (count, title.lower())
+        return (count, (info.get("title") or "").lower())
     tokens = sorted(tokens, key=sort_key)
     rows: List[List[InlineKeyboardButton]] = []
     for token in tokens:
         info = track_map.get(token)
         if not info:
             continue
-        path = Path(info["path"])
-        _, title = extract_track_title_components(path)
         count = int(info.get("usage") or 0)
-        base_label = f"{count} · {title}"
+        base_label = f"{count} · {info['title']}"
         label = truncate_button_label(base_label)
         rows.append([InlineKeyboardButton(label or "?", callback_data=f"musicprep_track:{token}")])
 
@@ -997,6 +1100,7 @@ def build_musicprep_track_keyboard(
     return text, InlineKeyboardMarkup(rows)
 
 
+@functools.cache
 def build_musicprep_seconds_keyboard() -> InlineKeyboardMarkup:
     zero_row = [InlineKeyboardButton("0", callback_data="musicprep_seconds:0")]
     first_row = [InlineKeyboardButton(str(i), callback_data=f"musicprep_seconds:{i}") for i in range(1, 6)]
@@ -1006,6 +1110,7 @@ def build_musicprep_seconds_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([zero_row, first_row, second_row, third_row, fourth_row])
 
 
+@functools.cache
 def build_musicprep_mode_keyboard() -> InlineKeyboardMarkup:
     row = [
         InlineKeyboardButton("beat", callback_data="musicprep_mode:beat"),
@@ -1104,7 +1209,8 @@ async def finalize_musicprep_project(
         project_name = sess.get("musicprep_name")
 
     try:
-        manifest = mod.create_music_project(
+        manifest = await asyncio.to_thread(
+            mod.create_music_project,
             mp3_path=file_path,
             name=project_name,
             target_segment=float(segment_len),
@@ -1154,14 +1260,14 @@ def _auto_musicprep_project_name(mp3_path: Path) -> str:
 def auto_create_random_music_project(
     used_music_paths: Optional[Set[str]] = None,
 ) -> Dict[str, Any]:
-    music_files = list_music_input_files()
-    if not music_files:
+    music_tracks = list_music_input_tracks()
+    if not music_tracks:
         raise RuntimeError("Music folder is empty. Add MP3/FLAC/WAV tracks before running.")
 
     normalized_used = {p for p in (used_music_paths or set())}
-    available = [p for p in music_files if _normalize_path_str(p) not in normalized_used]
+    available = [p for p, norm in music_tracks if norm not in normalized_used]
     if not available:
-        available = music_files
+        available = [p for p, _ in music_tracks]
     mp3_path = random.choice(available)
 
     mod = load_music_generator_module()
@@ -1281,6 +1387,7 @@ async def prompt_newcomp_duration(
     await send_fn("Выберите длительность используемых проектов:", build_newcomp_duration_keyboard())
 
 
+@functools.lru_cache(maxsize=64)
 def build_numeric_keyboard(prefix: str, total: int, per_row: int = 5) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
     row: List[InlineKeyboardButton] = []
@@ -1308,6 +1415,16 @@ RATEGRP_COLOR_CHOICES: Dict[str, Dict[str, str]] = {
 }
 RATEGRP_COLOR_EMOJIS = tuple(choice["emoji"] for choice in RATEGRP_COLOR_CHOICES.values())
 RATEGRP_COLOR_PROMPT = " / ".join(choice["emoji"] for choice in RATEGRP_COLOR_CHOICES.values())
+RATEGRP_EMOJI_TO_KEY = {choice["emoji"]: key for key, choice in RATEGRP_COLOR_CHOICES.items()}
+RATEGRP_GREEN_EMOJI = RATEGRP_COLOR_CHOICES["green"]["emoji"]
+RATEGRP_YELLOW_EMOJI = RATEGRP_COLOR_CHOICES["yellow"]["emoji"]
+RATEGRP_RED_EMOJI = RATEGRP_COLOR_CHOICES["red"]["emoji"]
+# Подписи комбинированных фильтров по цветам для /newcompmusic.
+NEWCOMP_COLOR_COMBO_LABELS: Dict[str, str] = {
+    "green_new": f"{RATEGRP_GREEN_EMOJI}+🆕",
+    "green_yellow": f"{RATEGRP_GREEN_EMOJI}+{RATEGRP_YELLOW_EMOJI}",
+    "green_yellow_red": f"{RATEGRP_GREEN_EMOJI}+{RATEGRP_YELLOW_EMOJI}+{RATEGRP_RED_EMOJI}",
+}
 
 # Добавляем в NAS_SYMLINK_COLOR_FOLDERS алиасы по эмодзи, чтобы не зависеть
 # от текстовых ключей цветов.
@@ -1346,10 +1463,12 @@ def db_set_source_color(source_id: int, emoji: str) -> Optional[str]:
     updated = " | ".join(parts)
     cur.execute("UPDATE sources SET comments = ? WHERE id = ?", (updated, source_id))
     conn.commit()
+    _note_db_write()
     conn.close()
     return updated
 
 
+@functools.cache
 def build_newcomp_sources_keyboard() -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
     row: List[InlineKeyboardButton] = []
@@ -1363,6 +1482,7 @@ def build_newcomp_sources_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+@functools.cache
 def build_newcomp_orientation_keyboard() -> InlineKeyboardMarkup:
     buttons = [
         InlineKeyboardButton(label, callback_data=f"newcomp_orient:{label}")
@@ -1371,6 +1491,7 @@ def build_newcomp_orientation_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([buttons])
 
 
+@functools.cache
 def build_rategrp_orientation_keyboard() -> InlineKeyboardMarkup:
     buttons = [
         InlineKeyboardButton(label, callback_data=f"rategrp_orient:{label}")
@@ -1380,6 +1501,7 @@ def build_rategrp_orientation_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([buttons, extra])
 
 
+@functools.cache
 def build_rategrp_color_keyboard() -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
     row: List[InlineKeyboardButton] = []
@@ -1404,6 +1526,7 @@ def build_rategrp_rerate_keyboard(
     return InlineKeyboardMarkup(rows)
 
 
+@functools.cache
 def build_newcomp_groupmode_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -1429,9 +1552,9 @@ def build_newcomp_color_keyboard(
     if single_row:
         rows.append(single_row)
     combo_counts = combo_counts or {}
-    green = RATEGRP_COLOR_CHOICES["green"]["emoji"]
-    yellow = RATEGRP_COLOR_CHOICES["yellow"]["emoji"]
-    red = RATEGRP_COLOR_CHOICES["red"]["emoji"]
+    green = RATEGRP_GREEN_EMOJI
+    yellow = RATEGRP_YELLOW_EMOJI
+    red = RATEGRP_RED_EMOJI
     green_new_total = combo_counts.get(
         "green_new", color_counts.get(green, 0) + unrated_count
     )
@@ -1447,19 +1570,19 @@ def build_newcomp_color_keyboard(
     combo_row: List[InlineKeyboardButton] = []
     combo_row.append(
         InlineKeyboardButton(
-            f"{green}+🆕 ({green_new_total})",
+            f"{NEWCOMP_COLOR_COMBO_LABELS['green_new']} ({green_new_total})",
             callback_data="newcomp_color:green_new",
         )
     )
     combo_row.append(
         InlineKeyboardButton(
-            f"{green}+{yellow} ({green_yellow_total})",
+            f"{NEWCOMP_COLOR_COMBO_LABELS['green_yellow']} ({green_yellow_total})",
             callback_data="newcomp_color:green_yellow",
         )
     )
     combo_row.append(
         InlineKeyboardButton(
-            f"{green}+{yellow}+{red} ({green_yellow_red_total})",
+            f"{NEWCOMP_COLOR_COMBO_LABELS['green_yellow_red']} ({green_yellow_red_total})",
             callback_data="newcomp_color:green_yellow_red",
         )
     )
@@ -1468,6 +1591,7 @@ def build_newcomp_color_keyboard(
     return InlineKeyboardMarkup(rows)
 
 
+@functools.cache
 def build_newcomp_algo_keyboard() -> InlineKeyboardMarkup:
     row = [
         InlineKeyboardButton("CAR", callback_data="newcomp_algo:car"),
@@ -1479,6 +1603,7 @@ def build_newcomp_algo_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([row])
 
 
+@functools.cache
 def build_randompmv_count_keyboard() -> InlineKeyboardMarkup:
     buttons: List[List[InlineKeyboardButton]] = []
     row: List[InlineKeyboardButton] = []
@@ -1492,6 +1617,7 @@ def build_randompmv_count_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(buttons)
 
 
+@functools.cache
 def build_randompmv_orientation_keyboard() -> InlineKeyboardMarkup:
     buttons = [
         InlineKeyboardButton(label, callback_data=f"randompmv_orient:{label}")
@@ -1501,6 +1627,7 @@ def build_randompmv_orientation_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([buttons])
 
 
+@functools.cache
 def build_randompmv_newcount_keyboard() -> InlineKeyboardMarkup:
     buttons: List[List[InlineKeyboardButton]] = []
     row: List[InlineKeyboardButton] = []
@@ -1561,6 +1688,7 @@ def build_ratepmv_pmv_keyboard(rows: List[sqlite3.Row]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(buttons)
 
 
+@functools.cache
 def build_ratepmv_score_keyboard() -> InlineKeyboardMarkup:
     row = [
         InlineKeyboardButton(str(score), callback_data=f"ratepmv_rate:{score}")
@@ -1615,7 +1743,8 @@ async def run_newcompmusic_generation(
                 preferred_group=preferred_group,
                 preferred_folder=preferred_folder,
             )
-        out_path, source_ids, (resolved_key, algo_meta) = make_music_synced_pmv(
+        out_path, source_ids, (resolved_key, algo_meta) = await asyncio.to_thread(
+            make_music_synced_pmv,
             selected.get("name") or selected.get("slug") or "music",
             parsed_segments,
             Path(audio_path_str),
@@ -1624,7 +1753,7 @@ async def run_newcompmusic_generation(
             orientation=orientation_label,
             group_number=group_number,
         )
-        out_path, move_comment = move_output_to_network_storage(out_path)
+        out_path, move_comment = await asyncio.to_thread(move_output_to_network_storage, out_path)
     except Exception as exc:
         user_sessions.pop(user_id, None)
         await send_fn(f"Ошибка при генерации: {exc}")
@@ -1710,14 +1839,9 @@ def _prepare_randompmv_session(
 
     project_candidates = forced_list + unused_projects + other_projects
 
-    groups_raw = get_source_groups_prefer_unused()
-    if not groups_raw:
+    sorted_entries, orientation_map = get_sorted_source_group_entries()
+    if not sorted_entries:
         raise RuntimeError("Нет доступных групп исходников. Выполните /scan.")
-    group_entries = [
-        SourceGroupEntry(key=key, rows=list(rows), unused_count=unused)
-        for key, rows, unused in groups_raw
-    ]
-    sorted_entries, orientation_map = sort_group_entries_with_orientation(group_entries)
     prepared_groups = [(entry.key, list(entry.rows), entry.unused_count) for entry in sorted_entries]
 
     fallback_result: Optional[Tuple[Dict[str, Any], str, Dict[str, Any]]] = None
@@ -1777,7 +1901,7 @@ def _prepare_randompmv_from_project(
     manifest_data = project.get("manifest_data")
     manifest_path = project.get("manifest_path")
     if not manifest_data and manifest_path and Path(manifest_path).exists():
-        manifest_data = json.loads(Path(manifest_path).read_text(encoding="utf-8"))
+        manifest_data = load_manifest_json(manifest_path)
         project["manifest_data"] = manifest_data
     parsed_segments = parse_manifest_segments(manifest_data or {})
     if not parsed_segments:
@@ -1802,12 +1926,14 @@ def _prepare_randompmv_from_project(
         orientation_cycle = list(NEWCOMPMUSIC_ORIENTATION_CHOICES)
         random.shuffle(orientation_cycle)
 
+    groups_by_orientation = index_groups_by_orientation(prepared_groups, orientation_map)
+
     def pick_group(
         forbid_used: bool,
         require_target_count: bool,
     ) -> Optional[Tuple[Tuple[str, str], List[sqlite3.Row], int, List[sqlite3.Row], str]]:
         for orient in orientation_cycle:
-            filtered = filter_groups_by_orientation(prepared_groups, orientation_map, orient)
+            filtered = groups_by_orientation.get(orient, [])
             if not filtered:
                 continue
             shuffled = filtered[:]
@@ -1939,7 +2065,9 @@ async def run_randompmv_batch(
         forced_projects: Optional[List[Dict[str, Any]]] = None
         if not auto_musicprep_disabled:
             try:
-                forced_project = auto_create_random_music_project(used_music_paths)
+                forced_project = await asyncio.to_thread(
+                    auto_create_random_music_project, used_music_paths
+                )
             except Exception as auto_exc:
                 auto_musicprep_disabled = True
                 await send_fn(
@@ -2024,21 +2152,44 @@ def load_music_generator_module():
     return module
 
 
-def list_music_input_files() -> List[Path]:
+MUSIC_INPUT_EXTENSIONS = frozenset({".mp3", ".wav", ".flac", ".m4a"})
+
+
+def list_music_input_tracks() -> List[Tuple[Path, str]]:
+    """Треки из MUSIC_INPUT_DIR (по имени) вместе с нормализованным путём.
+
+    Один проход os.scandir: каталог резолвится один раз, а resolve() на файл
+    вызывается только для симлинков.
+    """
     MUSIC_INPUT_DIR.mkdir(parents=True, exist_ok=True)
-    files = []
-    for path in sorted(MUSIC_INPUT_DIR.iterdir(), key=lambda p: p.name.lower()):
-        if path.is_file() and path.suffix.lower() in {".mp3", ".wav", ".flac", ".m4a"}:
-            files.append(path)
-    return files
+    base_norm = _normalize_path_str(MUSIC_INPUT_DIR)
+    with os.scandir(MUSIC_INPUT_DIR) as it:
+        entries = [
+            entry
+            for entry in it
+            if os.path.splitext(entry.name)[1].lower() in MUSIC_INPUT_EXTENSIONS
+            and entry.is_file()
+        ]
+    entries.sort(key=lambda entry: entry.name.lower())
+    tracks: List[Tuple[Path, str]] = []
+    for entry in entries:
+        path = Path(entry.path)
+        if entry.is_symlink():
+            norm = _normalize_path_str(path)
+        else:
+            norm = os.path.join(base_norm, entry.name.lower())
+        tracks.append((path, norm))
+    return tracks
 
 
 RESOLUTION_RE = re.compile(r"(\d+)\s*[xхXХ]\s*(\d+)")
 ORIENTATION_ORDER = {"VR": 0, "HOR": 1, "VER": 2}
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class SourceGroupEntry:
+    """Группа исходников (codec, resolution). rows — общий список, менять его на месте нельзя."""
+
     key: Tuple[str, str]
     rows: List[sqlite3.Row]
     unused_count: int = 0
@@ -2119,9 +2270,11 @@ def compute_group_folder_options(
     unused_only: bool = False,
 ) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
     folder_map: Dict[str, Dict[str, Any]] = {}
+    total_rows: List[sqlite3.Row] = []
     for row in rows:
         if unused_only and not _is_unused_source_row(row):
             continue
+        total_rows.append(row)
         try:
             parent = Path(row["video_path"]).resolve(strict=False).parent
         except Exception:
@@ -2158,7 +2311,6 @@ def compute_group_folder_options(
             "path": option["path"],
         }
 
-    total_rows = [row for row in rows if (not unused_only or _is_unused_source_row(row))]
     token_map["all"] = {
         "rows": total_rows,
         "count": len(total_rows),
@@ -2177,22 +2329,62 @@ def compute_group_folder_options(
     return options, token_map
 
 
-def filter_groups_by_orientation(
+def index_groups_by_orientation(
     groups: List[Tuple[Tuple[str, str], List[sqlite3.Row], int]],
     orientation_map: Dict[Tuple[str, str], str],
-    target: str,
-) -> List[Tuple[Tuple[str, str], List[sqlite3.Row], int]]:
-    normalized = (target or "").upper()
-    if normalized not in NEWCOMPMUSIC_ORIENTATION_CHOICES:
-        return []
-    filtered: List[Tuple[Tuple[str, str], List[sqlite3.Row], int]] = []
+) -> Dict[str, List[Tuple[Tuple[str, str], List[sqlite3.Row], int]]]:
+    """
+    Раскладывает группы по ориентациям (VR/HOR/VER) за один проход, порядок внутри сохраняется.
+    Если ориентации нет в карте, она определяется по разрешению группы.
+    """
+    index: Dict[str, List[Tuple[Tuple[str, str], List[sqlite3.Row], int]]] = defaultdict(list)
     for key, rows, unused in groups:
         label = (orientation_map.get(key) or "").upper()
         if not label:
             label = _resolution_orientation(key[1] or "")[0]
-        if label.upper() == normalized:
-            filtered.append((key, rows, unused))
-    return filtered
+        index[label.upper()].append((key, rows, unused))
+    return dict(index)
+
+
+def _session_groups_for_orientation(
+    sess: Dict[str, Any],
+    prefix: str,
+    target: str,
+) -> List[Tuple[Tuple[str, str], List[sqlite3.Row], int]]:
+    """
+    Группы нужной ориентации из индекса сессии (`{prefix}_groups_by_orientation`).
+    Если индекса ещё нет, он строится из `{prefix}_groups_all` и сохраняется.
+    """
+    index_key = f"{prefix}_groups_by_orientation"
+    index = sess.get(index_key)
+    if index is None:
+        index = index_groups_by_orientation(
+            sess.get(f"{prefix}_groups_all") or [],
+            sess.get(f"{prefix}_group_orientations") or {},
+        )
+        sess[index_key] = index
+    return index.get((target or "").upper(), [])
+
+
+def _cached_group_listing(
+    sess: Dict[str, Any],
+    cache_name: str,
+    group_entries: List[SourceGroupEntry],
+    orientation: str,
+    build: Callable[[], List[str]],
+) -> List[str]:
+    """
+    Список групп для промпта, закэшированный в сессии по (состояние БД, ориентация, число групп).
+    Возврат «назад» к тому же списку не пересчитывает статистику использования.
+    Возвращаемый список общий — его нельзя менять на месте.
+    """
+    key = (_db_state_token(), orientation, len(group_entries))
+    cached = sess.get(cache_name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    lines = build()
+    sess[cache_name] = (key, lines)
+    return lines
 
 
 def _build_group_selection_lines(
@@ -2219,10 +2411,16 @@ def _build_group_selection_lines(
     lines.append(f"Ориентация: {orientation}.")
     lines.append("")
     lines.extend(
-        format_source_group_lines(
+        _cached_group_listing(
+            sess,
+            "music_group_listing_cache",
             group_entries,
-            "Выберите группу исходников (codec + разрешение):",
-            prefix_func=orientation_prefix,
+            orientation,
+            lambda: format_source_group_lines(
+                group_entries,
+                "Выберите группу исходников (codec + разрешение):",
+                prefix_func=orientation_prefix,
+            ),
         )
     )
     lines.append("")
@@ -2263,13 +2461,33 @@ def format_folder_selection_message(
     return "\n".join(lines)
 
 
+def _session_folder_options(
+    sess: Dict[str, Any],
+    unused_only: bool,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """compute_group_folder_options для строк группы из сессии, с кэшем по режиму.
+
+    Кэш живёт, пока в сессии тот же список music_group_rows, так что
+    переключение «все / только новые» не резолвит пути заново.
+    """
+    rows = sess.get("music_group_rows") or []
+    cache = sess.get("music_folder_options_cache")
+    if not cache or cache.get("rows") is not rows:
+        cache = {"rows": rows}
+        sess["music_folder_options_cache"] = cache
+    result = cache.get(unused_only)
+    if result is None:
+        result = compute_group_folder_options(rows, unused_only=unused_only)
+        cache[unused_only] = result
+    return result
+
+
 def compose_newcomp_folder_prompt(
     sess: Dict[str, Any],
 ) -> Tuple[str, InlineKeyboardMarkup]:
-    rows = sess.get("music_group_rows") or []
-    options, folder_map = compute_group_folder_options(
-        rows,
-        unused_only=sess.get("music_folder_only_new", False),
+    options, folder_map = _session_folder_options(
+        sess,
+        bool(sess.get("music_folder_only_new", False)),
     )
     sess["music_folder_options"] = options
     sess["music_folder_map"] = folder_map
@@ -2552,12 +2770,6 @@ def _count_rategrp_unrated(rows: List[sqlite3.Row]) -> int:
     return sum(1 for row in rows if not _rategrp_row_has_color(row))
 
 
-def _count_rows_for_folder_mode(rows: List[sqlite3.Row], unused_only: bool) -> int:
-    if not unused_only:
-        return len(rows)
-    return sum(1 for row in rows if _is_unused_source_row(row))
-
-
 def format_rategrp_group_prompt(
     session: Dict[str, Any],
     group_entries: List[SourceGroupEntry],
@@ -2569,15 +2781,19 @@ def format_rategrp_group_prompt(
     def prefix_func(entry: SourceGroupEntry) -> str:
         return orientation_map.get(entry.key, "")
 
-    display_entries: List[SourceGroupEntry] = []
-    for entry in group_entries:
-        rows = list(entry.rows)
-        display_entries.append(
+    def build_listing() -> List[str]:
+        display_entries = [
             SourceGroupEntry(
                 key=entry.key,
-                rows=rows,
-                unused_count=_count_rategrp_unrated(rows),
+                rows=entry.rows,
+                unused_count=_count_rategrp_unrated(entry.rows),
             )
+            for entry in group_entries
+        ]
+        return format_source_group_lines(
+            display_entries,
+            "Выберите группу исходников (🆕 = без оценки):",
+            prefix_func=prefix_func,
         )
 
     lines = [
@@ -2585,10 +2801,8 @@ def format_rategrp_group_prompt(
         "",
     ]
     lines.extend(
-        format_source_group_lines(
-            display_entries,
-            "Выберите группу исходников (🆕 = без оценки):",
-            prefix_func=prefix_func,
+        _cached_group_listing(
+            session, "rategrp_group_listing_cache", group_entries, orientation, build_listing
         )
     )
     lines.append("")
@@ -2622,32 +2836,45 @@ def _rategrp_available_colors(rows: List[sqlite3.Row]) -> List[Tuple[str, str, i
     return available
 
 
-def _filter_rows_by_color(
-    rows: List[sqlite3.Row],
-    allowed: Set[str],
-    include_unrated: bool = False,
-) -> List[sqlite3.Row]:
-    filtered: List[sqlite3.Row] = []
-    for row in rows:
-        emoji = _rategrp_row_color(row)
-        if emoji:
-            if emoji in allowed:
-                filtered.append(row)
-        else:
-            if include_unrated:
-                filtered.append(row)
-    return filtered
+# Комбинированные фильтры по цветам для /newcompmusic: ключ кнопки -> ключи цветов.
+NEWCOMP_COLOR_COMBOS: Dict[str, Tuple[str, ...]] = {
+    "green_yellow": ("green", "yellow"),
+    "green_yellow_red": ("green", "yellow", "red"),
+}
 
 
-def _filter_green_new_rows(rows: List[sqlite3.Row]) -> List[sqlite3.Row]:
-    """Возвращает все зелёные исходники и любые исходники без PMV-истории."""
-    filtered: List[sqlite3.Row] = []
-    green_emoji = RATEGRP_COLOR_CHOICES["green"]["emoji"]
+def _bucket_rows_by_color(rows: List[sqlite3.Row]) -> Dict[str, List[sqlite3.Row]]:
+    """
+    Раскладывает исходники по цветам за один проход (порядок строк сохраняется).
+    Ключи: ключи RATEGRP_COLOR_CHOICES, "unrated", ключи NEWCOMP_COLOR_COMBOS и
+    "green_new" — все зелёные исходники и любые исходники без PMV-истории,
+    "green_new_unrated" — часть "green_new" без цветовой оценки.
+    """
+    buckets: Dict[str, List[sqlite3.Row]] = {key: [] for key in RATEGRP_COLOR_CHOICES}
+    buckets["unrated"] = []
+    buckets["green_new"] = []
+    buckets["green_new_unrated"] = []
+    combo_targets: Dict[str, List[List[sqlite3.Row]]] = {key: [] for key in RATEGRP_COLOR_CHOICES}
+    for combo_key, color_keys in NEWCOMP_COLOR_COMBOS.items():
+        buckets[combo_key] = []
+        for color_key in color_keys:
+            combo_targets[color_key].append(buckets[combo_key])
     for row in rows:
         emoji = _rategrp_row_color(row)
-        if emoji == green_emoji or _is_unused_source_row(row):
-            filtered.append(row)
-    return filtered
+        color_key = RATEGRP_EMOJI_TO_KEY.get(emoji) if emoji else None
+        if color_key is None:
+            buckets["unrated"].append(row)
+        else:
+            buckets[color_key].append(row)
+            for target in combo_targets[color_key]:
+                target.append(row)
+        if color_key == "green":
+            buckets["green_new"].append(row)
+        elif _is_unused_source_row(row):
+            buckets["green_new"].append(row)
+            if color_key is None:
+                buckets["green_new_unrated"].append(row)
+    return buckets
 
 
 def _prepare_rategrp_queue(rows: List[sqlite3.Row]) -> List[Dict[str, Any]]:
@@ -2663,16 +2890,17 @@ def _rategrp_update_cached_row_color(
     if not updated_comments:
         return
     rows = session.get("rategrp_rerate_rows") or []
-    for row in rows:
+    for idx, row in enumerate(rows):
         try:
-            row_id = int(row.get("id") if isinstance(row, dict) else row["id"])
+            row_id = int(row["id"])
         except Exception:
             continue
         if row_id == source_id:
-            try:
-                row["comments"] = updated_comments  # type: ignore[index]
-            except Exception:
-                pass
+            # sqlite3.Row неизменяем — копируем в dict только обновляемую строку
+            if not isinstance(row, dict):
+                row = dict(row)
+                rows[idx] = row
+            row["comments"] = updated_comments
             break
 
 
@@ -3072,6 +3300,7 @@ def db_update_sources_pmv_list(source_ids: List[int], pmv_tag: str) -> None:
             new_val = ", ".join(parts)
         cur.execute("UPDATE sources SET pmv_list = ? WHERE id = ?", (new_val, sid))
     conn.commit()
+    _note_db_write()
     conn.close()
 
 
@@ -3095,6 +3324,7 @@ def db_insert_compilation(
         ),
     )
     conn.commit()
+    _note_db_write()
     conn.close()
 
 def db_get_all_sources() -> List[sqlite3.Row]:
@@ -3117,41 +3347,87 @@ def db_get_sources_full() -> List[Dict[str, Any]]:
     cur = conn.cursor()
     cur.execute(
         """
-        SELECT id, video_name, video_path, size_bytes, codec, resolution,
-               pmv_list, comments, date_added
+        SELECT id, video_name, COALESCE(video_path, '') AS video_path,
+               COALESCE(size_bytes, 0) AS size_bytes,
+               COALESCE(codec, '') AS codec, COALESCE(resolution, '') AS resolution,
+               COALESCE(pmv_list, '') AS pmv_list, COALESCE(comments, '') AS comments,
+               date_added
         FROM sources
         ORDER BY id
         """
     )
+    # NULL-поля приводятся к пустым значениям прямо в SQL — /scan берёт их как есть.
     rows = [dict(row) for row in cur.fetchall()]
     conn.close()
     return rows
 
 
-def db_update_source_fields(source_id: int, **fields: Any) -> None:
-    if not fields:
+def db_update_sources_many(
+    updates: Iterable[Tuple[int, Dict[str, Any]]],
+    conn: Optional[sqlite3.Connection] = None,
+) -> None:
+    """
+    Пакетный UPDATE sources по парам (id, {колонка: значение}).
+    Строки с одинаковым набором колонок уходят одним executemany, порядок внутри набора сохраняется.
+    Если передан conn — работает внутри чужой транзакции и не коммитит.
+    """
+    grouped: Dict[Tuple[str, ...], List[List[Any]]] = {}
+    for source_id, fields in updates:
+        if not fields:
+            continue
+        columns = tuple(sorted(fields))
+        params = [fields[key] for key in columns]
+        params.append(source_id)
+        grouped.setdefault(columns, []).append(params)
+    if not grouped:
         return
-    columns = ", ".join(f"{key} = ?" for key in fields.keys())
-    params = list(fields.values())
-    params.append(source_id)
-    conn = get_conn()
+    own_conn = conn is None
+    if own_conn:
+        conn = get_conn()
     cur = conn.cursor()
-    cur.execute(f"UPDATE sources SET {columns} WHERE id = ?", params)
-    conn.commit()
-    conn.close()
+    for columns, rows in grouped.items():
+        assignments = ", ".join(f"{key} = ?" for key in columns)
+        cur.executemany(f"UPDATE sources SET {assignments} WHERE id = ?", rows)
+    if own_conn:
+        conn.commit()
+        _note_db_write()
+        conn.close()
 
 
-def db_delete_sources_by_ids(ids: Iterable[int]) -> int:
+def db_delete_sources_by_ids(
+    ids: Iterable[int],
+    conn: Optional[sqlite3.Connection] = None,
+) -> int:
+    """
+    Удаляет исходники одним DELETE: id передаются JSON-массивом через json_each, без тысяч
+    плейсхолдеров (лимит параметров SQLite). Если передан conn — работает внутри чужой транзакции и не коммитит.
+    """
     ids_list = [int(i) for i in ids]
     if not ids_list:
         return 0
-    placeholders = ", ".join("?" for _ in ids_list)
-    conn = get_conn()
+    own_conn = conn is None
+    if own_conn:
+        conn = get_conn()
     cur = conn.cursor()
-    cur.execute(f"DELETE FROM sources WHERE id IN ({placeholders})", ids_list)
+    try:
+        cur.execute(
+            "DELETE FROM sources WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(ids_list),),
+        )
+    except sqlite3.OperationalError:
+        # SQLite собран без JSON1 — id через временную таблицу.
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS delete_source_ids (id INTEGER PRIMARY KEY)")
+        cur.execute("DELETE FROM temp.delete_source_ids")
+        cur.executemany(
+            "INSERT OR IGNORE INTO temp.delete_source_ids (id) VALUES (?)",
+            [(source_id,) for source_id in ids_list],
+        )
+        cur.execute("DELETE FROM sources WHERE id IN (SELECT id FROM temp.delete_source_ids)")
     deleted = cur.rowcount
-    conn.commit()
-    conn.close()
+    if own_conn:
+        conn.commit()
+        _note_db_write()
+        conn.close()
     return deleted
 
 
@@ -3343,6 +3619,27 @@ def db_get_sources_by_ids(ids: Iterable[int]) -> List[sqlite3.Row]:
     return rows
 
 
+def db_get_sources_by_ids_map(ids: Iterable[int], chunk_size: int = 900) -> Dict[int, sqlite3.Row]:
+    """
+    Одним проходом достаёт исходники по списку id и возвращает {id: row}.
+    Запрос режется на пачки, чтобы не упереться в SQLITE_MAX_VARIABLE_NUMBER.
+    """
+    ids_list = list(dict.fromkeys(int(i) for i in ids if int(i) > 0))
+    result: Dict[int, sqlite3.Row] = {}
+    if not ids_list:
+        return result
+    conn = get_conn()
+    cur = conn.cursor()
+    for start in range(0, len(ids_list), chunk_size):
+        chunk = ids_list[start:start + chunk_size]
+        placeholders = ",".join("?" for _ in chunk)
+        cur.execute(f"SELECT * FROM sources WHERE id IN ({placeholders})", chunk)
+        for row in cur.fetchall():
+            result[int(row["id"])] = row
+    conn.close()
+    return result
+
+
 def db_get_random_name() -> str:
     conn = get_conn()
     cur = conn.cursor()
@@ -4027,6 +4324,10 @@ for _key, _meta in CLIP_SEQUENCE_ALGORITHMS.items():
     if short:
         CLIP_ALGO_CHOICE_MAP[short] = _key
 
+CLIP_ALGO_DESCRIPTION = ", ".join(
+    f"{meta['short']} ({meta['title']})" for meta in CLIP_SEQUENCE_ALGORITHMS.values()
+)
+
 
 def normalize_clip_algo_choice(choice: str) -> Optional[str]:
     if not choice:
@@ -4173,7 +4474,7 @@ def generate_musicprep_click_preview(project: Dict[str, Any]) -> Path:
     manifest_data = project.get("manifest_data")
     manifest_path = Path(project.get("manifest_path") or "")
     if not manifest_data and manifest_path.exists():
-        manifest_data = json.loads(manifest_path.read_text(encoding="utf-8"))
+        manifest_data = load_manifest_json(manifest_path)
         project["manifest_data"] = manifest_data
     segments = parse_manifest_segments(manifest_data or {})
     if not segments:
@@ -5511,7 +5812,70 @@ def autocreate_pmv_batch(
 # ТЕЛЕГРАМ-БОТ
 # =========================
 
-user_sessions: Dict[int, Dict] = {}
+SESSION_TTL_SECONDS = 3600
+SESSION_MAX_USERS = 10_000
+_MISSING = object()
+
+
+class SessionStore:
+    """
+    Хранилище диалоговых сессий по user_id с автоочисткой брошенных диалогов:
+    сессия живёт SESSION_TTL_SECONDS с последнего обращения. Повторяет
+    нужную часть интерфейса dict (get / pop / [] / in / len).
+    """
+
+    def __init__(self, ttl: float = SESSION_TTL_SECONDS, maxsize: int = SESSION_MAX_USERS) -> None:
+        self._ttl = ttl
+        self._maxsize = maxsize
+        # user_id -> (время последнего обращения, сессия); порядок — от самых старых.
+        self._data: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def _purge(self, now: float) -> None:
+        while self._data:
+            oldest_ts, _ = next(iter(self._data.values()))
+            if now - oldest_ts < self._ttl and len(self._data) <= self._maxsize:
+                break
+            self._data.popitem(last=False)
+
+    def get(self, user_id: int, default: Any = None) -> Any:
+        now = time.monotonic()
+        self._purge(now)
+        item = self._data.get(user_id)
+        if item is None:
+            return default
+        self._data[user_id] = (now, item[1])
+        self._data.move_to_end(user_id)
+        return item[1]
+
+    def __getitem__(self, user_id: int) -> Dict[str, Any]:
+        sess = self.get(user_id, _MISSING)
+        if sess is _MISSING:
+            raise KeyError(user_id)
+        return sess
+
+    def __setitem__(self, user_id: int, sess: Dict[str, Any]) -> None:
+        now = time.monotonic()
+        self._data[user_id] = (now, sess)
+        self._data.move_to_end(user_id)
+        self._purge(now)
+
+    def pop(self, user_id: int, default: Any = None) -> Any:
+        item = self._data.pop(user_id, None)
+        return default if item is None else item[1]
+
+    def __contains__(self, user_id: object) -> bool:
+        return self.get(user_id, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        self._purge(time.monotonic())
+        return len(self._data)
+
+
+user_sessions = SessionStore()
+
+_YES_SET = frozenset(("да", "д", "yes", "y"))
+_NO_SET = frozenset(("нет", "не", "no", "n"))
+_ALL_SET = frozenset(("all", "все"))
 
 
 def check_access(update: Update) -> bool:
@@ -5523,11 +5887,23 @@ async def unauthorized(update: Update) -> None:
     await update.effective_chat.send_message("⛔ У вас нет доступа к этому боту.")
 
 
+HandlerFunc = Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
 
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
 
+def authed(handler: HandlerFunc) -> HandlerFunc:
+    """Декоратор хендлера: пускает только ALLOWED_USER_ID, остальным — unauthorized()."""
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not check_access(update):
+            return await unauthorized(update)
+        return await handler(update, context)
+
+    return wrapper
+
+
+@authed
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = (
         f"👋 Привет! PMV-бот {BUILD_NAME}.\n\n"
         "Доступные команды:\n"
@@ -5556,13 +5932,12 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
     await update.message.reply_text(text, reply_markup=build_main_reply_keyboard())
 
+
+@authed
 async def cmd_lookcom(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Показать комментарии к компиляциям и исходникам.
     """
-    if not check_access(update):
-        return await unauthorized(update)
-
     comp_rows = db_get_compilations_with_comments()
     src_rows = db_get_sources_with_comments()
 
@@ -5595,14 +5970,12 @@ async def cmd_lookcom(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 
 
+@authed
 async def cmd_compmv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Добавить комментарий к компиляции (PMV).
     /compmv -> список PMV -> номер -> текст комментария.
     """
-    if not check_access(update):
-        return await unauthorized(update)
-
     rows = db_get_all_compilations()
     if not rows:
         return await update.message.reply_text("Пока нет ни одной компиляции.")
@@ -5624,10 +5997,8 @@ async def cmd_compmv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     await update.message.reply_text("\n".join(lines))
 
 
+@authed
 async def cmd_addfolder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     args = context.args
     if not args:
         return await update.message.reply_text("Использование: /addfolder C:\\path\\to\\folder")
@@ -5641,10 +6012,8 @@ async def cmd_addfolder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await update.message.reply_text(f"✅ Папка добавлена: {p}")
 
 
+@authed
 async def cmd_folders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     rows = db_get_upload_folders(include_ignored=True)
     if not rows:
         return await update.message.reply_text("Папок загрузки пока нет. Добавьте через /addfolder")
@@ -5665,10 +6034,8 @@ async def cmd_folders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await update.message.reply_text("\n".join(lines))
 
 
+@authed
 async def cmd_scan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     rows = db_get_upload_folders()
     if not rows:
         return await update.message.reply_text("Нет активных папок. Добавьте её через /addfolder")
@@ -5678,14 +6045,13 @@ async def cmd_scan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     env = ScanEnvironment(
         default_exts=DEFAULT_EXTS,
-        normalize_path_str=_normalize_path_str,
         normalize_path_prefix=_normalize_path_prefix,
-        is_path_under_prefixes=_is_path_under_prefixes,
         combine_comments=combine_comments,
         merge_pmv_lists=merge_pmv_lists,
         video_info_sort=video_info_sort,
+        db_connect=get_conn,
         db_get_sources_full=db_get_sources_full,
-        db_update_source_fields=db_update_source_fields,
+        db_update_sources_many=db_update_sources_many,
         db_insert_source=db_insert_source,
         db_delete_sources_by_ids=db_delete_sources_by_ids,
         db_path=DB_PATH,
@@ -5693,16 +6059,15 @@ async def cmd_scan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
     lines, _stats = run_scan(rows, ignored_rows, env)
+    _note_db_write()
     symlink_notes = sync_nas_symlinks()
     if symlink_notes:
         lines.append("")
         lines.extend(symlink_notes)
     await update.message.reply_text("\n".join(lines))
 
+@authed
 async def cmd_scanignore(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     user_id = update.effective_user.id
     user_sessions[user_id] = {
         "state": "scanignore_wait_path",
@@ -5714,14 +6079,12 @@ async def cmd_scanignore(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     ]
     await update.message.reply_text("\n".join(lines))
 
+@authed
 async def cmd_comvid(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Добавить комментарий к исходнику.
     /comvid -> список исходников -> номер -> текст комментария.
     """
-    if not check_access(update):
-        return await unauthorized(update)
-
     rows = db_get_all_sources()
     if not rows:
         return await update.message.reply_text("В базе нет исходников.")
@@ -5742,6 +6105,7 @@ async def cmd_comvid(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
     await update.message.reply_text("\n".join(lines))
 
+@authed
 async def cmd_autocreate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Автоматическое создание нескольких PMV подряд.
@@ -5757,9 +6121,6 @@ async def cmd_autocreate(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
        соблюдая пропорцию: половина из новых, половина из старых
        (при нечётном количестве — +1 к новым).
     """
-    if not check_access(update):
-        return await unauthorized(update)
-
     user_id = update.effective_user.id
 
     user_sessions[user_id] = {
@@ -5890,16 +6251,14 @@ def fallback_new_only_make_one(
 
 
 
+@authed
 async def cmd_pmvnew(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     groups = db_get_unused_sources_grouped()
     if not groups:
         return await update.message.reply_text("Нет исходников без PMV. Сначала воспользуйтесь /scan.")
 
     group_entries = [
-        SourceGroupEntry(key=key, rows=list(rows), unused_count=len(rows))
+        SourceGroupEntry(key=key, rows=rows, unused_count=len(rows))
         for key, rows in groups.items()
     ]
     group_entries = sort_source_group_entries(group_entries)
@@ -5920,13 +6279,11 @@ async def cmd_pmvnew(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
     await update.message.reply_text("\n".join(lines))
 
+@authed
 async def cmd_pmvold(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Как pmvnew, но берёт ВСЕ исходники, а не только те, у которых pmv_list пустой.
     """
-    if not check_access(update):
-        return await unauthorized(update)
-
     groups = db_get_all_sources_grouped()
     if not groups:
         return await update.message.reply_text("В базе нет исходников. Сначала воспользуйтесь /scan.")
@@ -5935,7 +6292,7 @@ async def cmd_pmvold(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     group_entries = [
         SourceGroupEntry(
             key=key,
-            rows=list(rows),
+            rows=rows,
             unused_count=len(unused_groups.get(key, [])),
         )
         for key, rows in groups.items()
@@ -5961,762 +6318,1192 @@ async def cmd_pmvold(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
 
 
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
+# Обработчики текстовых ответов по состоянию диалога: state -> корутина.
+TextStateHandler = Callable[
+    [Update, ContextTypes.DEFAULT_TYPE, Dict[str, Any], int, str, Callable[..., Awaitable[None]]],
+    Awaitable[None],
+]
 
-    user_id = update.effective_user.id
-    text = (update.message.text or "").strip()
 
-    # Локальный хелпер, режет длинные сообщения на части
-    async def reply_long(msg: str, chunk_size: int = 4000):
-        if len(msg) <= chunk_size:
-            await update.message.reply_text(msg)
-            return
-        for i in range(0, len(msg), chunk_size):
-            await update.message.reply_text(msg[i:i + chunk_size])
+async def _handle_text_scanignore_wait_path(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    candidate = text.strip().strip('"')
+    if not candidate:
+        return await reply_long("Пришлите путь к папке, например X:\\\\tor\\\\tmp.")
+    try:
+        raw_path = Path(candidate)
+        if not raw_path.is_absolute():
+            raw_path = (SCRIPT_DIR / raw_path).resolve(strict=False)
+        else:
+            raw_path = raw_path.resolve(strict=False)
+    except Exception as exc:
+        return await reply_long(f"Не удалось разобрать путь: {exc}")
 
-    lowered_text = text.lower()
-    if lowered_text in {"musicprep", "/musicprep"}:
-        return await cmd_musicprep(update, context)
-    if lowered_text in {"newcompmusic", "/newcompmusic"}:
-        return await cmd_newcompmusic(update, context)
-    if lowered_text in {"scan", "/scan"}:
-        return await cmd_scan(update, context)
-    if lowered_text in {"rategrp", "/rategrp"}:
-        return await cmd_rategrp(update, context)
-    if lowered_text in {"reports", "/reports", "отчёты", "отчеты"}:
-        return await cmd_reports(update, context)
-    if lowered_text in {"flagpmv", "/flagpmv", "find", "/find", "найти"}:
-        return await cmd_find(update, context)
-    if lowered_text in {"createrandompmv", "/createrandompmv"}:
-        return await cmd_randompmv(update, context)
+    db_add_scan_ignore(str(raw_path))
+    user_sessions.pop(user_id, None)
 
-    sess = user_sessions.get(user_id)
-    if not sess:
-        return await reply_long(
-            "Я вас не понял. Используйте /pmvnew для создания PMV или /scan для обновления исходников."
-        )
+    note = ""
+    if not raw_path.exists():
+        note = "\n⚠️ Папка пока не существует, но будет игнорироваться, когда появится."
+    return await reply_long(f"Готово. {raw_path} больше не сканируется.{note}")
 
-    state = sess.get("state")
 
-    if state == "scanignore_wait_path":
-        candidate = text.strip().strip('"')
-        if not candidate:
-            return await reply_long("Пришлите путь к папке, например X:\\\\tor\\\\tmp.")
-        try:
-            raw_path = Path(candidate)
-            if not raw_path.is_absolute():
-                raw_path = (SCRIPT_DIR / raw_path).resolve(strict=False)
-            else:
-                raw_path = raw_path.resolve(strict=False)
-        except Exception as exc:
-            return await reply_long(f"Не удалось разобрать путь: {exc}")
+async def _handle_text_use_buttons(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    return await reply_long("Используйте кнопки под сообщением или запустите команду заново.")
+
+
+async def _handle_text_randompmv_choose_orientation(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    choice = text.strip().upper()
+    if choice == "ВСЕ" or choice == "ALL":
+        orientation_choice = None
+    elif choice in NEWCOMPMUSIC_ORIENTATION_CHOICES:
+        orientation_choice = choice
+    else:
+        return await reply_long("Выберите ориентацию: VR, HOR, VER или ВСЕ.")
+    sess["randompmv_orientation_preference"] = orientation_choice
+    sess["state"] = "randompmv_wait_count"
+    user_sessions[user_id] = sess
+    label = choice if choice != "ALL" else "ВСЕ"
+    await update.message.reply_text(
+        f"Ориентация выбрана: {label}. Теперь выберите количество генераций.",
+        reply_markup=build_randompmv_count_keyboard(),
+    )
+    return
+
+
+async def _handle_text_randompmv_wait_count(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    sess = sess or {}
+    try:
+        total_runs = int(text)
+    except ValueError:
+        return await reply_long("Нужно указать целое число от 1 до 30.")
+    if total_runs < RANDOMPMV_MIN_BATCH:
+        return await reply_long("Нужно указать положительное число.")
+    total_runs = min(total_runs, RANDOMPMV_MAX_BATCH)
+    sess["randompmv_total_runs"] = total_runs
+    sess["state"] = "randompmv_wait_newcount"
+    user_sessions[user_id] = sess
+    await update.message.reply_text(
+        "Сколько новых исходников обязательно должно быть в PMV? (0 = любые)",
+        reply_markup=build_randompmv_newcount_keyboard(),
+    )
+    return
 
-        db_add_scan_ignore(str(raw_path))
+
+async def _handle_text_randompmv_wait_newcount(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    sess = sess or {}
+    try:
+        min_new = int(text)
+    except ValueError:
+        return await reply_long("Введите целое число новых исходников (0 допускается).")
+    if min_new < 0:
+        return await reply_long("Число новых исходников не может быть отрицательным.")
+    total_runs = int(sess.get("randompmv_total_runs") or 0)
+    if total_runs <= 0:
         user_sessions.pop(user_id, None)
+        return await reply_long("Сначала выберите количество генераций через CreateRandomPMV.")
+    user_sessions.pop(user_id, None)
+    await update.message.reply_text(
+        f"Запускаю {total_runs} Random PMV (новых ≥ {min_new})..."
+    )
+    orientation_pref = sess.get("randompmv_orientation_preference")
+    return await run_randompmv_batch(reply_long, user_id, total_runs, min_new, orientation_pref)
 
-        note = ""
-        if not raw_path.exists():
-            note = "\n⚠️ Папка пока не существует, но будет игнорироваться, когда появится."
-        return await reply_long(f"Готово. {raw_path} больше не сканируется.{note}")
-
-    if state in {
-        "musicprep_wait_track",
-        "musicprep_wait_seconds",
-        "musicprep_wait_mode",
-        "musicprep_wait_sensitivity",
-        "newcompmusic_wait_project",
-        "newcompmusic_wait_group",
-        "newcompmusic_choose_duration",
-        "newcompmusic_choose_groupmode",
-        "newcompmusic_choose_color",
-        "newcompmusic_wait_sources",
-        "newcompmusic_wait_algo",
-        "musicprepcheck_wait_project",
-        "musicprep_ask_sensitivity",
-    }:
-        return await reply_long("Используйте кнопки под сообщением или запустите команду заново.")
-
-    if state == "randompmv_choose_orientation":
-        choice = text.strip().upper()
-        if choice == "ВСЕ" or choice == "ALL":
-            orientation_choice = None
-        elif choice in NEWCOMPMUSIC_ORIENTATION_CHOICES:
-            orientation_choice = choice
+
+async def _handle_text_find(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    term = text.strip()
+    if not term:
+        return await reply_long("Пришлите часть названия файла, пример: 20251207 или 0734.")
+    matches = _search_find_matches(term)
+    sess["find_matches"] = matches
+    sess["find_sources_by_id"] = db_get_sources_by_ids_map(
+        m["id"] for m in matches if m.get("type") == "source"
+    )
+    if not matches:
+        sess["state"] = "find_wait_term"
+        return await reply_long("Не нашла PMV по этому фрагменту. Попробуйте другую часть имени.")
+    sess["state"] = "find_wait_choice"
+    pmv_count = sum(1 for m in matches if m.get("type") == "pmv")
+    src_count = sum(1 for m in matches if m.get("type") == "source")
+    lines = ["Нашлись совпадения. Выберите нужный файл кнопкой ниже."]
+    lines.append(f"PMV: {pmv_count} · Исходники: {src_count}")
+    for idx, match in enumerate(matches, 1):
+        if match.get("type") == "pmv":
+            lines.append(f"{idx}. PMV · {match.get('stem')}")
         else:
-            return await reply_long("Выберите ориентацию: VR, HOR, VER или ВСЕ.")
-        sess["randompmv_orientation_preference"] = orientation_choice
-        sess["state"] = "randompmv_wait_count"
-        user_sessions[user_id] = sess
-        label = choice if choice != "ALL" else "ВСЕ"
-        await update.message.reply_text(
-            f"Ориентация выбрана: {label}. Теперь выберите количество генераций.",
-            reply_markup=build_randompmv_count_keyboard(),
-        )
-        return
+            color = extract_color_emoji(match.get("comments"))
+            prefix = f"{color} " if color else ""
+            lines.append(f"{idx}. {prefix}{match.get('video_name')}")
+    await update.message.reply_text(
+        "\n".join(lines),
+        reply_markup=build_find_keyboard(matches),
+    )
+    return
 
-    if state == "randompmv_wait_count":
-        sess = sess or {}
-        try:
-            total_runs = int(text)
-        except ValueError:
-            return await reply_long("Нужно указать целое число от 1 до 30.")
-        if total_runs < RANDOMPMV_MIN_BATCH:
-            return await reply_long("Нужно указать положительное число.")
-        total_runs = min(total_runs, RANDOMPMV_MAX_BATCH)
-        sess["randompmv_total_runs"] = total_runs
-        sess["state"] = "randompmv_wait_newcount"
-        user_sessions[user_id] = sess
-        await update.message.reply_text(
-            "Сколько новых исходников обязательно должно быть в PMV? (0 = любые)",
-            reply_markup=build_randompmv_newcount_keyboard(),
-        )
-        return
 
-    if state == "randompmv_wait_newcount":
-        sess = sess or {}
+# =========================
+# NEWCOMPMUSIC: выбор музыкального проекта
+# =========================
+async def _handle_text_newcompmusic_choose_project(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    if not text.isdigit():
+        return await reply_long("Нужно прислать номер проекта (целое число).")
+    idx = int(text)
+    projects: List[Dict[str, Any]] = sess.get("music_projects") or []
+    if not (1 <= idx <= len(projects)):
+        return await reply_long("Нет проекта с таким номером. Попробуйте снова.")
+    chosen = projects[idx - 1]
+    manifest_data = chosen.get("manifest_data")
+    if not manifest_data and chosen.get("manifest_path") and chosen["manifest_path"].exists():
         try:
-            min_new = int(text)
-        except ValueError:
-            return await reply_long("Введите целое число новых исходников (0 допускается).")
-        if min_new < 0:
-            return await reply_long("Число новых исходников не может быть отрицательным.")
-        total_runs = int(sess.get("randompmv_total_runs") or 0)
-        if total_runs <= 0:
-            user_sessions.pop(user_id, None)
-            return await reply_long("Сначала выберите количество генераций через CreateRandomPMV.")
-        user_sessions.pop(user_id, None)
-        await update.message.reply_text(
-            f"Запускаю {total_runs} Random PMV (новых ≥ {min_new})..."
-        )
-        orientation_pref = sess.get("randompmv_orientation_preference")
-        return await run_randompmv_batch(reply_long, user_id, total_runs, min_new, orientation_pref)
-
-
-    if state in {"find_wait_term", "find_wait_choice"}:
-        term = text.strip()
-        if not term:
-            return await reply_long("Пришлите часть названия файла, пример: 20251207 или 0734.")
-        matches = _search_find_matches(term)
-        sess["find_matches"] = matches
-        if not matches:
-            sess["state"] = "find_wait_term"
-            return await reply_long("Не нашла PMV по этому фрагменту. Попробуйте другую часть имени.")
-        sess["state"] = "find_wait_choice"
-        pmv_count = sum(1 for m in matches if m.get("type") == "pmv")
-        src_count = sum(1 for m in matches if m.get("type") == "source")
-        lines = ["Нашлись совпадения. Выберите нужный файл кнопкой ниже."]
-        lines.append(f"PMV: {pmv_count} · Исходники: {src_count}")
-        for idx, match in enumerate(matches, 1):
-            if match.get("type") == "pmv":
-                lines.append(f"{idx}. PMV · {match.get('stem')}")
-            else:
-                color = extract_color_emoji(match.get("comments"))
-                prefix = f"{color} " if color else ""
-                lines.append(f"{idx}. {prefix}{match.get('video_name')}")
-        await update.message.reply_text(
-            "\n".join(lines),
-            reply_markup=build_find_keyboard(matches),
-        )
+            manifest_data = load_manifest_json(chosen["manifest_path"])
+            chosen["manifest_data"] = manifest_data
+        except Exception as exc:
+            return await reply_long(f"Не удалось прочитать manifest.json: {exc}")
+    parsed_segments = parse_manifest_segments(manifest_data or {})
+    total_duration = chosen.get("duration")
+    if total_duration is None and parsed_segments:
+        total_duration = parsed_segments[-1].end
+    seg_count = len(parsed_segments)
+    minutes = (total_duration or 0.0) / 60.0 if total_duration else None
+
+    sorted_entries, orientation_map = get_sorted_source_group_entries()
+    if not sorted_entries:
+        return await reply_long("Не удалось найти группы исходников. Сначала просканируйте /scan.")
+
+    sess["state"] = "newcompmusic_choose_orientation"
+    sess["music_selected"] = {
+        "slug": chosen["slug"],
+        "name": chosen["name"],
+        "duration": total_duration,
+        "segments": seg_count,
+        "manifest": manifest_data,
+        "audio_path": str(chosen.get("audio_path")) if chosen.get("audio_path") else None,
+        "parsed_segments": parsed_segments,
+    }
+    lines = [
+        f"Выбран проект: {chosen['name']} (slug: {chosen['slug']}).",
+        f"Смен клипов: {seg_count}",
+    ]
+    if minutes:
+        lines.append(f"Продолжительность ≈ {minutes:.1f} минут.")
+    sess["music_group_orientations"] = orientation_map
+    sess["music_groups_all"] = [
+        (entry.key, entry.rows, entry.unused_count) for entry in sorted_entries
+    ]
+    sess["music_groups_by_orientation"] = index_groups_by_orientation(
+        sess["music_groups_all"], orientation_map
+    )
+    sess["music_groups"] = []
+    sess["music_orientation_preference"] = None
+    lines.append("")
+    lines.append("Выберите ориентацию исходников: VR, HOR или VER.")
+    lines.append("Пришлите одно из этих значений или нажмите кнопку ниже.")
+    return await reply_long(
+        "\n".join(lines),
+        reply_markup=build_newcomp_orientation_keyboard(),
+    )
+
+
+async def _handle_text_newcompmusic_choose_orientation(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    choice = text.strip().upper()
+    if choice == "BACK":
+        return await reply_long("Выбор сброшен. Укажите ориентацию: VR, HOR или VER.")
+    if choice not in NEWCOMPMUSIC_ORIENTATION_CHOICES:
+        return await reply_long("Введите VR, HOR или VER.")
+    all_groups = sess.get("music_groups_all") or []
+    if not all_groups:
+        return await reply_long("Не удалось найти группы. Запустите /newcompmusic заново.")
+    filtered = _session_groups_for_orientation(sess, "music", choice)
+    if not filtered:
+        return await reply_long("Нет групп с такой ориентацией. Выберите другой режим.")
+    sess["music_orientation_preference"] = choice
+    sess["music_groups"] = filtered
+    sess["state"] = "newcompmusic_choose_group"
+    group_entries = [
+        SourceGroupEntry(key=key, rows=rows, unused_count=unused)
+        for key, rows, unused in filtered
+    ]
+
+    lines = _build_group_selection_lines(
+        sess, group_entries, choice, prompt_kind="text"
+    )
+    return await reply_long("\n".join(lines))
+
+
+async def _handle_text_newcompmusic_choose_group(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    if not text.isdigit():
+        return await reply_long("Нужно прислать номер группы.")
+    idx = int(text)
+    groups: List[Tuple[Tuple[str, str], List[sqlite3.Row], int]] = sess.get("music_groups") or []
+    if not (1 <= idx <= len(groups)):
+        return await reply_long("Нет группы с таким номером.")
+    key, rows, unused_count = groups[idx - 1]
+    if not rows:
+        return await reply_long("В выбранной группе нет исходников. Выберите другую.")
+
+    orientation_label = (sess.get("music_group_orientations") or {}).get(key)
+    if not orientation_label:
+        orientation_label = _resolution_orientation(key[1] or "")[0]
+    sess["music_group_choice"] = {
+        "key": key,
+        "count": len(rows),
+        "orientation": orientation_label,
+        "total_count": len(rows),
+        "unused_count": unused_count,
+        "group_number": idx,
+    }
+    sess["music_group_rows"] = list(rows)
+    sess["music_folder_only_new"] = False
+    sess.pop("music_color_rows", None)
+    sess["state"] = "newcompmusic_choose_groupmode"
+    summary = [
+        f"Группа {idx} выбрана: {key[0]} {key[1]} (исходников: {len(rows)}).",
+        "Как будем группировать исходники?",
+    ]
+    await reply_long("\n".join(summary))
+    return await update.message.reply_text(
+        "Выберите вариант:",
+        reply_markup=build_newcomp_groupmode_keyboard(),
+    )
+
+
+async def _handle_text_newcompmusic_wait_folder(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    options: List[Dict[str, Any]] = sess.get("music_folder_options") or []
+    if not text.isdigit():
+        return await reply_long("Выберите подпапку кнопками под сообщением или пришлите её номер.")
+    idx = int(text)
+    if not (1 <= idx <= len(options)):
+        return await reply_long("Нет папки с таким номером. Попробуйте снова.")
+    token = options[idx - 1]["token"]
+    try:
+        count, label = apply_newcomp_folder_choice(sess, token, next_state="newcompmusic_ask_sources")
+    except ValueError as exc:
+        return await reply_long(str(exc))
+    project_info = sess.get("music_selected") or {}
+    codec, res = sess.get("music_group_choice", {}).get("key") or ("?", "?")
+    lines = [
+        f"Папка выбрана: {label} (исходников: {count}).",
+        f"Группа: {codec} {res}.",
+        "Сколько исходников задействовать? Пришлите целое число (например: 6).",
+    ]
+    return await reply_long("\n".join(lines))
+
+
+async def _handle_text_newcompmusic_ask_sources(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    try:
+        sources_count = int(text)
+        if sources_count <= 0:
+            raise ValueError
+    except ValueError:
+        return await reply_long("Нужно указать положительное число исходников.")
+    available = int((sess.get("music_group_choice") or {}).get("count") or 0)
+    info_line = None
+    if available and sources_count > available:
+        sources_count = available
+        info_line = _source_limit_message(sess, available)
+
+    sess["music_sources"] = sources_count
+    sess["state"] = "newcompmusic_wait_algo"
+
+    msg_lines = []
+    if info_line:
+        msg_lines.append(info_line)
+    msg_lines.append(f"Ок, возьмём {sources_count} исходников.")
+    msg_lines.append(f"Выберите метод рандомизации клипов: {CLIP_ALGO_DESCRIPTION}")
+    await update.message.reply_text(
+        "\n".join(msg_lines),
+        reply_markup=build_newcomp_algo_keyboard(),
+    )
+    return
+
+
+async def _handle_text_rategrp_choose_rerate_color(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    color_key = normalize_rategrp_color_input(text)
+
+    async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        await update.message.reply_text(msg, reply_markup=markup)
+
+    if not color_key:
+        rows = sess.get("rategrp_rerate_rows") or []
+        available = _rategrp_available_colors(rows)
+        if available:
+            await send_rategrp(
+                "Выберите цвет с помощью кнопок ниже.",
+                build_rategrp_rerate_keyboard(available),
+            )
+        else:
+            await reply_long("Нет исходников для переоценки. Выберите другую группу.")
+        return
+    if await _rategrp_start_rerate(sess, color_key, send_rategrp):
         return
+    return
 
-    # =========================
-    # NEWCOMPMUSIC: выбор музыкального проекта
-    # =========================
-    if state == "newcompmusic_choose_project":
-        if not text.isdigit():
-            return await reply_long("Нужно прислать номер проекта (целое число).")
-        idx = int(text)
-        projects: List[Dict[str, Any]] = sess.get("music_projects") or []
-        if not (1 <= idx <= len(projects)):
-            return await reply_long("Нет проекта с таким номером. Попробуйте снова.")
-        chosen = projects[idx - 1]
-        manifest_data = chosen.get("manifest_data")
-        if not manifest_data and chosen.get("manifest_path") and chosen["manifest_path"].exists():
-            try:
-                manifest_data = json.loads(chosen["manifest_path"].read_text(encoding="utf-8"))
-                chosen["manifest_data"] = manifest_data
-            except Exception as exc:
-                return await reply_long(f"Не удалось прочитать manifest.json: {exc}")
-        parsed_segments = parse_manifest_segments(manifest_data or {})
-        total_duration = chosen.get("duration")
-        if total_duration is None and parsed_segments:
-            total_duration = parsed_segments[-1].end
-        seg_count = len(parsed_segments)
-        minutes = (total_duration or 0.0) / 60.0 if total_duration else None
-
-        groups = get_source_groups_prefer_unused()
-        if not groups:
-            return await reply_long("Не удалось найти группы исходников. Сначала просканируйте /scan.")
-
-        sess["state"] = "newcompmusic_choose_orientation"
-        sess["music_selected"] = {
-            "slug": chosen["slug"],
-            "name": chosen["name"],
-            "duration": total_duration,
-            "segments": seg_count,
-            "manifest": manifest_data,
-            "audio_path": str(chosen.get("audio_path")) if chosen.get("audio_path") else None,
-            "parsed_segments": parsed_segments,
-        }
-        lines = [
-            f"Выбран проект: {chosen['name']} (slug: {chosen['slug']}).",
-            f"Смен клипов: {seg_count}",
-        ]
-        if minutes:
-            lines.append(f"Продолжительность ≈ {minutes:.1f} минут.")
-        group_entries = [
-            SourceGroupEntry(key=key, rows=list(rows), unused_count=unused_count)
-            for key, rows, unused_count in groups
-        ]
-        sorted_entries, orientation_map = sort_group_entries_with_orientation(group_entries)
-        sess["music_group_orientations"] = orientation_map
-        sess["music_groups_all"] = [
-            (entry.key, entry.rows, entry.unused_count) for entry in sorted_entries
-        ]
-        sess["music_groups"] = []
-        sess["music_orientation_preference"] = None
-        lines.append("")
-        lines.append("Выберите ориентацию исходников: VR, HOR или VER.")
-        lines.append("Пришлите одно из этих значений или нажмите кнопку ниже.")
-        return await reply_long(
-            "\n".join(lines),
-            reply_markup=build_newcomp_orientation_keyboard(),
-        )
 
-    if state == "newcompmusic_choose_orientation":
-        choice = text.strip().upper()
-        if choice == "BACK":
-            return await reply_long("Выбор сброшен. Укажите ориентацию: VR, HOR или VER.")
-        if choice not in NEWCOMPMUSIC_ORIENTATION_CHOICES:
-            return await reply_long("Введите VR, HOR или VER.")
-        all_groups = sess.get("music_groups_all") or []
-        if not all_groups:
-            return await reply_long("Не удалось найти группы. Запустите /newcompmusic заново.")
-        orientation_map = sess.get("music_group_orientations") or {}
-        filtered = filter_groups_by_orientation(all_groups, orientation_map, choice)
-        if not filtered:
-            return await reply_long("Нет групп с такой ориентацией. Выберите другой режим.")
-        sess["music_orientation_preference"] = choice
-        sess["music_groups"] = filtered
-        sess["state"] = "newcompmusic_choose_group"
-        group_entries = [
-            SourceGroupEntry(key=key, rows=list(rows), unused_count=unused)
-            for key, rows, unused in filtered
-        ]
-        orientation_map = sess.get("music_group_orientations") or {}
+async def _handle_text_rategrp_rate_source(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    color_key = normalize_rategrp_color_input(text)
+    if not color_key:
+        return await reply_long(f"Используйте кнопки {RATEGRP_COLOR_PROMPT} или пришлите название цвета.")
 
-        lines = _build_group_selection_lines(
-            sess, group_entries, choice, prompt_kind="text"
-        )
-        return await reply_long("\n".join(lines))
+    async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        await update.message.reply_text(msg, reply_markup=markup)
 
-    if state == "newcompmusic_choose_group":
-        if not text.isdigit():
-            return await reply_long("Нужно прислать номер группы.")
-        idx = int(text)
-        groups: List[Tuple[Tuple[str, str], List[sqlite3.Row], int]] = sess.get("music_groups") or []
-        if not (1 <= idx <= len(groups)):
-            return await reply_long("Нет группы с таким номером.")
-        key, rows, unused_count = groups[idx - 1]
-        if not rows:
-            return await reply_long("В выбранной группе нет исходников. Выберите другую.")
-
-        orientation_label = (sess.get("music_group_orientations") or {}).get(key)
-        if not orientation_label:
-            orientation_label = _resolution_orientation(key[1] or "")[0]
-        sess["music_group_choice"] = {
-            "key": key,
-            "count": len(rows),
-            "orientation": orientation_label,
-            "total_count": len(rows),
-            "unused_count": unused_count,
-            "group_number": idx,
-        }
-        sess["music_group_rows"] = list(rows)
-        sess["music_folder_only_new"] = False
-        sess.pop("music_color_rows", None)
-        sess["state"] = "newcompmusic_choose_groupmode"
-        summary = [
-            f"Группа {idx} выбрана: {key[0]} {key[1]} (исходников: {len(rows)}).",
-            "Как будем группировать исходники?",
-        ]
-        await reply_long("\n".join(summary))
-        return await update.message.reply_text(
-            "Выберите вариант:",
-            reply_markup=build_newcomp_groupmode_keyboard(),
-        )
+    return await rategrp_apply_rating(sess, color_key, send_rategrp)
 
-    if state == "newcompmusic_wait_folder":
-        options: List[Dict[str, Any]] = sess.get("music_folder_options") or []
-        if not text.isdigit():
-            return await reply_long("Выберите подпапку кнопками под сообщением или пришлите её номер.")
-        idx = int(text)
-        if not (1 <= idx <= len(options)):
-            return await reply_long("Нет папки с таким номером. Попробуйте снова.")
-        token = options[idx - 1]["token"]
-        try:
-            count, label = apply_newcomp_folder_choice(sess, token, next_state="newcompmusic_ask_sources")
-        except ValueError as exc:
-            return await reply_long(str(exc))
-        project_info = sess.get("music_selected") or {}
-        codec, res = sess.get("music_group_choice", {}).get("key") or ("?", "?")
+
+# ====== MUSICPREP: выбор трека и параметров ======
+async def _handle_text_musicprep_choose_file(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    if not text.isdigit():
+        return await reply_long("Нужно прислать номер трека.")
+    files = sess.get("music_files") or []
+    idx = int(text)
+    if not (1 <= idx <= len(files)):
+        return await reply_long("Нет трека с таким номером.")
+    sess["musicprep_file"] = files[idx - 1]
+    sess["state"] = "musicprep_ask_name"
+    return await reply_long("Введите имя проекта (или оставьте пустым).")
+
+
+async def _handle_text_musicprep_ask_name(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    sess["musicprep_name"] = text.strip() or None
+    sess["state"] = "musicprep_ask_segment"
+    mod = load_music_generator_module()
+    default_seg = getattr(mod, "DEFAULT_TARGET_SEGMENT", 1.0)
+    return await reply_long(
+        f"Укажите минимальную длительность сегмента в секундах "
+        f"(по умолчанию {default_seg})."
+    )
+
+
+async def _handle_text_musicprep_ask_segment(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    mod = load_music_generator_module()
+    default_seg = getattr(mod, "DEFAULT_TARGET_SEGMENT", 1.0)
+    try:
+        segment_len = float(text)
+        if segment_len < 0:
+            raise ValueError
+    except ValueError:
+        segment_len = default_seg
+    sess["musicprep_segment"] = segment_len
+    sess["state"] = "musicprep_ask_mode"
+    modes = getattr(mod, "SEGMENT_MODES", ("beat",))
+    return await reply_long(
+        "Выберите алгоритм сегментации по музыке "
+        f"(доступны: {', '.join(modes)})."
+    )
+
+
+async def _handle_text_musicprep_ask_mode(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    mod = load_music_generator_module()
+    modes = getattr(mod, "SEGMENT_MODES", ("beat",))
+    mode = text.strip().lower() or getattr(mod, "DEFAULT_SEGMENT_MODE", modes[0])
+    if mode not in modes:
+        return await reply_long("Неизвестный режим. Повторите ввод.")
+    sess["musicprep_selected_mode"] = mode
+    options = get_musicprep_sensitivity_options(mode)
+    if options:
+        sess["musicprep_sensitivity_options"] = options
+        sess["state"] = "musicprep_ask_sensitivity"
         lines = [
-            f"Папка выбрана: {label} (исходников: {count}).",
-            f"Группа: {codec} {res}.",
-            "Сколько исходников задействовать? Пришлите целое число (например: 6).",
+            f"Алгоритм {mode} выбран.",
+            "Выберите чувствительность анализа:",
         ]
+        for idx, opt in enumerate(options, 1):
+            lines.append(f"{idx}. {opt['label']} — {opt['description']}")
+        lines.append("Пришлите номер или ключевое слово.")
         return await reply_long("\n".join(lines))
 
-    if state == "newcompmusic_ask_sources":
-        try:
-            sources_count = int(text)
-            if sources_count <= 0:
-                raise ValueError
-        except ValueError:
-            return await reply_long("Нужно указать положительное число исходников.")
-        available = int((sess.get("music_group_choice") or {}).get("count") or 0)
-        info_line = None
-        if available and sources_count > available:
-            sources_count = available
-            info_line = _source_limit_message(sess, available)
-
-        sess["music_sources"] = sources_count
-        sess["state"] = "newcompmusic_ask_algo"
-
-        algo_parts = [
-            f"{key} ({meta['title']})"
-            for key, meta in CLIP_SEQUENCE_ALGORITHMS.items()
-        ]
-        base_line = f"Ок, возьмём {sources_count} исходников."
-        if info_line:
-            base_line = f"{info_line}\n{base_line}"
-        msg = (
-            f"ÐÑÑÐ¿Ð¿Ð° {key[0]} {key[1]} Ð²ÑÐ±ÑÐ°Ð½Ð°. "
-            "ÐÐ¾Ð²ÑÑ Ð¸ÑÑÐ¾Ð´Ð½Ð¸ÐºÐ¾Ð² Ð½ÐµÑ, Ð²ÑÐ±ÐµÑÐ¸ÑÐµ ÑÐ²ÐµÑ Ð´Ð»Ñ Ð¿ÐµÑÐµÐ¾ÑÐµÐ½ÐºÐ¸:"
-        )
-        await update.message.reply_text(
-            msg, reply_markup=build_rategrp_rerate_keyboard(available)
-        )
-        return
-        sess["rategrp_queue"] = queue
-        sess["rategrp_total"] = len(queue)
-        sess["rategrp_processed"] = 0
-        sess["rategrp_queue_origin"] = "unrated"
-        sess["state"] = "rategrp_rate_source"
+    async def send(msg: str) -> None:
+        await reply_long(msg)
 
-        async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-            await update.message.reply_text(msg, reply_markup=markup)
+    return await finalize_musicprep_project(send, sess, user_id, mode)
 
-        await send_rategrp(f"Группа {key[0]} {key[1]} выбрана. Неоценённых исходников: {len(queue)}.")
-        return await rategrp_send_next_prompt(sess, send_rategrp)
 
-    if state == "rategrp_choose_rerate_color":
-        color_key = normalize_rategrp_color_input(text)
+# =========================
+# AUTOCREATE: диалог
+# =========================
+# Шаг 1: сколько видео создать
+async def _handle_text_autocreate_ask_count(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    try:
+        count = int(text)
+        if count <= 0:
+            raise ValueError
+    except ValueError:
+        return await reply_long("Нужно положительное целое число — сколько видео создать (например: 4).")
 
-        async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-            await update.message.reply_text(msg, reply_markup=markup)
+    sess["autocreate_total_videos"] = count
+    sess["state"] = "autocreate_ask_length"
 
-        if not color_key:
-            rows = sess.get("rategrp_rerate_rows") or []
-            available = _rategrp_available_colors(rows)
-            if available:
-                await send_rategrp(
-                    "Выберите цвет с помощью кнопок ниже.",
-                    build_rategrp_rerate_keyboard(available),
-                )
-            else:
-                await reply_long("Нет исходников для переоценки. Выберите другую группу.")
-            return
-        if await _rategrp_start_rerate(sess, color_key, send_rategrp):
-            return
-        return
+    return await reply_long(
+        f"Ок, создаём до {count} видео.\n"
+        "Теперь введите длину КАЖДОГО видео в минутах (например: 15)."
+    )
 
-    if state == "rategrp_rate_source":
-        color_key = normalize_rategrp_color_input(text)
-        if not color_key:
-            return await reply_long(f"Используйте кнопки {RATEGRP_COLOR_PROMPT} или пришлите название цвета.")
 
-        async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-            await update.message.reply_text(msg, reply_markup=markup)
-
-        return await rategrp_apply_rating(sess, color_key, send_rategrp)
-    # ====== MUSICPREP: выбор трека и параметров ======
-    if state == "musicprep_choose_file":
-        if not text.isdigit():
-            return await reply_long("Нужно прислать номер трека.")
-        files = sess.get("music_files") or []
-        idx = int(text)
-        if not (1 <= idx <= len(files)):
-            return await reply_long("Нет трека с таким номером.")
-        sess["musicprep_file"] = files[idx - 1]
-        sess["state"] = "musicprep_ask_name"
-        return await reply_long("Введите имя проекта (или оставьте пустым).")
-
-    if state == "musicprep_ask_name":
-        sess["musicprep_name"] = text.strip() or None
-        sess["state"] = "musicprep_ask_segment"
-        mod = load_music_generator_module()
-        default_seg = getattr(mod, "DEFAULT_TARGET_SEGMENT", 1.0)
-        return await reply_long(
-            f"Укажите минимальную длительность сегмента в секундах "
-            f"(по умолчанию {default_seg})."
+# Шаг 2: длина каждого видео
+async def _handle_text_autocreate_ask_length(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    try:
+        minutes = int(text)
+        if minutes <= 0:
+            raise ValueError
+    except ValueError:
+        minutes = DEFAULT_TARGET_MINUTES
+
+    sess["autocreate_minutes"] = minutes
+    sess["state"] = "autocreate_ask_max_sources"
+
+    return await reply_long(
+        f"Желаемая длительность PMV около {minutes} минут.\n"
+        "Теперь введите МАКСИМАЛЬНОЕ количество исходников на одно видео (например: 10)."
+    )
+
+
+async def _handle_text_autocreate_ask_max_sources(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    try:
+        max_sources = int(text)
+        if max_sources <= 0:
+            raise ValueError
+    except ValueError:
+        max_sources = 10
+
+    min_sources = max_sources
+    total_videos = sess.get("autocreate_total_videos", 1)
+    minutes = sess.get("autocreate_minutes", DEFAULT_TARGET_MINUTES)
+
+    user_sessions.pop(user_id, None)
+
+    await reply_long(
+        f"Запускаю пакетную генерацию из {total_videos} PMV.\n"
+        f"Длительность каждого: ~{minutes} минут.\n"
+        f"Исходников на одно видео: минимум {min_sources}, максимум {max_sources}.\n"
+        "Попробую собрать максимально разнообразные (как по использованным источникам) ролики, "
+        "насколько это получится. Ну что, поехали..."
+    )
+
+    try:
+        # В отдельном потоке, чтобы не блокировать event loop на время генерации.
+        report = await asyncio.to_thread(
+            autocreate_pmv_batch,
+            total_videos=total_videos,
+            minutes_each=minutes,
+            max_sources=max_sources,
+            min_sources=min_sources,
         )
+    except Exception as e:
+        return await reply_long(f"Ой, произошла ошибка во время пакетной генерации PMV: {e}")
 
-    if state == "musicprep_ask_segment":
-        mod = load_music_generator_module()
-        default_seg = getattr(mod, "DEFAULT_TARGET_SEGMENT", 1.0)
-        try:
-            segment_len = float(text)
-            if segment_len < 0:
-                raise ValueError
-        except ValueError:
-            segment_len = default_seg
-        sess["musicprep_segment"] = segment_len
-        sess["state"] = "musicprep_ask_mode"
-        modes = getattr(mod, "SEGMENT_MODES", ("beat",))
-        return await reply_long(
-            "Выберите алгоритм сегментации по музыке "
-            f"(доступны: {', '.join(modes)})."
+    return await reply_long(report)
+
+
+# =========================
+# ДАЛЬШЕ — ВСЯ СТАРАЯ ЛОГИКА
+# =========================
+# ====== Шаг 1: выбор группы ======
+async def _handle_text_choose_group(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    if not text.isdigit():
+        return await reply_long("Нужно просто число — номер группы.")
+    idx = int(text)
+    groups: List[Tuple[Tuple[str, str], List[sqlite3.Row]]] = sess["groups"]
+    if not (1 <= idx <= len(groups)):
+        return await reply_long("Неверный номер группы.")
+    key, rows = groups[idx - 1]
+    codec, res = key
+
+    sess["state"] = "choose_files"
+    sess["current_group"] = key
+    sess["current_rows"] = rows
+
+    lines = [
+        f"Выбрана группа: {codec} {res}. Файлы:",
+        *(f"{i}. {Path(r['video_path']).name} (id={r['id']})" for i, r in enumerate(rows, 1)),
+        "",
+        "Ответьте: 'all' чтобы взять все, либо номера файлов через пробел (например: 1 3 5).",
+    ]
+    return await reply_long("\n".join(lines))
+
+
+# ====== Шаг 2: выбор файлов ======
+async def _handle_text_choose_files(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    rows: List[sqlite3.Row] = sess["current_rows"]
+
+    if text.lower() in _ALL_SET:
+        selected_rows = rows
+    else:
+        parts = text.replace(",", " ").split()
+        idxs = []
+        for p in parts:
+            if not p.isdigit():
+                continue
+            v = int(p)
+            if 1 <= v <= len(rows):
+                idxs.append(v - 1)
+        if not idxs:
+            return await reply_long(
+                "Не получилось распознать номера. Напишите 'all' или номера файлов через пробел."
+            )
+        selected_rows = [rows[i] for i in idxs]
+
+    if not selected_rows:
+        return await reply_long("Пустой выбор. Попробуйте ещё раз.")
+
+    sess["state"] = "choose_length"
+    sess["selected_rows"] = selected_rows
+
+    names = ", ".join(Path(r["video_path"]).name for r in selected_rows)
+    msg = (
+        f"Выбрано файлов: {len(selected_rows)}.\n"
+        f"Имена: {names}\n\n"
+        "Теперь введите желаемую длину итогового PMV в МИНУТАХ (например: 15)."
+    )
+    return await reply_long(msg)
+
+
+# ====== Шаг 3: выбор длины ======
+async def _handle_text_choose_length(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    try:
+        minutes = int(text)
+        if minutes <= 0:
+            raise ValueError
+    except ValueError:
+        minutes = DEFAULT_TARGET_MINUTES
+
+    sess["target_minutes"] = minutes
+    sess["state"] = "choose_big_parts"
+
+    return await reply_long(
+        f"Ок, целевая длина ~{minutes} минут.\n"
+        "Сколько БОЛЬШИХ частей на каждый файл (big_parts)? (по умолчанию 5)"
+    )
+
+
+# ====== Шаг 4: выбор big_parts ======
+async def _handle_text_choose_big_parts(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    try:
+        big_parts = int(text)
+        if big_parts <= 0:
+            raise ValueError
+    except ValueError:
+        big_parts = 5
+
+    sess["big_parts"] = big_parts
+    sess["state"] = "choose_small_parts"
+
+    return await reply_long(
+        f"big_parts = {big_parts}\n"
+        "Сколько МАЛЕНЬКИХ клипов в каждой большой части (small_per_big)? (по умолчанию 5)"
+    )
+
+
+# ====== Шаг 5: выбор small_per_big и запуск нарезки ======
+async def _handle_text_choose_small_parts(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    try:
+        small_per_big = int(text)
+        if small_per_big <= 0:
+            raise ValueError
+    except ValueError:
+        small_per_big = 5
+
+    minutes = sess["target_minutes"]
+    selected_rows: List[sqlite3.Row] = sess["selected_rows"]
+    big_parts = sess["big_parts"]
+
+    target_seconds = minutes * 60
+
+    await reply_long(
+        f"Ок, делаем PMV ~{minutes} минут.\n"
+        f"big_parts = {big_parts}, small_per_big = {small_per_big}, файлов: {len(selected_rows)}.\n"
+        "Начинаю нарезку, подождите..."
+    )
+
+    paths = [Path(r["video_path"]) for r in selected_rows]
+    source_ids = [int(r["id"]) for r in selected_rows]
+
+    user_sessions.pop(user_id, None)
+
+    manual_algo_key = random.choice(list(CLIP_SEQUENCE_ALGORITHMS.keys()))
+    manual_algo_key, manual_algo_meta = resolve_clip_algorithm(manual_algo_key)
+
+    move_comment = ""
+    try:
+        out_path = make_pmv_from_files(
+            paths,
+            target_seconds,
+            big_parts,
+            small_per_big,
+            clip_algo_key=manual_algo_key,
         )
+        out_path, move_comment = move_output_to_network_storage(out_path)
+    except Exception as e:
+        return await reply_long(f"❌ Ошибка при создании PMV: {e}")
 
-    if state == "musicprep_ask_mode":
-        mod = load_music_generator_module()
-        modes = getattr(mod, "SEGMENT_MODES", ("beat",))
-        mode = text.strip().lower() or getattr(mod, "DEFAULT_SEGMENT_MODE", modes[0])
-        if mode not in modes:
-            return await reply_long("Неизвестный режим. Повторите ввод.")
-        sess["musicprep_selected_mode"] = mode
-        options = get_musicprep_sensitivity_options(mode)
-        if options:
-            sess["musicprep_sensitivity_options"] = options
-            sess["state"] = "musicprep_ask_sensitivity"
-            lines = [
-                f"Алгоритм {mode} выбран.",
-                "Выберите чувствительность анализа:",
-            ]
-            for idx, opt in enumerate(options, 1):
-                lines.append(f"{idx}. {opt['label']} — {opt['description']}")
-            lines.append("Пришлите номер или ключевое слово.")
-            return await reply_long("\n".join(lines))
-
-        async def send(msg: str) -> None:
-            await reply_long(msg)
-
-        return await finalize_musicprep_project(send, sess, user_id, mode)
-
-    if state == "musicprep_ask_sensitivity":
-        options: List[Dict[str, Any]] = sess.get("musicprep_sensitivity_options") or []
-        mode = sess.get("musicprep_selected_mode") or "beat"
-        if not options:
-            sess["state"] = "musicprep_ask_mode"
-            return await reply_long("Повторите выбор алгоритма сегментации.")
-
-        choice = text.strip().lower()
-        selected: Optional[Dict[str, Any]] = None
-        if choice.isdigit():
-            idx = int(choice) - 1
-            if 0 <= idx < len(options):
-                selected = options[idx]
-        if not selected:
-            for opt in options:
-                if choice in {opt["key"].lower(), opt["label"].lower()}:
-                    selected = opt
-                    break
-        if not selected:
-            return await reply_long("Не удалось распознать вариант. Пришлите номер из списка.")
-
-        analysis_kwargs = selected.get("analysis_kwargs") or {}
-
-        async def send(msg: str) -> None:
-            await reply_long(msg)
-
-        return await finalize_musicprep_project(send, sess, user_id, mode, analysis_kwargs)
-
-    # ====== MUSICPREP: выбор трека и параметров ======
-    if state == "musicprep_choose_file":
-        if not text.isdigit():
-            return await reply_long("Нужно прислать номер трека.")
-        files = sess.get("music_files") or []
-        idx = int(text)
-        if not (1 <= idx <= len(files)):
-            return await reply_long("Нет трека с таким номером.")
-        sess["musicprep_file"] = files[idx - 1]
-        sess["state"] = "musicprep_ask_name"
-        return await reply_long("Введите имя проекта (или оставьте пустым).")
-
-    if state == "musicprep_ask_name":
-        sess["musicprep_name"] = text.strip() or None
-        sess["state"] = "musicprep_ask_segment"
-        mod = load_music_generator_module()
-        default_seg = getattr(mod, "DEFAULT_TARGET_SEGMENT", 1.0)
+    pmv_tag = Path(out_path).name
+    db_insert_compilation(out_path, source_ids, comments=move_comment)
+    db_update_sources_pmv_list(source_ids, pmv_tag)
+
+    return await reply_long(
+        f"✅ Готово!\nФайл: {out_path}\n"
+        f"Алгоритм клипов: {manual_algo_meta['title']} ({manual_algo_meta['short']}).\n"
+        f"PMV записан в базу, исходники помечены как использованные."
+    )
+
+
+async def _handle_text_ratepmv_choose_pmv(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    tokens = text.replace(",", " ").split()
+    digits = [t for t in tokens if t.isdigit()]
+    if len(digits) < 2:
         return await reply_long(
-            f"Укажите минимальную длительность сегмента в секундах "
-            f"(по умолчанию {default_seg})."
+            "Укажи хотя бы одну пару `<номер> <оценка 1-5>` (например: `2 5` или `1 5 2 4`)."
         )
 
-    if state == "musicprep_ask_segment":
-        mod = load_music_generator_module()
-        default_seg = getattr(mod, "DEFAULT_TARGET_SEGMENT", 1.0)
-        try:
-            segment_len = float(text)
-            if segment_len < 0:
-                raise ValueError
-        except ValueError:
-            segment_len = default_seg
-        sess["musicprep_segment"] = segment_len
-        sess["state"] = "musicprep_ask_mode"
-        modes = getattr(mod, "SEGMENT_MODES", ("beat",))
+    numbers = [int(t) for t in digits]
+    if len(numbers) == 2:
+        idx, rating = numbers
+        await process_ratepmv_choice(sess, idx, rating, reply_long)
+        return
+
+    if len(numbers) % 2 != 0:
         return await reply_long(
-            "Выберите алгоритм сегментации по музыке "
-            f"(доступны: {', '.join(modes)})."
+            "В пакетном режиме нужно чётное количество чисел — номер PMV и оценка 1-5."
         )
 
-    if state == "musicprep_ask_mode":
-        mod = load_music_generator_module()
-        modes = getattr(mod, "SEGMENT_MODES", ("beat",))
-        mode = text.strip().lower() or getattr(mod, "DEFAULT_SEGMENT_MODE", modes[0])
-        if mode not in modes:
-            return await reply_long("Неизвестный режим. Повторите ввод.")
-        sess["musicprep_selected_mode"] = mode
-        options = get_musicprep_sensitivity_options(mode)
-        if options:
-            sess["musicprep_sensitivity_options"] = options
-            sess["state"] = "musicprep_ask_sensitivity"
-            lines = [
-                f"Алгоритм {mode} выбран.",
-                "Выберите чувствительность анализа:",
-            ]
-            for idx, opt in enumerate(options, 1):
-                lines.append(f"{idx}. {opt['label']} — {opt['description']}")
-            lines.append("Пришлите номер или ключевое слово.")
-            return await reply_long("\n".join(lines))
+    pmv_rows: List[sqlite3.Row] = sess.get("pmv_rows") or []
+    if not pmv_rows:
+        return await reply_long("Не удалось найти список PMV для оценки.")
 
-        async def send(msg: str) -> None:
-            await reply_long(msg)
+    await reply_long("Принял пакет, выставляю оценки...")
 
-        return await finalize_musicprep_project(send, sess, user_id, mode)
+    numbers_iter = iter(numbers)
+    rating_pairs = list(zip(numbers_iter, numbers_iter))
+    success_lines, error_lines = apply_pmv_rating_pairs(pmv_rows, rating_pairs)
 
-    # =========================
-    # AUTOCREATE: диалог
-    # =========================
+    if not success_lines:
+        msg = "Не удалось обработать ни одну пару. Проверь номера и оценки."
+        if error_lines:
+            msg += "\n" + "\n".join(error_lines)
+        return await reply_long(msg)
 
-    # Шаг 1: сколько видео создать
-    if state == "autocreate_ask_count":
-        try:
-            count = int(text)
-            if count <= 0:
-                raise ValueError
-        except ValueError:
-            return await reply_long("Нужно положительное целое число — сколько видео создать (например: 4).")
+    user_sessions.pop(user_id, None)
+
+    lines = [
+        f"✅ Пакетная оценка завершена, обновлено PMV: {len(success_lines)}.",
+        "Успешно отмечены:",
+    ]
+    lines.extend(f"- {entry}" for entry in success_lines)
+    if error_lines:
+        lines.append("")
+        lines.append("⚠️ Пропущены:")
+        lines.extend(f"- {entry}" for entry in error_lines)
+    lines.append("")
+    lines.append("Оценки источников в пакетном режиме не ставятся — отправь конкретный PMV отдельно, если нужно.")
+    return await reply_long("\n".join(lines))
 
-        sess["autocreate_total_videos"] = count
-        sess["state"] = "autocreate_ask_length"
 
+async def _handle_text_ratepmv_confirm_sources(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    answer = text.lower()
+    if answer not in _YES_SET and answer not in _NO_SET:
+        return await reply_long("Ответьте 'да' или 'нет'.")
+
+    if answer in _NO_SET:
+        user_sessions.pop(user_id, None)
+        return await reply_long("✅ Оценка PMV сохранена.")
+
+    chosen_pmv: Dict[str, Any] = sess["chosen_pmv"]
+    pmv_id = int(chosen_pmv["id"])
+    source_ids_str = chosen_pmv["source_ids"] or ""
+    src_ids = [int(x) for x in source_ids_str.split(",") if x.strip().isdigit()]
+
+    if not src_ids:
+        user_sessions.pop(user_id, None)
         return await reply_long(
-            f"Ок, создаём до {count} видео.\n"
-            "Теперь введите длину КАЖДОГО видео в минутах (например: 15)."
+            "В этой компиляции не нашлось исходников (source_ids пустые)."
         )
 
-    # Шаг 2: длина каждого видео
-    if state == "autocreate_ask_length":
-        try:
-            minutes = int(text)
-            if minutes <= 0:
-                raise ValueError
-        except ValueError:
-            minutes = DEFAULT_TARGET_MINUTES
+    conn = get_conn()
+    cur = conn.cursor()
+    q_marks = ",".join("?" for _ in src_ids)
+    cur.execute(f"SELECT * FROM sources WHERE id IN ({q_marks})", src_ids)
+    src_rows = cur.fetchall()
+    conn.close()
+
+    if not src_rows:
+        user_sessions.pop(user_id, None)
+        return await reply_long(
+            "Не удалось найти исходники в базе. Оценка PMV уже сохранена."
+        )
+
+    src_map = {r["id"]: r for r in src_rows}
+    ordered_sources = [src_map[sid] for sid in src_ids if sid in src_map]
+
+    # Выкидываем те исходники, которые уже оценены для ЭТОГО PMV
+    unrated_sources = []
+    already_rated = 0
+    marker_search = re.compile(re.escape(f"pmv#{pmv_id}_rating=")).search
+    for r in ordered_sources:
+        if marker_search(r["comments"] or "") is not None:
+            already_rated += 1
+        else:
+            unrated_sources.append(r)
+
+    if not unrated_sources:
+        user_sessions.pop(user_id, None)
+        return await reply_long(
+            "Все исходники в этой компиляции уже имеют оценки для этого PMV. ✅"
+        )
 
-        sess["autocreate_minutes"] = minutes
-        sess["state"] = "autocreate_ask_max_sources"
+    sess["state"] = "ratepmv_sources_scores"
+    sess["sources_rows"] = unrated_sources
 
+    header = [f"Часть видео уже оценена для этого PMV: пропущено {already_rated} шт."] if already_rated else []
+    lines = [
+        *header,
+        "Оценим оставшиеся видео в этой компиляции:",
+        *(f"{i}. {r['video_name']} (id={r['id']})" for i, r in enumerate(unrated_sources, 1)),
+        "",
+        "Пришлите оценки через пробел, например: `5 3 4 1 5`.\n"
+        "Количество оценок может быть меньше количества видео — "
+        "лишние видео останутся без оценки.",
+    ]
+    return await reply_long("\n".join(lines))
+
+
+async def _handle_text_ratepmv_sources_scores(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    parts = text.replace(",", " ").split()
+    ratings: List[int] = []
+    for p in parts:
+        if not p.isdigit():
+            continue
+        v = int(p)
+        if 1 <= v <= 5:
+            ratings.append(v)
+
+    if not ratings:
         return await reply_long(
-            f"Желаемая длительность PMV около {minutes} минут.\n"
-            "Теперь введите МАКСИМАЛЬНОЕ количество исходников на одно видео (например: 10)."
+            "Не получилось распознать ни одной оценки от 1 до 5. Попробуйте ещё раз."
         )
 
-    if state == "autocreate_ask_max_sources":
-        try:
-            max_sources = int(text)
-            if max_sources <= 0:
-                raise ValueError
-        except ValueError:
-            max_sources = 10
+    sources_rows: List[sqlite3.Row] = sess["sources_rows"]
+    pmv_id = int(sess["chosen_pmv"]["id"])
+    marker_prefix = f"pmv#{pmv_id}_rating="
+
+    for src_row, rate in zip(sources_rows, ratings):
+        db_append_source_comment(int(src_row["id"]), f"{marker_prefix}{rate}")
+
+    user_sessions.pop(user_id, None)
+    return await reply_long(
+        f"✅ Оценки сохранены.\n"
+        f"Видео оценено: {len(ratings)} из {len(sources_rows)} (в этой сессии)."
+    )
 
-        min_sources = max_sources
-        total_videos = sess.get("autocreate_total_videos", 1)
-        minutes = sess.get("autocreate_minutes", DEFAULT_TARGET_MINUTES)
 
-        user_sessions.pop(user_id, None)
+async def _handle_text_compmv_choose(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    if not text.isdigit():
+        return await reply_long("Нужно просто число — номер PMV.")
 
-        await reply_long(
-            f"Запускаю пакетную генерацию из {total_videos} PMV.\n"
-            f"Длительность каждого: ~{minutes} минут.\n"
-            f"Исходников на одно видео: минимум {min_sources}, максимум {max_sources}.\n"
-            "Попробую собрать максимально разнообразные (как по использованным источникам) ролики, "
-            "насколько это получится. Ну что, поехали..."
-        )
+    idx = int(text)
+    pmv_rows: List[sqlite3.Row] = sess["pmv_rows"]
+    if not (1 <= idx <= len(pmv_rows)):
+        return await reply_long("Неверный номер PMV.")
 
-        try:
-            report = autocreate_pmv_batch(
-                total_videos=total_videos,
-                minutes_each=minutes,
-                max_sources=max_sources,
-                min_sources=min_sources,
-            )
-        except Exception as e:
-            return await reply_long(f"Ой, произошла ошибка во время пакетной генерации PMV: {e}")
-
-        return await reply_long(report)
-
-    # =========================
-    # ДАЛЬШЕ — ВСЯ СТАРАЯ ЛОГИКА
-    # =========================
-
-    # ====== Шаг 1: выбор группы ======
-    if state == "choose_group":
-        if not text.isdigit():
-            return await reply_long("Нужно просто число — номер группы.")
-        idx = int(text)
-        groups: List[Tuple[Tuple[str, str], List[sqlite3.Row]]] = sess["groups"]
-        if not (1 <= idx <= len(groups)):
-            return await reply_long("Неверный номер группы.")
-        key, rows = groups[idx - 1]
-        codec, res = key
-
-        sess["state"] = "choose_files"
-        sess["current_group"] = key
-        sess["current_rows"] = rows
-
-        lines = [f"Выбрана группа: {codec} {res}. Файлы:"]
-        for i, r in enumerate(rows, 1):
-            lines.append(f"{i}. {Path(r['video_path']).name} (id={r['id']})")
-        lines.append("")
-        lines.append("Ответьте: 'all' чтобы взять все, либо номера файлов через пробел (например: 1 3 5).")
-        return await reply_long("\n".join(lines))
+    row = pmv_rows[idx - 1]
+    pmv_id = int(row["id"])
+    pmv_name = Path(row["video_path"]).name
 
-    # ====== Шаг 2: выбор файлов ======
-    if state == "choose_files":
-        rows: List[sqlite3.Row] = sess["current_rows"]
+    sess["state"] = "compmv_enter_comment"
+    sess["chosen_pmv_id"] = pmv_id
 
-        if text.lower() in {"all", "все"}:
-            selected_rows = rows
-        else:
-            parts = text.replace(",", " ").split()
-            idxs = []
-            for p in parts:
-                if not p.isdigit():
-                    continue
-                v = int(p)
-                if 1 <= v <= len(rows):
-                    idxs.append(v - 1)
-            if not idxs:
-                return await reply_long(
-                    "Не получилось распознать номера. Напишите 'all' или номера файлов через пробел."
-                )
-            selected_rows = [rows[i] for i in idxs]
+    return await reply_long(
+        f"Вы выбрали PMV: {pmv_name} (id={pmv_id}).\n"
+        "Теперь пришлите текст комментария."
+    )
 
-        if not selected_rows:
-            return await reply_long("Пустой выбор. Попробуйте ещё раз.")
 
-        sess["state"] = "choose_length"
-        sess["selected_rows"] = selected_rows
+async def _handle_text_compmv_enter_comment(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    pmv_id = sess.get("chosen_pmv_id")
+    comment_text = text.strip()
+    if not comment_text:
+        return await reply_long("Комментарий пустой. Пришлите непустой текст.")
 
-        names = ", ".join(Path(r["video_path"]).name for r in selected_rows)
-        msg = (
-            f"Выбрано файлов: {len(selected_rows)}.\n"
-            f"Имена: {names}\n\n"
-            "Теперь введите желаемую длину итогового PMV в МИНУТАХ (например: 15)."
-        )
-        return await reply_long(msg)
+    db_append_compilation_comment(pmv_id, comment_text)
 
-    # ====== Шаг 3: выбор длины ======
-    if state == "choose_length":
-        try:
-            minutes = int(text)
-            if minutes <= 0:
-                raise ValueError
-        except ValueError:
-            minutes = DEFAULT_TARGET_MINUTES
+    user_sessions.pop(user_id, None)
+    return await reply_long("✅ Комментарий к компиляции сохранён.")
 
-        sess["target_minutes"] = minutes
-        sess["state"] = "choose_big_parts"
 
-        return await reply_long(
-            f"Ок, целевая длина ~{minutes} минут.\n"
-            "Сколько БОЛЬШИХ частей на каждый файл (big_parts)? (по умолчанию 5)"
-        )
+async def _handle_text_comvid_choose(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    if not text.isdigit():
+        return await reply_long("Нужно просто число — номер видео.")
 
-    # ====== Шаг 4: выбор big_parts ======
-    if state == "choose_big_parts":
-        try:
-            big_parts = int(text)
-            if big_parts <= 0:
-                raise ValueError
-        except ValueError:
-            big_parts = 5
+    idx = int(text)
+    src_rows: List[sqlite3.Row] = sess["src_rows"]
+    if not (1 <= idx <= len(src_rows)):
+        return await reply_long("Неверный номер видео.")
 
-        sess["big_parts"] = big_parts
-        sess["state"] = "choose_small_parts"
+    row = src_rows[idx - 1]
+    src_id = int(row["id"])
+    src_name = row["video_name"]
 
-        return await reply_long(
-            f"big_parts = {big_parts}\n"
-            "Сколько МАЛЕНЬКИХ клипов в каждой большой части (small_per_big)? (по умолчанию 5)"
-        )
+    sess["state"] = "comvid_enter_comment"
+    sess["chosen_src_id"] = src_id
 
-    # ====== Шаг 5: выбор small_per_big и запуск нарезки ======
-    if state == "choose_small_parts":
-        try:
-            small_per_big = int(text)
-            if small_per_big <= 0:
-                raise ValueError
-        except ValueError:
-            small_per_big = 5
+    return await reply_long(
+        f"Вы выбрали видео: {src_name} (id={src_id}).\n"
+        "Теперь пришлите текст комментария."
+    )
 
-        minutes = sess["target_minutes"]
-        selected_rows: List[sqlite3.Row] = sess["selected_rows"]
-        big_parts = sess["big_parts"]
 
-        target_seconds = minutes * 60
+async def _handle_text_comvid_enter_comment(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    sess: Dict[str, Any],
+    user_id: int,
+    text: str,
+    reply_long: Callable[..., Awaitable[None]],
+) -> None:
+    src_id = sess.get("chosen_src_id")
+    comment_text = text.strip()
+    if not comment_text:
+        return await reply_long("Комментарий пустой. Пришлите непустой текст.")
 
-        await reply_long(
-            f"Ок, делаем PMV ~{minutes} минут.\n"
-            f"big_parts = {big_parts}, small_per_big = {small_per_big}, файлов: {len(selected_rows)}.\n"
-            "Начинаю нарезку, подождите..."
-        )
+    db_append_source_comment(src_id, comment_text)
 
-        paths = [Path(r["video_path"]) for r in selected_rows]
-        source_ids = [int(r["id"]) for r in selected_rows]
+    user_sessions.pop(user_id, None)
+    return await reply_long("✅ Комментарий к исходнику сохранён.")
+
+
+TEXT_STATE_HANDLERS: Dict[str, TextStateHandler] = {
+    "scanignore_wait_path": _handle_text_scanignore_wait_path,
+    "musicprep_wait_track": _handle_text_use_buttons,
+    "musicprep_wait_seconds": _handle_text_use_buttons,
+    "musicprep_wait_mode": _handle_text_use_buttons,
+    "musicprep_wait_sensitivity": _handle_text_use_buttons,
+    "newcompmusic_wait_project": _handle_text_use_buttons,
+    "newcompmusic_wait_group": _handle_text_use_buttons,
+    "newcompmusic_choose_duration": _handle_text_use_buttons,
+    "newcompmusic_choose_groupmode": _handle_text_use_buttons,
+    "newcompmusic_choose_color": _handle_text_use_buttons,
+    "newcompmusic_wait_sources": _handle_text_use_buttons,
+    "newcompmusic_wait_algo": _handle_text_use_buttons,
+    "musicprepcheck_wait_project": _handle_text_use_buttons,
+    "musicprep_ask_sensitivity": _handle_text_use_buttons,
+    "randompmv_choose_orientation": _handle_text_randompmv_choose_orientation,
+    "randompmv_wait_count": _handle_text_randompmv_wait_count,
+    "randompmv_wait_newcount": _handle_text_randompmv_wait_newcount,
+    "find_wait_term": _handle_text_find,
+    "find_wait_choice": _handle_text_find,
+    "newcompmusic_choose_project": _handle_text_newcompmusic_choose_project,
+    "newcompmusic_choose_orientation": _handle_text_newcompmusic_choose_orientation,
+    "newcompmusic_choose_group": _handle_text_newcompmusic_choose_group,
+    "newcompmusic_wait_folder": _handle_text_newcompmusic_wait_folder,
+    "newcompmusic_ask_sources": _handle_text_newcompmusic_ask_sources,
+    "rategrp_choose_rerate_color": _handle_text_rategrp_choose_rerate_color,
+    "rategrp_rate_source": _handle_text_rategrp_rate_source,
+    "musicprep_choose_file": _handle_text_musicprep_choose_file,
+    "musicprep_ask_name": _handle_text_musicprep_ask_name,
+    "musicprep_ask_segment": _handle_text_musicprep_ask_segment,
+    "musicprep_ask_mode": _handle_text_musicprep_ask_mode,
+    "autocreate_ask_count": _handle_text_autocreate_ask_count,
+    "autocreate_ask_length": _handle_text_autocreate_ask_length,
+    "autocreate_ask_max_sources": _handle_text_autocreate_ask_max_sources,
+    "choose_group": _handle_text_choose_group,
+    "choose_files": _handle_text_choose_files,
+    "choose_length": _handle_text_choose_length,
+    "choose_big_parts": _handle_text_choose_big_parts,
+    "choose_small_parts": _handle_text_choose_small_parts,
+    "ratepmv_choose_pmv": _handle_text_ratepmv_choose_pmv,
+    "ratepmv_confirm_sources": _handle_text_ratepmv_confirm_sources,
+    "ratepmv_sources_scores": _handle_text_ratepmv_sources_scores,
+    "compmv_choose": _handle_text_compmv_choose,
+    "compmv_enter_comment": _handle_text_compmv_enter_comment,
+    "comvid_choose": _handle_text_comvid_choose,
+    "comvid_enter_comment": _handle_text_comvid_enter_comment,
+}
 
-        user_sessions.pop(user_id, None)
 
-        manual_algo_key = random.choice(list(CLIP_SEQUENCE_ALGORITHMS.keys()))
-        manual_algo_key, manual_algo_meta = resolve_clip_algorithm(manual_algo_key)
+@authed
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    text = (update.message.text or "").strip()
 
-        move_comment = ""
-        try:
-            out_path = make_pmv_from_files(
-                paths,
-                target_seconds,
-                big_parts,
-                small_per_big,
-                clip_algo_key=manual_algo_key,
-            )
-            out_path, move_comment = move_output_to_network_storage(out_path)
-        except Exception as e:
-            return await reply_long(f"❌ Ошибка при создании PMV: {e}")
+    # Локальный хелпер, режет длинные сообщения на части
+    async def reply_long(msg: str, chunk_size: int = 4000):
+        if len(msg) <= chunk_size:
+            await update.message.reply_text(msg)
+            return
+        for i in range(0, len(msg), chunk_size):
+            await update.message.reply_text(msg[i:i + chunk_size])
 
-        pmv_tag = Path(out_path).name
-        db_insert_compilation(out_path, source_ids, comments=move_comment)
-        db_update_sources_pmv_list(source_ids, pmv_tag)
+    lowered_text = text.lower()
+    if lowered_text in {"musicprep", "/musicprep"}:
+        return await cmd_musicprep(update, context)
+    if lowered_text in {"newcompmusic", "/newcompmusic"}:
+        return await cmd_newcompmusic(update, context)
+    if lowered_text in {"scan", "/scan"}:
+        return await cmd_scan(update, context)
+    if lowered_text in {"rategrp", "/rategrp"}:
+        return await cmd_rategrp(update, context)
+    if lowered_text in {"reports", "/reports", "отчёты", "отчеты"}:
+        return await cmd_reports(update, context)
+    if lowered_text in {"flagpmv", "/flagpmv", "find", "/find", "найти"}:
+        return await cmd_find(update, context)
+    if lowered_text in {"createrandompmv", "/createrandompmv"}:
+        return await cmd_randompmv(update, context)
 
+    sess = user_sessions.get(user_id)
+    if not sess:
         return await reply_long(
-            f"✅ Готово!\nФайл: {out_path}\n"
-            f"Алгоритм клипов: {manual_algo_meta['title']} ({manual_algo_meta['short']}).\n"
-            f"PMV записан в базу, исходники помечены как использованные."
+            "Я вас не понял. Используйте /pmvnew для создания PMV или /scan для обновления исходников."
         )
 
+    handler = TEXT_STATE_HANDLERS.get(sess.get("state"))
+    if handler is not None:
+        return await handler(update, context, sess, user_id, text, reply_long)
+
+
+def _move_pmv_to_rating_dir(
+    old_path: str,
+    rating: int,
+    rating_dirs: Optional[Dict[int, str]] = None,
+) -> Optional[str]:
+    """
+    Переносит файл PMV в папку rating_<оценка>.
+    Возвращает новый путь или None, если файл уже лежит в нужной папке.
+    rating_dirs — кэш уже созданных и разрешённых папок rating_<оценка> для пакетного режима.
+    """
+    rating_dir = rating_dirs.get(rating) if rating_dirs is not None else None
+    if rating_dir is None:
+        rating_dir_path = NETWORK_OUTPUT_ROOT / f"rating_{rating}"
+        rating_dir_path.mkdir(parents=True, exist_ok=True)
+        rating_dir = os.path.realpath(rating_dir_path)
+        if rating_dirs is not None:
+            rating_dirs[rating] = rating_dir
+
+    if os.path.realpath(os.path.dirname(old_path)) == rating_dir:
+        return None
+    new_path = os.path.join(rating_dir, os.path.basename(old_path))
+    try:
+        os.rename(old_path, new_path)
+    except OSError:
+        # EXDEV (другой диск/шара) или уже существующий файл на Windows —
+        # пусть shutil.move сделает copy+unlink.
+        shutil.move(old_path, new_path)
+    return new_path
+
+
 def apply_pmv_rating(
     row_obj: Union[sqlite3.Row, Dict[str, Any]],
     rating: int,
@@ -6727,35 +7514,87 @@ def apply_pmv_rating(
     """
     row = dict(row_obj)
     pmv_id = int(row["id"])
-    old_path = Path(row["video_path"])
-    pmv_name = old_path.name
+    old_path = row["video_path"]
+    pmv_name = os.path.basename(old_path)
 
     db_append_compilation_comment(pmv_id, f"pmv_rating={rating}")
 
     try:
-        rating_dir = NETWORK_OUTPUT_ROOT / f"rating_{rating}"
-        rating_dir.mkdir(parents=True, exist_ok=True)
-
-        new_path = rating_dir / old_path.name
-        if old_path.resolve() != new_path.resolve():
-            shutil.move(str(old_path), str(new_path))
-
+        new_path = _move_pmv_to_rating_dir(old_path, rating)
+        if new_path is not None:
             conn = get_conn()
-            cur = conn.cursor()
-            cur.execute(
+            conn.execute(
                 "UPDATE compilations SET video_path = ? WHERE id = ?",
-                (str(new_path.resolve()), pmv_id),
+                (new_path, pmv_id),
             )
             conn.commit()
+            _note_db_write()
             conn.close()
-
-            row["video_path"] = str(new_path.resolve())
+            row["video_path"] = new_path
     except Exception as e:
         db_append_compilation_comment(pmv_id, f"move_error={e}")
 
     return row, pmv_name
 
 
+def _apply_pmv_ratings(
+    jobs: Iterable[Tuple[int, Union[sqlite3.Row, Dict[str, Any]], int]],
+    success_lines: List[str],
+    error_lines: List[str],
+) -> None:
+    """
+    Применяет оценки (номер, запись PMV, оценка); результаты дописывает в переданные списки.
+    Файл переносится вне транзакции, затем комментарий и новый путь этой PMV пишутся
+    короткой транзакцией. Ошибка БД (например, "database is locked", пока идёт /scan)
+    затрагивает только свою PMV и попадает в error_lines вместе с новым путём файла.
+    """
+    rating_dirs: Dict[int, str] = {}
+    conn: Optional[sqlite3.Connection] = None
+    try:
+        for idx_val, row_obj, rating_val in jobs:
+            try:
+                pmv_id = int(row_obj["id"])
+                old_path = row_obj["video_path"]
+            except Exception as exc:
+                error_lines.append(f"PMV №{idx_val}: ошибка {exc}.")
+                continue
+
+            comment_pieces = [f"pmv_rating={rating_val}"]
+            new_path: Optional[str] = None
+            try:
+                new_path = _move_pmv_to_rating_dir(old_path, rating_val, rating_dirs)
+            except Exception as e:
+                comment_pieces.append(f"move_error={e}")
+
+            try:
+                if conn is None:
+                    conn = get_conn()
+                for piece in comment_pieces:
+                    db_append_compilation_comment(pmv_id, piece, conn)
+                if new_path is not None:
+                    conn.execute(
+                        "UPDATE compilations SET video_path = ? WHERE id = ?",
+                        (new_path, pmv_id),
+                    )
+                conn.commit()
+                _note_db_write()
+            except Exception as exc:
+                if conn is not None:
+                    conn.rollback()
+                if new_path is not None:
+                    error_lines.append(
+                        f"PMV №{idx_val}: файл перенесён в {new_path}, но БД не обновлена: {exc}."
+                    )
+                else:
+                    error_lines.append(f"PMV №{idx_val}: оценка не записана в БД: {exc}.")
+                continue
+
+            success_lines.append(f"{os.path.basename(old_path)} → {rating_val}/5")
+    finally:
+        if conn is not None:
+            conn.close()
+
+
 def apply_pmv_rating_pairs(
     pmv_rows: List[sqlite3.Row],
     pairs: Iterable[Tuple[int, int]],
@@ -6768,22 +7607,38 @@ def apply_pmv_rating_pairs(
     error_lines: List[str] = []
     total = len(pmv_rows)
 
-    for idx_val, rating_val in pairs:
-        if rating_val < 1 or rating_val > 5:
-            error_lines.append(f"PMV №{idx_val}: оценка должна быть 1-5.")
-            continue
-        if not (1 <= idx_val <= total):
-            error_lines.append(f"PMV №{idx_val}: такого номера нет (всего {total}).")
-            continue
+    def valid_jobs() -> Iterable[Tuple[int, sqlite3.Row, int]]:
+        for idx_val, rating_val in pairs:
+            if rating_val < 1 or rating_val > 5:
+                error_lines.append(f"PMV №{idx_val}: оценка должна быть 1-5.")
+                continue
+            if not (1 <= idx_val <= total):
+                error_lines.append(f"PMV №{idx_val}: такого номера нет (всего {total}).")
+                continue
+            yield idx_val, pmv_rows[idx_val - 1], rating_val
 
-        try:
-            _, pmv_name = apply_pmv_rating(pmv_rows[idx_val - 1], rating_val)
-        except Exception as exc:
-            error_lines.append(f"PMV №{idx_val}: ошибка {exc}.")
-            continue
+    _apply_pmv_ratings(valid_jobs(), success_lines, error_lines)
+    return success_lines, error_lines
 
-        success_lines.append(f"{pmv_name} → {rating_val}/5")
 
+def apply_pmv_rating_uniform(
+    pmv_rows: List[sqlite3.Row],
+    rating: int,
+) -> Tuple[List[str], List[str]]:
+    """
+    Ставит одну и ту же оценку всем PMV из списка за один проход.
+    Возвращает два списка строк: успешно обработанные и ошибки.
+    """
+    success_lines: List[str] = []
+    error_lines: List[str] = []
+    if rating < 1 or rating > 5:
+        error_lines.append("Оценка должна быть 1-5.")
+        return success_lines, error_lines
+    _apply_pmv_ratings(
+        ((idx, row, rating) for idx, row in enumerate(pmv_rows, 1)),
+        success_lines,
+        error_lines,
+    )
     return success_lines, error_lines
 
 
@@ -6817,613 +7672,509 @@ async def process_ratepmv_choice(
     )
     return True
 
-# ====== RATEPMV: выбор PMV и общей оценки ======
-    if state == "ratepmv_choose_pmv":
-        tokens = text.replace(",", " ").split()
-        digits = [t for t in tokens if t.isdigit()]
-        if len(digits) < 2:
-            return await reply_long(
-                "Укажи хотя бы одну пару `<номер> <оценка 1-5>` (например: `2 5` или `1 5 2 4`)."
-            )
-
-        numbers = [int(t) for t in digits]
-        if len(numbers) == 2:
-            idx, rating = numbers
-            return await process_ratepmv_choice(sess, idx, rating, reply_long)
-
-        if len(numbers) % 2 != 0:
-            return await reply_long(
-                "В пакетном режиме нужно чётное количество чисел — номер PMV и оценка 1-5."
-            )
-
-        pmv_rows: List[sqlite3.Row] = sess.get("pmv_rows") or []
-        if not pmv_rows:
-            return await reply_long("Не удалось найти список PMV для оценки.")
-
-        await reply_long("Принял пакет, выставляю оценки...")
-
-        rating_pairs = [
-            (numbers[i], numbers[i + 1]) for i in range(0, len(numbers), 2)
-        ]
-        success_lines, error_lines = apply_pmv_rating_pairs(pmv_rows, rating_pairs)
-
-        if not success_lines:
-            msg = "Не удалось обработать ни одну пару. Проверь номера и оценки."
-            if error_lines:
-                msg += "\n" + "\n".join(error_lines)
-            return await reply_long(msg)
-
-        user_sessions.pop(user_id, None)
-
-        lines = [
-            f"✅ Пакетная оценка завершена, обновлено PMV: {len(success_lines)}.",
-            "Успешно отмечены:",
-        ]
-        lines.extend(f"- {entry}" for entry in success_lines)
-        if error_lines:
-            lines.append("")
-            lines.append("⚠️ Пропущены:")
-            lines.extend(f"- {entry}" for entry in error_lines)
-        lines.append("")
-        lines.append("Оценки источников в пакетном режиме не ставятся — отправь конкретный PMV отдельно, если нужно.")
-        return await reply_long("\n".join(lines))
-
-    # ====== RATEPMV: спросить, оценивать ли исходники ======
-    if state == "ratepmv_confirm_sources":
-        answer = text.lower()
-        if answer not in {"да", "д", "yes", "y", "нет", "не", "no", "n"}:
-            return await reply_long("Ответьте 'да' или 'нет'.")
-
-        if answer in {"нет", "не", "no", "n"}:
-            user_sessions.pop(user_id, None)
-            return await reply_long("✅ Оценка PMV сохранена.")
-
-        chosen_pmv: sqlite3.Row | dict = sess["chosen_pmv"]
-        pmv_id = int(chosen_pmv["id"])
-        source_ids_str = chosen_pmv["source_ids"] or ""
-        src_ids = [int(x) for x in source_ids_str.split(",") if x.strip().isdigit()]
-
-        if not src_ids:
-            user_sessions.pop(user_id, None)
-            return await reply_long(
-                "В этой компиляции не нашлось исходников (source_ids пустые)."
-            )
-
-        conn = get_conn()
-        cur = conn.cursor()
-        q_marks = ",".join("?" for _ in src_ids)
-        cur.execute(f"SELECT * FROM sources WHERE id IN ({q_marks})", src_ids)
-        src_rows = cur.fetchall()
-        conn.close()
-
-        if not src_rows:
-            user_sessions.pop(user_id, None)
-            return await reply_long(
-                "Не удалось найти исходники в базе. Оценка PMV уже сохранена."
-            )
-
-        src_map = {r["id"]: r for r in src_rows}
-        ordered_sources = [src_map[sid] for sid in src_ids if sid in src_map]
-
-        # 🔥 НОВОЕ: выкидываем те исходники, которые уже оценены для ЭТОГО PMV
-        unrated_sources = []
-        already_rated = 0
-        marker = f"pmv#{pmv_id}_rating="
-        for r in ordered_sources:
-            comments = (r["comments"] or "")
-            if marker in comments:
-                already_rated += 1
-            else:
-                unrated_sources.append(r)
-
-        if not unrated_sources:
-            user_sessions.pop(user_id, None)
-            return await reply_long(
-                "Все исходники в этой компиляции уже имеют оценки для этого PMV. ✅"
-            )
-
-        sess["state"] = "ratepmv_sources_scores"
-        sess["sources_rows"] = unrated_sources
-
-        lines = []
-        if already_rated:
-            lines.append(f"Часть видео уже оценена для этого PMV: пропущено {already_rated} шт.")
-        lines.append("Оценим оставшиеся видео в этой компиляции:")
-        for i, r in enumerate(unrated_sources, 1):
-            lines.append(f"{i}. {r['video_name']} (id={r['id']})")
-        lines.append("")
-        lines.append(
-            "Пришлите оценки через пробел, например: `5 3 4 1 5`.\n"
-            "Количество оценок может быть меньше количества видео — "
-            "лишние видео останутся без оценки."
-        )
-        return await reply_long("\n".join(lines))
-
-    # ====== RATEPMV: приём оценок по каждому исходнику ======
-    if state == "ratepmv_sources_scores":
-        parts = text.replace(",", " ").split()
-        ratings: List[int] = []
-        for p in parts:
-            if not p.isdigit():
-                continue
-            v = int(p)
-            if 1 <= v <= 5:
-                ratings.append(v)
-
-        if not ratings:
-            return await reply_long(
-                "Не получилось распознать ни одной оценки от 1 до 5. Попробуйте ещё раз."
-            )
-
-        sources_rows: List[sqlite3.Row] = sess["sources_rows"]
-        chosen_pmv: sqlite3.Row | dict = sess["chosen_pmv"]
-        pmv_id = int(chosen_pmv["id"])
-
-        for src_row, rate in zip(sources_rows, ratings):
-            sid = int(src_row["id"])
-            db_append_source_comment(sid, f"pmv#{pmv_id}_rating={rate}")
-
-        user_sessions.pop(user_id, None)
-        return await reply_long(
-            f"✅ Оценки сохранены.\n"
-            f"Видео оценено: {len(ratings)} из {len(sources_rows)} (в этой сессии)."
-        )
-
-    # ====== COMPMV: выбор PMV ======
-    if state == "compmv_choose":
-        if not text.isdigit():
-            return await reply_long("Нужно просто число — номер PMV.")
-
-        idx = int(text)
-        pmv_rows: List[sqlite3.Row] = sess["pmv_rows"]
-        if not (1 <= idx <= len(pmv_rows)):
-            return await reply_long("Неверный номер PMV.")
-
-        row = pmv_rows[idx - 1]
-        pmv_id = int(row["id"])
-        pmv_name = Path(row["video_path"]).name
-        
-
-        sess["state"] = "compmv_enter_comment"
-        sess["chosen_pmv_id"] = pmv_id
-
-        return await reply_long(
-            f"Вы выбрали PMV: {pmv_name} (id={pmv_id}).\n"
-            "Теперь пришлите текст комментария."
-        )
-
-    # ====== COMPMV: ввод комментария ======
-    if state == "compmv_enter_comment":
-        pmv_id = sess.get("chosen_pmv_id")
-        comment_text = text.strip()
-        if not comment_text:
-            return await reply_long("Комментарий пустой. Пришлите непустой текст.")
-
-        db_append_compilation_comment(pmv_id, comment_text)
-
-        user_sessions.pop(user_id, None)
-        return await reply_long("✅ Комментарий к компиляции сохранён.")
-
-    # ====== COMVID: выбор исходника ======
-    if state == "comvid_choose":
-        if not text.isdigit():
-            return await reply_long("Нужно просто число — номер видео.")
-
-        idx = int(text)
-        src_rows: List[sqlite3.Row] = sess["src_rows"]
-        if not (1 <= idx <= len(src_rows)):
-            return await reply_long("Неверный номер видео.")
-
-        row = src_rows[idx - 1]
-        src_id = int(row["id"])
-        src_name = row["video_name"]
-
-        sess["state"] = "comvid_enter_comment"
-        sess["chosen_src_id"] = src_id
-
-        return await reply_long(
-            f"Вы выбрали видео: {src_name} (id={src_id}).\n"
-            "Теперь пришлите текст комментария."
-        )
-
-    # ====== COMVID: ввод комментария ======
-    if state == "comvid_enter_comment":
-        src_id = sess.get("chosen_src_id")
-        comment_text = text.strip()
-        if not comment_text:
-            return await reply_long("Комментарий пустой. Пришлите непустой текст.")
 
-        db_append_source_comment(src_id, comment_text)
-
-        user_sessions.pop(user_id, None)
-        return await reply_long("✅ Комментарий к исходнику сохранён.")
-
-    # Если что-то пошло не так
-    await reply_long("Что-то пошло не так с состоянием диалога. Запустите /pmvnew или /autocreate заново.")
-    user_sessions.pop(user_id, None)
-
-
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    if not check_access(update):
-        await query.answer("Нет доступа", show_alert=True)
-        return await unauthorized(update)
+# Обработчики inline-кнопок: префикс callback_data -> корутина.
+CallbackHandler = Callable[
+    [Update, ContextTypes.DEFAULT_TYPE, CallbackQuery, Dict[str, Any], int, str],
+    Awaitable[None],
+]
 
-    user_id = query.from_user.id if query.from_user else 0
-    data = (query.data or "").strip()
-    sess = user_sessions.get(user_id)
 
-    if not sess:
-        await query.answer("Сессия устарела", show_alert=True)
+async def _handle_callback_report_group(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "reports_wait_choice":
+        await query.answer("Сначала откройте меню отчётов.", show_alert=True)
         return
+    color_key = payload
+    report_env = ReportEnvironment(
+        db_color_group_stats=db_color_group_stats,
+        color_choices=RATEGRP_COLOR_CHOICES,
+    )
+    text = build_color_group_report(report_env, color_key)
+    await asyncio.gather(
+        query.answer("Готово"),
+        query.message.reply_text(text),
+    )
+    return
 
-    if data.startswith("report_group:"):
-        if sess.get("state") != "reports_wait_choice":
-            await query.answer("Сначала откройте меню отчётов.", show_alert=True)
-            return
-        color_key = data.split(":", 1)[1]
-        report_env = ReportEnvironment(
-            db_get_groups=db_get_all_sources_grouped,
-            color_choices=RATEGRP_COLOR_CHOICES,
-        )
-        text = build_color_group_report(report_env, color_key)
-        await query.answer("Готово")
-        await query.message.reply_text(text)
-        return
 
-    if data.startswith("randompmv_orient:"):
-        if not sess or sess.get("state") != "randompmv_choose_orientation":
-            return await query.answer("Сначала запустите CreateRandomPMV", show_alert=True)
-        choice = data.split(":", 1)[1].upper()
-        if choice == "ALL":
-            orientation_choice = None
-            label = "ВСЕ"
-        elif choice in NEWCOMPMUSIC_ORIENTATION_CHOICES:
-            orientation_choice = choice
-            label = choice
-        else:
-            return await query.answer("Не понял ориентацию", show_alert=True)
-        sess["randompmv_orientation_preference"] = orientation_choice
-        sess["state"] = "randompmv_wait_count"
-        user_sessions[user_id] = sess
-        await query.answer(f"Ориентация: {label}")
-        await query.message.reply_text(
+async def _handle_callback_randompmv_orient(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if not sess or sess.get("state") != "randompmv_choose_orientation":
+        return await query.answer("Сначала запустите CreateRandomPMV", show_alert=True)
+    choice = payload.upper()
+    if choice == "ALL":
+        orientation_choice = None
+        label = "ВСЕ"
+    elif choice in NEWCOMPMUSIC_ORIENTATION_CHOICES:
+        orientation_choice = choice
+        label = choice
+    else:
+        return await query.answer("Не понял ориентацию", show_alert=True)
+    sess["randompmv_orientation_preference"] = orientation_choice
+    sess["state"] = "randompmv_wait_count"
+    user_sessions[user_id] = sess
+    await asyncio.gather(
+        query.answer(f"Ориентация: {label}"),
+        query.message.reply_text(
             f"Ориентация выбрана: {label}. Теперь выберите количество генераций.",
             reply_markup=build_randompmv_count_keyboard(),
-        )
-        return
+        ),
+    )
+    return
 
-    if data.startswith("randompmv_count:"):
-        if not sess or sess.get("state") != "randompmv_wait_count":
-            return await query.answer("Нет активной сессии CreateRandomPMV", show_alert=True)
-        try:
-            total_runs = int(data.split(":", 1)[1])
-        except ValueError:
-            return await query.answer("Не понял выбранное значение", show_alert=True)
-        total_runs = max(RANDOMPMV_MIN_BATCH, min(total_runs, RANDOMPMV_MAX_BATCH))
-        sess["randompmv_total_runs"] = total_runs
-        sess["state"] = "randompmv_wait_newcount"
-        user_sessions[user_id] = sess
-        await query.answer("Количество запусков сохранено")
-        await query.message.reply_text(
-            "Сколько новых исходников обязательно включать в каждый PMV? (0 = любые)",
-            reply_markup=build_randompmv_newcount_keyboard(),
-        )
-        return
 
-    if data.startswith("randompmv_newcount:"):
-        if not sess or sess.get("state") != "randompmv_wait_newcount":
-            return await query.answer("Сначала выберите количество PMV", show_alert=True)
-        try:
-            min_new = int(data.split(":", 1)[1])
-        except ValueError:
-            return await query.answer("Не понял выбранное значение", show_alert=True)
-        if min_new < 0:
-            return await query.answer("Число не может быть отрицательным", show_alert=True)
-        total_runs = int(sess.get("randompmv_total_runs") or 0)
-        if total_runs <= 0:
-            user_sessions.pop(user_id, None)
-            return await query.answer("Сессия CreateRandomPMV сброшена", show_alert=True)
+async def _handle_callback_randompmv_count(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if not sess or sess.get("state") != "randompmv_wait_count":
+        return await query.answer("Нет активной сессии CreateRandomPMV", show_alert=True)
+    try:
+        total_runs = int(payload)
+    except ValueError:
+        return await query.answer("Не понял выбранное значение", show_alert=True)
+    total_runs = max(RANDOMPMV_MIN_BATCH, min(total_runs, RANDOMPMV_MAX_BATCH))
+    sess["randompmv_total_runs"] = total_runs
+    sess["state"] = "randompmv_wait_newcount"
+    user_sessions[user_id] = sess
+    await asyncio.gather(
+        query.answer("Количество запусков сохранено"),
+        query.message.reply_text(
+            "Сколько новых исходников обязательно включать в каждый PMV? (0 = любые)",
+            reply_markup=build_randompmv_newcount_keyboard(),
+        ),
+    )
+    return
 
-        async def send_from_query(message: str) -> None:
-            await query.message.reply_text(message)
 
+async def _handle_callback_randompmv_newcount(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if not sess or sess.get("state") != "randompmv_wait_newcount":
+        return await query.answer("Сначала выберите количество PMV", show_alert=True)
+    try:
+        min_new = int(payload)
+    except ValueError:
+        return await query.answer("Не понял выбранное значение", show_alert=True)
+    if min_new < 0:
+        return await query.answer("Число не может быть отрицательным", show_alert=True)
+    total_runs = int(sess.get("randompmv_total_runs") or 0)
+    if total_runs <= 0:
         user_sessions.pop(user_id, None)
-        await query.answer(f"Запускаю {total_runs} Random PMV")
-        await query.message.reply_text(
-            f"Запускаю {total_runs} Random PMV (новых ≥ {min_new})..."
-        )
-        orientation_pref = sess.get("randompmv_orientation_preference")
-        return await run_randompmv_batch(send_from_query, user_id, total_runs, min_new, orientation_pref)
+        return await query.answer("Сессия CreateRandomPMV сброшена", show_alert=True)
 
-    if data.startswith("find_pick:"):
-        if not sess.get("find_mode"):
-            return await query.answer("Сначала запустите команду «Найти».", show_alert=True)
-        try:
-            idx = int(data.split(":", 1)[1])
-        except ValueError:
-            return await query.answer("Не понял номер", show_alert=True)
-        matches: List[Dict[str, Any]] = sess.get("find_matches") or []
-        if not (0 <= idx < len(matches)):
-            return await query.answer("Нет такого PMV в списке", show_alert=True)
+    async def send_from_query(message: str) -> None:
+        await query.message.reply_text(message)
+
+    user_sessions.pop(user_id, None)
+    await asyncio.gather(
+        query.answer(f"Запускаю {total_runs} Random PMV"),
+        query.message.reply_text(
+            f"Запускаю {total_runs} Random PMV (новых ≥ {min_new})..."
+        ),
+    )
+    orientation_pref = sess.get("randompmv_orientation_preference")
+    return await run_randompmv_batch(send_from_query, user_id, total_runs, min_new, orientation_pref)
 
-        async def send_find(message: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-            await query.message.reply_text(message, reply_markup=markup)
 
-        await query.answer("Открываю PMV")
-        await query.message.edit_reply_markup(None)
-        entry = matches[idx]
-        if entry.get("type") == "pmv":
-            return await _start_find_pmv_queue(sess, entry, send_find)
-        if entry.get("type") == "source":
-            rows = db_get_sources_by_ids([entry["id"]])
-            if not rows:
-                return await query.message.reply_text("Не удалось найти исходник в базе.")
-            return await _start_find_single_source(sess, rows[0], send_find)
-        return await query.message.reply_text("Неизвестный тип результата.")
-
-    if data == "find_retry":
-        if not sess.get("find_mode"):
-            return await query.answer("Сначала запустите «Найти».", show_alert=True)
-        sess["state"] = "find_wait_term"
-        sess["find_matches"] = []
-        await query.answer("Введите другой фрагмент имени")
-        return await query.message.reply_text(
+async def _handle_callback_find_pick(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if not sess.get("find_mode"):
+        return await query.answer("Сначала запустите команду «Найти».", show_alert=True)
+    try:
+        idx = int(payload)
+    except ValueError:
+        return await query.answer("Не понял номер", show_alert=True)
+    matches: List[Dict[str, Any]] = sess.get("find_matches") or []
+    if not (0 <= idx < len(matches)):
+        return await query.answer("Нет такого PMV в списке", show_alert=True)
+
+    async def send_find(message: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        await query.message.reply_text(message, reply_markup=markup)
+
+    await query.answer("Открываю PMV")
+    await query.message.edit_reply_markup(None)
+    entry = matches[idx]
+    if entry.get("type") == "pmv":
+        return await _start_find_pmv_queue(sess, entry, send_find)
+    if entry.get("type") == "source":
+        row = (sess.get("find_sources_by_id") or {}).get(entry["id"])
+        if row is None:
+            return await query.message.reply_text("Не удалось найти исходник в базе.")
+        return await _start_find_single_source(sess, row, send_find)
+    return await query.message.reply_text("Неизвестный тип результата.")
+
+
+async def _handle_callback_find_retry(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if not sess.get("find_mode"):
+        return await query.answer("Сначала запустите «Найти».", show_alert=True)
+    sess["state"] = "find_wait_term"
+    sess["find_matches"] = []
+    await asyncio.gather(
+        query.answer("Введите другой фрагмент имени"),
+        query.message.reply_text(
             "Пришлите новый фрагмент имени PMV. Например, дату 20251207 или время 0734."
-        )
+        ),
+    )
 
-    if data.startswith("ratepmv_select:"):
-        if sess.get("state") != "ratepmv_choose_pmv":
-            return await query.answer("Сейчас не жду выбор PMV", show_alert=True)
-        try:
-            idx = int(data.split(":", 1)[1])
-        except ValueError:
-            return await query.answer("Не понял номер", show_alert=True)
-        pmv_rows: List[sqlite3.Row] = sess.get("pmv_rows") or []
-        if not (1 <= idx <= len(pmv_rows)):
-            return await query.answer("Некорректный номер PMV", show_alert=True)
-        row = pmv_rows[idx - 1]
-        name = Path(row["video_path"]).name
-        sess["state"] = "ratepmv_wait_rating"
-        sess["ratepmv_selected_idx"] = idx
-        await query.answer("PMV выбрано")
-        await query.message.reply_text(
+
+async def _handle_callback_ratepmv_select(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "ratepmv_choose_pmv":
+        return await query.answer("Сейчас не жду выбор PMV", show_alert=True)
+    try:
+        idx = int(payload)
+    except ValueError:
+        return await query.answer("Не понял номер", show_alert=True)
+    pmv_rows: List[sqlite3.Row] = sess.get("pmv_rows") or []
+    if not (1 <= idx <= len(pmv_rows)):
+        return await query.answer("Некорректный номер PMV", show_alert=True)
+    row = pmv_rows[idx - 1]
+    name = Path(row["video_path"]).name
+    sess["state"] = "ratepmv_wait_rating"
+    sess["ratepmv_selected_idx"] = idx
+    await asyncio.gather(
+        query.answer("PMV выбрано"),
+        query.message.reply_text(
             f"PMV №{idx}: {name}\nВыбери оценку 1-5:",
             reply_markup=build_ratepmv_score_keyboard(),
-        )
-        return
+        ),
+    )
+    return
 
-    if data.startswith("ratepmv_rate:"):
-        if sess.get("state") != "ratepmv_wait_rating":
-            return await query.answer("Сейчас не жду оценку", show_alert=True)
-        try:
-            rating = int(data.split(":", 1)[1])
-        except ValueError:
-            return await query.answer("Не понял оценку", show_alert=True)
-        idx = int(sess.get("ratepmv_selected_idx") or 0)
-        if idx <= 0:
-            return await query.answer("Нет выбранного PMV", show_alert=True)
 
-        async def send_from_query(message: str) -> None:
-            await query.message.reply_text(message)
+async def _handle_callback_ratepmv_rate(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "ratepmv_wait_rating":
+        return await query.answer("Сейчас не жду оценку", show_alert=True)
+    try:
+        rating = int(payload)
+    except ValueError:
+        return await query.answer("Не понял оценку", show_alert=True)
+    idx = int(sess.get("ratepmv_selected_idx") or 0)
+    if idx <= 0:
+        return await query.answer("Нет выбранного PMV", show_alert=True)
 
-        await query.answer(f"Оценка: {rating}")
-        await process_ratepmv_choice(sess, idx, rating, send_from_query)
-        sess.pop("ratepmv_selected_idx", None)
-        return
+    async def send_from_query(message: str) -> None:
+        await query.message.reply_text(message)
 
-    if data.startswith("ratepmv_bulk:"):
-        if sess.get("state") not in {"ratepmv_choose_pmv", "ratepmv_wait_rating"}:
-            return await query.answer("Пакетная оценка сейчас недоступна", show_alert=True)
-        try:
-            rating = int(data.split(":", 1)[1])
-        except ValueError:
-            return await query.answer("Не понял оценку", show_alert=True)
-        if rating < 1 or rating > 5:
-            return await query.answer("Оценка должна быть 1-5", show_alert=True)
+    await query.answer(f"Оценка: {rating}")
+    await process_ratepmv_choice(sess, idx, rating, send_from_query)
+    sess.pop("ratepmv_selected_idx", None)
+    return
 
-        pmv_rows: List[sqlite3.Row] = sess.get("pmv_rows") or []
-        if not pmv_rows:
-            return await query.answer("Нет списка PMV", show_alert=True)
 
-        await query.answer("Применяю пакетную оценку…")
+async def _handle_callback_ratepmv_bulk(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") not in {"ratepmv_choose_pmv", "ratepmv_wait_rating"}:
+        return await query.answer("Пакетная оценка сейчас недоступна", show_alert=True)
+    try:
+        rating = int(payload)
+    except ValueError:
+        return await query.answer("Не понял оценку", show_alert=True)
+    if rating < 1 or rating > 5:
+        return await query.answer("Оценка должна быть 1-5", show_alert=True)
 
-        pairs = [(idx + 1, rating) for idx in range(len(pmv_rows))]
-        success_lines, error_lines = apply_pmv_rating_pairs(pmv_rows, pairs)
+    pmv_rows: List[sqlite3.Row] = sess.get("pmv_rows") or []
+    if not pmv_rows:
+        return await query.answer("Нет списка PMV", show_alert=True)
 
-        if not success_lines:
-            msg = "Не удалось применить пакетную оценку."
-            if error_lines:
-                msg += "\n" + "\n".join(error_lines)
-            return await query.message.reply_text(msg)
+    await query.answer("Применяю пакетную оценку…")
 
-        user_sessions.pop(user_id, None)
+    success_lines, error_lines = apply_pmv_rating_uniform(pmv_rows, rating)
 
-        lines = [
-            f"✅ Все показанные PMV получили оценку {rating}/5: {len(success_lines)} шт.",
-            "Успешно отмечены:",
-        ]
-        lines.extend(f"- {entry}" for entry in success_lines)
+    if not success_lines:
+        msg = "Не удалось применить пакетную оценку."
         if error_lines:
-            lines.append("")
-            lines.append("⚠️ Пропущены:")
-            lines.extend(f"- {entry}" for entry in error_lines)
+            msg += "\n" + "\n".join(error_lines)
+        return await query.message.reply_text(msg)
+
+    user_sessions.pop(user_id, None)
+
+    lines = [
+        f"✅ Все показанные PMV получили оценку {rating}/5: {len(success_lines)} шт.",
+        "Успешно отмечены:",
+    ]
+    lines.extend(f"- {entry}" for entry in success_lines)
+    if error_lines:
         lines.append("")
-        lines.append("Оценки источников не ставились. Если нужно — выбери конкретный PMV отдельно.")
-        await query.message.reply_text("\n".join(lines))
-        return
+        lines.append("⚠️ Пропущены:")
+        lines.extend(f"- {entry}" for entry in error_lines)
+    lines.append("")
+    lines.append("Оценки источников не ставились. Если нужно — выбери конкретный PMV отдельно.")
+    await query.message.reply_text("\n".join(lines))
+    return
 
-    if data == "rategrp_from_pmv":
-        if sess.get("state") != "rategrp_choose_orientation":
-            return await query.answer("Эта опция доступна только в начале команды rategrp.", show_alert=True)
 
-        async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-            await query.message.reply_text(msg, reply_markup=markup)
+async def _handle_callback_rategrp_from_pmv(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "rategrp_choose_orientation":
+        return await query.answer("Эта опция доступна только в начале команды rategrp.", show_alert=True)
 
-        success = await _start_rategrp_from_pmv(sess, send_rategrp)
-        if success:
-            await query.answer("Показываю исходники из PMV")
-        else:
-            await query.answer("Нет подходящих исходников", show_alert=True)
-        return
+    async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        await query.message.reply_text(msg, reply_markup=markup)
 
-    if data.startswith("musicprep_show:"):
-        mode = data.split(":", 1)[1]
-        show_used = mode == "used"
-        sess["state"] = "musicprep_wait_track"
-        text, keyboard = build_musicprep_track_keyboard(sess, show_used=show_used)
-        try:
-            await query.edit_message_text(text, reply_markup=keyboard)
-        except Exception:
-            await query.message.reply_text(text, reply_markup=keyboard)
-        return await query.answer()
+    success = await _start_rategrp_from_pmv(sess, send_rategrp)
+    if success:
+        await query.answer("Показываю исходники из PMV")
+    else:
+        await query.answer("Нет подходящих исходников", show_alert=True)
+    return
 
-    if data.startswith("musicprep_track:"):
-        tracks = sess.get("music_tracks") or {}
-        token = data.split(":", 1)[1]
-        info = tracks.get(token)
-        if not info:
-            return await query.answer("Трек не найден", show_alert=True)
-        path = Path(info["path"])
-        _, title = extract_track_title_components(path)
-        prefix = slugify_token(title or path.stem)
-        sess["musicprep_file"] = str(path)
-        sess["musicprep_project_prefix"] = prefix
-        sess.pop("musicprep_project_partial", None)
-        sess["state"] = "musicprep_wait_seconds"
-        await query.answer("Трек выбран")
-        await query.message.reply_text(
-            f"Трек выбран: {path.name}\n"
+
+async def _handle_callback_musicprep_show(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    mode = payload
+    show_used = mode == "used"
+    sess["state"] = "musicprep_wait_track"
+    text, keyboard = build_musicprep_track_keyboard(sess, show_used=show_used)
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except Exception:
+        await query.message.reply_text(text, reply_markup=keyboard)
+    return await query.answer()
+
+
+async def _handle_callback_musicprep_track(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    tracks = sess.get("music_tracks") or {}
+    token = payload
+    info = tracks.get(token)
+    if not info:
+        return await query.answer("Трек не найден", show_alert=True)
+    prefix = slugify_token(info["title"] or info["stem"])
+    sess["musicprep_file"] = info["path"]
+    sess["musicprep_project_prefix"] = prefix
+    sess.pop("musicprep_project_partial", None)
+    sess["state"] = "musicprep_wait_seconds"
+    await asyncio.gather(
+        query.answer("Трек выбран"),
+        query.message.reply_text(
+            f"Трек выбран: {info['name']}\n"
             f"Префикс проекта: {prefix}\n"
             "Выберите минимальную длительность сегмента:",
             reply_markup=build_musicprep_seconds_keyboard(),
-        )
-        return
+        ),
+    )
+    return
 
-    if data.startswith("musicprep_seconds:"):
-        if sess.get("state") not in {"musicprep_wait_seconds", "musicprep_wait_mode"}:
-            return await query.answer("Сначала выберите трек", show_alert=True)
-        try:
-            seconds = int(data.split(":", 1)[1])
-        except ValueError:
-            return await query.answer("Неверное значение", show_alert=True)
-        prefix = sess.get("musicprep_project_prefix") or "project"
-        partial = f"{prefix}_{seconds}"
-        sess["musicprep_segment"] = float(seconds)
-        sess["musicprep_project_partial"] = partial
-        sess["state"] = "musicprep_wait_mode"
-        await query.answer(f"{seconds} сек.")
-        if seconds == 0:
-            length_line = "Длина сегмента: авто (минимум не ограничен)."
-        else:
-            length_line = f"Длина сегмента: {seconds} сек."
+
+async def _handle_callback_musicprep_seconds(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") not in {"musicprep_wait_seconds", "musicprep_wait_mode"}:
+        return await query.answer("Сначала выберите трек", show_alert=True)
+    try:
+        seconds = int(payload)
+    except ValueError:
+        return await query.answer("Неверное значение", show_alert=True)
+    prefix = sess.get("musicprep_project_prefix") or "project"
+    partial = f"{prefix}_{seconds}"
+    sess["musicprep_segment"] = float(seconds)
+    sess["musicprep_project_partial"] = partial
+    sess["state"] = "musicprep_wait_mode"
+    await query.answer(f"{seconds} сек.")
+    if seconds == 0:
+        length_line = "Длина сегмента: авто (минимум не ограничен)."
+    else:
+        length_line = f"Длина сегмента: {seconds} сек."
+    await query.message.reply_text(
+        f"{length_line}\n"
+        f"Имя проекта станет: {partial}_<algo>\n"
+        "Выберите алгоритм сегментации:",
+        reply_markup=build_musicprep_mode_keyboard(),
+    )
+    return
+
+
+async def _handle_callback_musicprep_mode(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "musicprep_wait_mode":
+        return await query.answer("Сначала выберите сегменты", show_alert=True)
+
+    mode = payload
+    if mode not in {"beat", "onset", "uniform"}:
+        return await query.answer("Неизвестный режим", show_alert=True)
+
+    sess["musicprep_selected_mode"] = mode
+    options = get_musicprep_sensitivity_options(mode)
+    if options:
+        sess["musicprep_sensitivity_options"] = options
+        sess["state"] = "musicprep_wait_sensitivity"
+        await query.answer("Алгоритм выбран")
         await query.message.reply_text(
-            f"{length_line}\n"
-            f"Имя проекта станет: {partial}_<algo>\n"
-            "Выберите алгоритм сегментации:",
-            reply_markup=build_musicprep_mode_keyboard(),
+            "Выберите чувствительность анализа:",
+            reply_markup=build_musicprep_sensitivity_keyboard(mode),
         )
         return
 
-    if data.startswith("musicprep_mode:"):
-        if sess.get("state") != "musicprep_wait_mode":
-            return await query.answer("Сначала выберите сегменты", show_alert=True)
-
-        mode = data.split(":", 1)[1]
-        if mode not in {"beat", "onset", "uniform"}:
-            return await query.answer("Неизвестный режим", show_alert=True)
-
-        sess["musicprep_selected_mode"] = mode
-        options = get_musicprep_sensitivity_options(mode)
-        if options:
-            sess["musicprep_sensitivity_options"] = options
-            sess["state"] = "musicprep_wait_sensitivity"
-            await query.answer("Алгоритм выбран")
-            await query.message.reply_text(
-                "Выберите чувствительность анализа:",
-                reply_markup=build_musicprep_sensitivity_keyboard(mode),
-            )
-            return
+    await query.answer("Запускаю генерацию…")
 
-        await query.answer("Запускаю генерацию…")
+    async def send(msg: str) -> None:
+        await query.message.reply_text(msg)
 
-        async def send(msg: str) -> None:
-            await query.message.reply_text(msg)
+    return await finalize_musicprep_project(send, sess, user_id, mode)
 
-        return await finalize_musicprep_project(send, sess, user_id, mode)
 
-    if data.startswith("musicprep_sens:"):
-        if sess.get("state") != "musicprep_wait_sensitivity":
-            return await query.answer("Сначала выберите алгоритм", show_alert=True)
-        parts = data.split(":", 2)
-        if len(parts) != 3:
-            return await query.answer("Неверный параметр", show_alert=True)
-        _, mode, key = parts
-        options = get_musicprep_sensitivity_options(mode)
-        selected = next((opt for opt in options if opt["key"] == key), None)
-        if not selected:
-            return await query.answer("Не удалось распознать вариант", show_alert=True)
-        sess["state"] = None
-        await query.answer("Чувствительность выбрана")
+async def _handle_callback_musicprep_sens(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "musicprep_wait_sensitivity":
+        return await query.answer("Сначала выберите алгоритм", show_alert=True)
+    parts = payload.split(":", 1)
+    if len(parts) != 2:
+        return await query.answer("Неверный параметр", show_alert=True)
+    mode, key = parts
+    options = get_musicprep_sensitivity_options(mode)
+    selected = next((opt for opt in options if opt["key"] == key), None)
+    if not selected:
+        return await query.answer("Не удалось распознать вариант", show_alert=True)
+    sess["state"] = None
+    await query.answer("Чувствительность выбрана")
 
-        async def send(msg: str) -> None:
-            await query.message.reply_text(msg)
+    async def send(msg: str) -> None:
+        await query.message.reply_text(msg)
 
-        return await finalize_musicprep_project(
-            send, sess, user_id, mode, selected.get("analysis_kwargs") or {}
-        )
+    return await finalize_musicprep_project(
+        send, sess, user_id, mode, selected.get("analysis_kwargs") or {}
+    )
 
-    if data.startswith("musicprepcheck_project:"):
-        if sess.get("state") != "musicprepcheck_wait_project":
-            return await query.answer("Сначала запусти /musicprepcheck", show_alert=True)
-        slug = data.split(":", 1)[1]
-        projects_map: Dict[str, Dict[str, Any]] = sess.get("musicprepcheck_projects") or {}
-        project = projects_map.get(slug)
-        if not project:
-            return await query.answer("Проект не найден", show_alert=True)
-        await query.answer("Готовлю щелчки…")
-        try:
-            output_path = generate_musicprep_click_preview(project)
-        except Exception as exc:
-            return await query.message.reply_text(f"Не удалось создать MP3 со щелчками: {exc}")
 
-        caption = f"Щелчки для проекта {project.get('name') or slug}"
-        try:
-            with output_path.open("rb") as fh:
-                await context.bot.send_document(
-                    chat_id=update.effective_chat.id,
-                    document=fh,
-                    filename=output_path.name,
-                    caption=caption,
-                )
-        except Exception:
-            await query.message.reply_text(f"Файл сохранён: {output_path}")
-        else:
-            await query.message.reply_text(f"Готово. Файл: {output_path}")
-        return
+async def _handle_callback_musicprepcheck_project(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "musicprepcheck_wait_project":
+        return await query.answer("Сначала запусти /musicprepcheck", show_alert=True)
+    slug = payload
+    projects_map: Dict[str, Dict[str, Any]] = sess.get("musicprepcheck_projects") or {}
+    project = projects_map.get(slug)
+    if not project:
+        return await query.answer("Проект не найден", show_alert=True)
+    await query.answer("Готовлю щелчки…")
+    try:
+        output_path = await asyncio.to_thread(generate_musicprep_click_preview, project)
+    except Exception as exc:
+        return await query.message.reply_text(f"Не удалось создать MP3 со щелчками: {exc}")
 
-    if data.startswith("newcomp_show:"):
-        mode = data.split(":", 1)[1]
-        show_used = mode == "used"
-        if show_used and not sess.get("music_projects_duration_filter"):
-            async def send_duration(text: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-                try:
-                    await query.edit_message_text(text, reply_markup=markup)
-                except Exception:
-                    await query.message.reply_text(text, reply_markup=markup)
+    caption = f"Щелчки для проекта {project.get('name') or slug}"
+    try:
+        document_bytes = await asyncio.to_thread(output_path.read_bytes)
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=document_bytes,
+            filename=output_path.name,
+            caption=caption,
+        )
+    except Exception:
+        await query.message.reply_text(f"Файл сохранён: {output_path}")
+    else:
+        await query.message.reply_text(f"Готово. Файл: {output_path}")
+    return
 
-            await prompt_newcomp_duration(sess, send_duration)
-            await query.answer()
-            return
-        sess["state"] = "newcompmusic_wait_project"
-        text, keyboard = build_newcomp_project_keyboard(sess, show_used=show_used)
-        try:
-            await query.edit_message_text(text, reply_markup=keyboard)
-        except Exception:
-            await query.message.reply_text(text, reply_markup=keyboard)
-        return await query.answer()
 
-    if data == "newcomp_bucket_menu":
+async def _handle_callback_newcomp_show(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    mode = payload
+    show_used = mode == "used"
+    if show_used and not sess.get("music_projects_duration_filter"):
         async def send_duration(text: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
             try:
                 await query.edit_message_text(text, reply_markup=markup)
@@ -7431,558 +8182,748 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 await query.message.reply_text(text, reply_markup=markup)
 
         await prompt_newcomp_duration(sess, send_duration)
-        return await query.answer()
-
-    if data.startswith("newcomp_bucket:"):
-        bucket = data.split(":", 1)[1]
-        valid_keys = {key for key, _, _, _ in NEWCOMPMUSIC_DURATION_BUCKETS}
-        if bucket not in valid_keys:
-            return await query.answer("Неизвестная длительность", show_alert=True)
-        sess["music_projects_duration_filter"] = bucket
-        sess["state"] = "newcompmusic_wait_project"
-        text, keyboard = build_newcomp_project_keyboard(sess, show_used=True)
+        await query.answer()
+        return
+    sess["state"] = "newcompmusic_wait_project"
+    text, keyboard = build_newcomp_project_keyboard(sess, show_used=show_used)
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except Exception:
+        await query.message.reply_text(text, reply_markup=keyboard)
+    return await query.answer()
+
+
+async def _handle_callback_newcomp_bucket_menu(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    async def send_duration(text: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
         try:
-            await query.edit_message_text(text, reply_markup=keyboard)
+            await query.edit_message_text(text, reply_markup=markup)
         except Exception:
-            await query.message.reply_text(text, reply_markup=keyboard)
-        return await query.answer("Фильтр обновлён")
-
-    if data.startswith("newcomp_project:"):
-        projects_map: Dict[str, Dict[str, Any]] = sess.get("music_projects_map") or {}
-        token = data.split(":", 1)[1]
-        chosen = projects_map.get(token)
-        if not chosen:
-            return await query.answer("Проект не найден", show_alert=True)
-
-        manifest_data = chosen.get("manifest_data")
-        manifest_path = chosen.get("manifest_path")
-        if not manifest_data and manifest_path and Path(manifest_path).exists():
-            try:
-                manifest_data = json.loads(Path(manifest_path).read_text(encoding="utf-8"))
-                chosen["manifest_data"] = manifest_data
-            except Exception as exc:
-                return await query.answer(f"Ошибка manifest.json: {exc}", show_alert=True)
-
-        parsed_segments = parse_manifest_segments(manifest_data or {})
-        total_duration = chosen.get("duration")
-        if total_duration is None and parsed_segments:
-            total_duration = parsed_segments[-1].end
-        seg_count = len(parsed_segments)
-        minutes = (total_duration / 60.0) if total_duration else None
-
-        groups = get_source_groups_prefer_unused()
-        if not groups:
-            return await query.answer("Нет групп исходников. Сначала /scan.", show_alert=True)
-
-        sess["state"] = "newcompmusic_choose_orientation"
-        sess["music_selected"] = {
-            "slug": chosen.get("slug"),
-            "name": chosen.get("name"),
-            "duration": total_duration,
-            "segments": seg_count,
-            "manifest": manifest_data,
-            "audio_path": str(chosen.get("audio_path")) if chosen.get("audio_path") else None,
-            "parsed_segments": parsed_segments,
-        }
-        group_entries = [
-            SourceGroupEntry(key=key, rows=list(rows), unused_count=unused_count)
-            for key, rows, unused_count in groups
-        ]
-        sorted_entries, orientation_map = sort_group_entries_with_orientation(group_entries)
-        sess["music_group_orientations"] = orientation_map
-        sess["music_groups_all"] = [
-            (entry.key, entry.rows, entry.unused_count) for entry in sorted_entries
-        ]
-        sess["music_groups"] = []
-        sess["music_orientation_preference"] = None
+            await query.message.reply_text(text, reply_markup=markup)
 
-        lines = [
-            f"Выбран проект: {chosen['name']} (slug: {chosen['slug']}).",
-            f"Смен клипов: {seg_count}",
-        ]
-        if minutes:
-            lines.append(f"Продолжительность ≈ {minutes:.1f} минут.")
-        lines.append("")
-        lines.append("Выберите ориентацию исходников: VR, HOR или VER.")
+    await prompt_newcomp_duration(sess, send_duration)
+    return await query.answer()
 
-        await query.answer("Проект выбран")
-        await query.message.reply_text(
+
+async def _handle_callback_newcomp_bucket(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    bucket = payload
+    valid_keys = {key for key, _, _, _ in NEWCOMPMUSIC_DURATION_BUCKETS}
+    if bucket not in valid_keys:
+        return await query.answer("Неизвестная длительность", show_alert=True)
+    sess["music_projects_duration_filter"] = bucket
+    sess["state"] = "newcompmusic_wait_project"
+    text, keyboard = build_newcomp_project_keyboard(sess, show_used=True)
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except Exception:
+        await query.message.reply_text(text, reply_markup=keyboard)
+    return await query.answer("Фильтр обновлён")
+
+
+async def _handle_callback_newcomp_project(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    projects_map: Dict[str, Dict[str, Any]] = sess.get("music_projects_map") or {}
+    token = payload
+    chosen = projects_map.get(token)
+    if not chosen:
+        return await query.answer("Проект не найден", show_alert=True)
+
+    manifest_data = chosen.get("manifest_data")
+    manifest_path = chosen.get("manifest_path")
+    if not manifest_data and manifest_path and chosen.get("manifest_exists"):
+        try:
+            manifest_data = load_manifest_json(manifest_path)
+            chosen["manifest_data"] = manifest_data
+        except Exception as exc:
+            return await query.answer(f"Ошибка manifest.json: {exc}", show_alert=True)
+
+    parsed_segments = parse_manifest_segments(manifest_data or {})
+    total_duration = chosen.get("duration")
+    if total_duration is None and parsed_segments:
+        total_duration = parsed_segments[-1].end
+    seg_count = len(parsed_segments)
+    minutes = (total_duration / 60.0) if total_duration else None
+
+    sorted_entries, orientation_map = get_sorted_source_group_entries()
+    if not sorted_entries:
+        return await query.answer("Нет групп исходников. Сначала /scan.", show_alert=True)
+
+    sess["state"] = "newcompmusic_choose_orientation"
+    sess["music_selected"] = {
+        "slug": chosen.get("slug"),
+        "name": chosen.get("name"),
+        "duration": total_duration,
+        "segments": seg_count,
+        "manifest": manifest_data,
+        "audio_path": str(chosen.get("audio_path")) if chosen.get("audio_path") else None,
+        "parsed_segments": parsed_segments,
+    }
+    sess["music_group_orientations"] = orientation_map
+    sess["music_groups_all"] = [
+        (entry.key, entry.rows, entry.unused_count) for entry in sorted_entries
+    ]
+    sess["music_groups_by_orientation"] = index_groups_by_orientation(
+        sess["music_groups_all"], orientation_map
+    )
+    sess["music_groups"] = []
+    sess["music_orientation_preference"] = None
+
+    lines = [
+        f"Выбран проект: {chosen['name']} (slug: {chosen['slug']}).",
+        f"Смен клипов: {seg_count}",
+    ]
+    if minutes:
+        lines.append(f"Продолжительность ≈ {minutes:.1f} минут.")
+    lines.append("")
+    lines.append("Выберите ориентацию исходников: VR, HOR или VER.")
+
+    await asyncio.gather(
+        query.answer("Проект выбран"),
+        query.message.reply_text(
             "\n".join(lines),
             reply_markup=build_newcomp_orientation_keyboard(),
-        )
-        return
+        ),
+    )
+    return
 
-    if data.startswith("newcomp_orient:"):
-        if sess.get("state") != "newcompmusic_choose_orientation":
-            return await query.answer("Сначала выберите проект", show_alert=True)
-        target = data.split(":", 1)[1].upper()
-        if target not in NEWCOMPMUSIC_ORIENTATION_CHOICES:
-            return await query.answer("Неизвестный режим", show_alert=True)
-        all_groups = sess.get("music_groups_all") or []
-        if not all_groups:
-            return await query.answer("Список групп пуст. Запустите команду заново.", show_alert=True)
-        orientation_map = sess.get("music_group_orientations") or {}
-        filtered = filter_groups_by_orientation(all_groups, orientation_map, target)
-        if not filtered:
-            return await query.answer("Нет групп в этой ориентации.", show_alert=True)
-        sess["music_orientation_preference"] = target
-        sess["music_groups"] = filtered
-        sess["state"] = "newcompmusic_wait_group"
-        group_entries = [
-            SourceGroupEntry(key=key, rows=list(rows), unused_count=unused)
-            for key, rows, unused in filtered
-        ]
-        msg_lines = _build_group_selection_lines(
-            sess, group_entries, target, prompt_kind="inline"
-        )
-        await query.answer("Ориентация выбрана")
-        await query.message.reply_text(
+
+async def _handle_callback_newcomp_orient(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "newcompmusic_choose_orientation":
+        return await query.answer("Сначала выберите проект", show_alert=True)
+    target = payload.upper()
+    if target not in NEWCOMPMUSIC_ORIENTATION_CHOICES:
+        return await query.answer("Неизвестный режим", show_alert=True)
+    all_groups = sess.get("music_groups_all") or []
+    if not all_groups:
+        return await query.answer("Список групп пуст. Запустите команду заново.", show_alert=True)
+    filtered = _session_groups_for_orientation(sess, "music", target)
+    if not filtered:
+        return await query.answer("Нет групп в этой ориентации.", show_alert=True)
+    sess["music_orientation_preference"] = target
+    sess["music_groups"] = filtered
+    sess["state"] = "newcompmusic_wait_group"
+    group_entries = [
+        SourceGroupEntry(key=key, rows=rows, unused_count=unused)
+        for key, rows, unused in filtered
+    ]
+    msg_lines = _build_group_selection_lines(
+        sess, group_entries, target, prompt_kind="inline"
+    )
+    await asyncio.gather(
+        query.answer("Ориентация выбрана"),
+        query.message.reply_text(
             "\n".join(msg_lines),
             reply_markup=build_numeric_keyboard("newcomp_group", len(filtered)),
-        )
-        return
+        ),
+    )
+    return
 
-    if data.startswith("rategrp_orient:"):
-        if sess.get("state") != "rategrp_choose_orientation":
-            return await query.answer("Сначала запустите /rategrp", show_alert=True)
-        target = data.split(":", 1)[1].upper()
-        if target not in NEWCOMPMUSIC_ORIENTATION_CHOICES:
-            return await query.answer("Неизвестный режим", show_alert=True)
-        all_groups = sess.get("rategrp_groups_all") or []
-        if not all_groups:
-            return await query.answer("Нет доступных групп. Запустите /rategrp заново.", show_alert=True)
-        orientation_map = sess.get("rategrp_group_orientations") or {}
-        filtered = filter_groups_by_orientation(all_groups, orientation_map, target)
-        if not filtered:
-            return await query.answer("Нет групп в этой ориентации.", show_alert=True)
-        sess["rategrp_orientation_preference"] = target
-        sess["rategrp_groups"] = filtered
-        sess["state"] = "rategrp_choose_group"
-        group_entries = [
-            SourceGroupEntry(key=key, rows=list(rows), unused_count=unused)
-            for key, rows, unused in filtered
-        ]
-        msg_lines = format_rategrp_group_prompt(sess, group_entries, target, prompt_kind="inline")
-        await query.answer("Ориентация выбрана")
-        await query.message.reply_text(
+
+async def _handle_callback_rategrp_orient(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "rategrp_choose_orientation":
+        return await query.answer("Сначала запустите /rategrp", show_alert=True)
+    target = payload.upper()
+    if target not in NEWCOMPMUSIC_ORIENTATION_CHOICES:
+        return await query.answer("Неизвестный режим", show_alert=True)
+    all_groups = sess.get("rategrp_groups_all") or []
+    if not all_groups:
+        return await query.answer("Нет доступных групп. Запустите /rategrp заново.", show_alert=True)
+    filtered = _session_groups_for_orientation(sess, "rategrp", target)
+    if not filtered:
+        return await query.answer("Нет групп в этой ориентации.", show_alert=True)
+    sess["rategrp_orientation_preference"] = target
+    sess["rategrp_groups"] = filtered
+    sess["state"] = "rategrp_choose_group"
+    group_entries = [
+        SourceGroupEntry(key=key, rows=rows, unused_count=unused)
+        for key, rows, unused in filtered
+    ]
+    msg_lines = format_rategrp_group_prompt(sess, group_entries, target, prompt_kind="inline")
+    await asyncio.gather(
+        query.answer("Ориентация выбрана"),
+        query.message.reply_text(
             "\n".join(msg_lines),
             reply_markup=build_numeric_keyboard("rategrp_group", len(filtered)),
+        ),
+    )
+    return
+
+
+async def _handle_callback_rategrp_group(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "rategrp_choose_group":
+        return await query.answer("Сначала выберите ориентацию", show_alert=True)
+    try:
+        idx = int(payload)
+    except ValueError:
+        return await query.answer("Неверный номер группы", show_alert=True)
+    groups = sess.get("rategrp_groups") or []
+    if not (1 <= idx <= len(groups)):
+        return await query.answer("Нет группы с таким номером", show_alert=True)
+    key, rows, _ = groups[idx - 1]
+    rows = list(rows)
+    orientation_label = (sess.get("rategrp_group_orientations") or {}).get(key)
+    if not orientation_label:
+        orientation_label = _resolution_orientation(key[1] or "")[0]
+    sess["rategrp_group_choice"] = {
+        "key": key,
+        "label": f"{key[0]} {key[1]}",
+        "orientation": orientation_label,
+    }
+    sess["rategrp_rerate_rows"] = rows
+    queue = _prepare_rategrp_queue(rows)
+    if not queue:
+        available = _rategrp_available_colors(rows)
+        if not available:
+            return await query.answer("В этой группе нет исходников.", show_alert=True)
+        sess["state"] = "rategrp_choose_rerate_color"
+        await query.answer("Выберите цвет для переоценки")
+
+        async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
+            await query.message.reply_text(msg, reply_markup=markup)
+
+        await send_rategrp(
+            f"Группа {key[0]} {key[1]} выбрана. Новых исходников нет, выберите цвет для переоценки:",
+            build_rategrp_rerate_keyboard(available),
         )
         return
+    sess["rategrp_queue"] = queue
+    sess["rategrp_total"] = len(queue)
+    sess["rategrp_processed"] = 0
+    sess["rategrp_queue_origin"] = "unrated"
+    sess["state"] = "rategrp_rate_source"
 
-    if data.startswith("rategrp_group:"):
-        if sess.get("state") != "rategrp_choose_group":
-            return await query.answer("Сначала выберите ориентацию", show_alert=True)
-        try:
-            idx = int(data.split(":", 1)[1])
-        except ValueError:
-            return await query.answer("Неверный номер группы", show_alert=True)
-        groups = sess.get("rategrp_groups") or []
-        if not (1 <= idx <= len(groups)):
-            return await query.answer("Нет группы с таким номером", show_alert=True)
-        key, rows, _ = groups[idx - 1]
-        rows = [dict(row) for row in rows]
-        orientation_label = (sess.get("rategrp_group_orientations") or {}).get(key)
-        if not orientation_label:
-            orientation_label = _resolution_orientation(key[1] or "")[0]
-        sess["rategrp_group_choice"] = {
-            "key": key,
-            "label": f"{key[0]} {key[1]}",
-            "orientation": orientation_label,
-        }
-        sess["rategrp_rerate_rows"] = rows
-        queue = _prepare_rategrp_queue(rows)
-        if not queue:
-            available = _rategrp_available_colors(rows)
-            if not available:
-                return await query.answer("В этой группе нет исходников.", show_alert=True)
-            sess["state"] = "rategrp_choose_rerate_color"
-            await query.answer("Выберите цвет для переоценки")
+    async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        await query.message.reply_text(msg, reply_markup=markup)
 
-            async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-                await query.message.reply_text(msg, reply_markup=markup)
+    await query.answer("Группа выбрана")
+    await send_rategrp(f"Группа {key[0]} {key[1]} выбрана. Неоценённых исходников: {len(queue)}.")
+    return await rategrp_send_next_prompt(sess, send_rategrp)
 
-            await send_rategrp(
-                f"Группа {key[0]} {key[1]} выбрана. Новых исходников нет, выберите цвет для переоценки:",
-                build_rategrp_rerate_keyboard(available),
-            )
-            return
-        sess["rategrp_queue"] = queue
-        sess["rategrp_total"] = len(queue)
-        sess["rategrp_processed"] = 0
-        sess["rategrp_queue_origin"] = "unrated"
-        sess["state"] = "rategrp_rate_source"
 
-        async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-            await query.message.reply_text(msg, reply_markup=markup)
+async def _handle_callback_rategrp_color(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "rategrp_rate_source":
+        return await query.answer("Сначала выберите группу", show_alert=True)
+    color_key = payload
+    choice = RATEGRP_COLOR_CHOICES.get(color_key)
+    if not choice:
+        return await query.answer("Неизвестный цвет", show_alert=True)
 
-        await query.answer("Группа выбрана")
-        await send_rategrp(f"Группа {key[0]} {key[1]} выбрана. Неоценённых исходников: {len(queue)}.")
-        return await rategrp_send_next_prompt(sess, send_rategrp)
+    async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        await query.message.reply_text(msg, reply_markup=markup)
 
-    if data.startswith("rategrp_color:"):
-        if sess.get("state") != "rategrp_rate_source":
-            return await query.answer("Сначала выберите группу", show_alert=True)
-        color_key = data.split(":", 1)[1]
-        choice = RATEGRP_COLOR_CHOICES.get(color_key)
-        if not choice:
-            return await query.answer("Неизвестный цвет", show_alert=True)
+    await query.answer(f"Отмечено {choice['emoji']}")
+    return await rategrp_apply_rating(sess, color_key, send_rategrp)
 
-        async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-            await query.message.reply_text(msg, reply_markup=markup)
 
-        await query.answer(f"Отмечено {choice['emoji']}")
-        return await rategrp_apply_rating(sess, color_key, send_rategrp)
+async def _handle_callback_rategrp_rerate_color(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "rategrp_choose_rerate_color":
+        return await query.answer("Сначала выберите группу", show_alert=True)
+    color_key = payload
 
-    if data.startswith("rategrp_rerate_color:"):
-        if sess.get("state") != "rategrp_choose_rerate_color":
-            return await query.answer("Сначала выберите группу", show_alert=True)
-        color_key = data.split(":", 1)[1]
+    async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        await query.message.reply_text(msg, reply_markup=markup)
 
-        async def send_rategrp(msg: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-            await query.message.reply_text(msg, reply_markup=markup)
+    success = await _rategrp_start_rerate(sess, color_key, send_rategrp)
+    if success:
+        await query.answer("Запускаю переоценку")
+    else:
+        await query.answer("Не удалось начать переоценку", show_alert=True)
+    return
 
-        success = await _rategrp_start_rerate(sess, color_key, send_rategrp)
-        if success:
-            await query.answer("Запускаю переоценку")
-        else:
-            await query.answer("Не удалось начать переоценку", show_alert=True)
-        return
 
-    if data == "rategrp_rerate_back":
-        if sess.get("state") != "rategrp_choose_rerate_color":
-            return await query.answer("Сначала выберите группу", show_alert=True)
-        sess["state"] = "rategrp_choose_group"
-        groups = sess.get("rategrp_groups") or []
-        orientation = sess.get("rategrp_orientation_preference") or "?"
-        group_entries = [
-            SourceGroupEntry(key=key, rows=list(rows), unused_count=unused) for key, rows, unused in groups
-        ]
-        lines = format_rategrp_group_prompt(sess, group_entries, orientation, prompt_kind="inline")
-        keyboard = build_numeric_keyboard("rategrp_group", len(groups)) if groups else None
-        await query.message.reply_text("\n".join(lines), reply_markup=keyboard)
-        return await query.answer("Выберите другую группу")
-
-    if data.startswith("newcomp_group:"):
-        if sess.get("state") != "newcompmusic_wait_group":
-            return await query.answer("Сначала выберите проект", show_alert=True)
-        try:
-            idx = int(data.split(":", 1)[1])
-        except ValueError:
-            return await query.answer("Неверный номер группы", show_alert=True)
-        groups: List[Tuple[Tuple[str, str], List[sqlite3.Row], int]] = sess.get("music_groups") or []
-        if not (1 <= idx <= len(groups)):
-            return await query.answer("Нет группы с таким номером", show_alert=True)
-        key, rows, unused_count = groups[idx - 1]
-        if not rows:
-            return await query.answer("Группа пустая", show_alert=True)
-
-        orientation_label = (sess.get("music_group_orientations") or {}).get(key)
-        if not orientation_label:
-            orientation_label = _resolution_orientation(key[1] or "")[0]
-        sess["music_group_choice"] = {
-            "key": key,
-            "count": len(rows),
-            "orientation": orientation_label,
-            "total_count": len(rows),
-            "unused_count": unused_count,
-            "group_number": idx,
-        }
-        sess["music_group_rows"] = list(rows)
-        sess["music_folder_only_new"] = False
-        sess.pop("music_color_rows", None)
-        sess["state"] = "newcompmusic_choose_groupmode"
+async def _handle_callback_rategrp_rerate_back(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "rategrp_choose_rerate_color":
+        return await query.answer("Сначала выберите группу", show_alert=True)
+    sess["state"] = "rategrp_choose_group"
+    groups = sess.get("rategrp_groups") or []
+    orientation = sess.get("rategrp_orientation_preference") or "?"
+    group_entries = [
+        SourceGroupEntry(key=key, rows=rows, unused_count=unused) for key, rows, unused in groups
+    ]
+    lines = format_rategrp_group_prompt(sess, group_entries, orientation, prompt_kind="inline")
+    keyboard = build_numeric_keyboard("rategrp_group", len(groups)) if groups else None
+    await query.message.reply_text("\n".join(lines), reply_markup=keyboard)
+    return await query.answer("Выберите другую группу")
 
-        await query.answer("Группа выбрана")
-        await query.message.reply_text(
+
+async def _handle_callback_newcomp_group(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "newcompmusic_wait_group":
+        return await query.answer("Сначала выберите проект", show_alert=True)
+    try:
+        idx = int(payload)
+    except ValueError:
+        return await query.answer("Неверный номер группы", show_alert=True)
+    groups: List[Tuple[Tuple[str, str], List[sqlite3.Row], int]] = sess.get("music_groups") or []
+    if not (1 <= idx <= len(groups)):
+        return await query.answer("Нет группы с таким номером", show_alert=True)
+    key, rows, unused_count = groups[idx - 1]
+    if not rows:
+        return await query.answer("Группа пустая", show_alert=True)
+
+    orientation_label = (sess.get("music_group_orientations") or {}).get(key)
+    if not orientation_label:
+        orientation_label = _resolution_orientation(key[1] or "")[0]
+    sess["music_group_choice"] = {
+        "key": key,
+        "count": len(rows),
+        "orientation": orientation_label,
+        "total_count": len(rows),
+        "unused_count": unused_count,
+        "group_number": idx,
+    }
+    sess["music_group_rows"] = list(rows)
+    sess["music_folder_only_new"] = False
+    sess.pop("music_color_rows", None)
+    sess["state"] = "newcompmusic_choose_groupmode"
+
+    await asyncio.gather(
+        query.answer("Группа выбрана"),
+        query.message.reply_text(
             "Группа выбрана. Как будем группировать исходники?",
             reply_markup=build_newcomp_groupmode_keyboard(),
+        ),
+    )
+    return
+
+
+async def _handle_callback_newcomp_folder(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "newcompmusic_wait_folder":
+        return await query.answer("Сначала выберите группу", show_alert=True)
+    token = payload
+    try:
+        count, label = apply_newcomp_folder_choice(
+            sess, token, next_state="newcompmusic_wait_sources"
         )
-        return
+    except ValueError as exc:
+        return await query.answer(str(exc), show_alert=True)
 
-    if data.startswith("newcomp_folder:"):
-        if sess.get("state") != "newcompmusic_wait_folder":
-            return await query.answer("Сначала выберите группу", show_alert=True)
-        token = data.split(":", 1)[1]
-        try:
-            count, label = apply_newcomp_folder_choice(
-                sess, token, next_state="newcompmusic_wait_sources"
-            )
-        except ValueError as exc:
-            return await query.answer(str(exc), show_alert=True)
-
-        choice = sess.get("music_group_choice") or {}
-        codec, res = choice.get("key") or ("?", "?")
-        project_info = sess.get("music_selected") or {}
-        segs = project_info.get("segments")
-        duration = project_info.get("duration")
-        duration_minutes = (duration / 60.0) if duration else None
-
-        msg_lines = [
-            f"Папка выбрана: {label} (исходников: {count}).",
-            f"Группа: {codec} {res}.",
-        ]
-        if duration_minutes:
-            msg_lines.append(f"Продолжительность проекта ≈ {duration_minutes:.1f} минут.")
-        if segs is not None:
-            msg_lines.append(f"Смен клипов: {segs}.")
-        msg_lines.append("Выберите, сколько исходников задействовать:")
+    choice = sess.get("music_group_choice") or {}
+    codec, res = choice.get("key") or ("?", "?")
+    project_info = sess.get("music_selected") or {}
+    segs = project_info.get("segments")
+    duration = project_info.get("duration")
+    duration_minutes = (duration / 60.0) if duration else None
 
-        await query.answer("Папка выбрана")
-        await query.message.reply_text(
+    msg_lines = [
+        f"Папка выбрана: {label} (исходников: {count}).",
+        f"Группа: {codec} {res}.",
+    ]
+    if duration_minutes:
+        msg_lines.append(f"Продолжительность проекта ≈ {duration_minutes:.1f} минут.")
+    if segs is not None:
+        msg_lines.append(f"Смен клипов: {segs}.")
+    msg_lines.append("Выберите, сколько исходников задействовать:")
+
+    await asyncio.gather(
+        query.answer("Папка выбрана"),
+        query.message.reply_text(
             "\n".join(msg_lines),
             reply_markup=build_newcomp_sources_keyboard(),
-        )
+        ),
+    )
+    return
+
+
+async def _handle_callback_newcomp_folder_back(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "newcompmusic_wait_folder":
+        return await query.answer("Сначала выберите группу", show_alert=True)
+    groups = sess.get("music_groups") or []
+    if not groups:
+        return await query.answer("Нет списка групп. Запустите заново.", show_alert=True)
+    sess["state"] = "newcompmusic_wait_group"
+    sess.pop("music_group_choice", None)
+    sess.pop("music_group_rows", None)
+    sess.pop("music_color_rows", None)
+    sess["music_folder_only_new"] = False
+    orientation_label = sess.get("music_orientation_preference") or "?"
+    group_entries = [
+        SourceGroupEntry(key=key, rows=rows, unused_count=unused)
+        for key, rows, unused in groups
+    ]
+    msg_lines = _build_group_selection_lines(
+        sess, group_entries, orientation_label, prompt_kind="inline"
+    )
+    await asyncio.gather(
+        query.answer("Выберите другую группу"),
+        query.message.reply_text(
+            "\n".join(msg_lines),
+            reply_markup=build_numeric_keyboard("newcomp_group", len(groups)),
+        ),
+    )
+    return
+
+
+def _reset_group_count_to_total(sess: Dict[str, Any]) -> None:
+    """Возвращает счётчик выбранной группы к полному размеру после сброса фильтра по цвету."""
+    group_choice = sess.get("music_group_choice")
+    if not group_choice:
         return
+    total = group_choice.get("total_count")
+    if total:
+        group_choice["count"] = total
 
-    if data == "newcomp_folder_back":
-        if sess.get("state") != "newcompmusic_wait_folder":
-            return await query.answer("Сначала выберите группу", show_alert=True)
-        groups = sess.get("music_groups") or []
-        if not groups:
-            return await query.answer("Нет списка групп. Запустите заново.", show_alert=True)
-        sess["state"] = "newcompmusic_wait_group"
-        sess.pop("music_group_choice", None)
-        sess.pop("music_group_rows", None)
-        sess.pop("music_color_rows", None)
+
+async def _handle_callback_newcomp_groupmode(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "newcompmusic_choose_groupmode":
+        return await query.answer("Сначала выберите группу", show_alert=True)
+    mode = payload
+    rows = sess.get("music_group_rows") or []
+    if not rows:
+        return await query.answer("Не удалось загрузить группу.", show_alert=True)
+    if mode == "folders":
+        sess["music_color_rows"] = None
+        sess["music_color_choice"] = None
+        sess["music_color_autotag"] = None
+        _reset_group_count_to_total(sess)
         sess["music_folder_only_new"] = False
-        orientation_label = sess.get("music_orientation_preference") or "?"
-        group_entries = [
-            SourceGroupEntry(key=key, rows=list(rows), unused_count=unused)
-            for key, rows, unused in groups
-        ]
-        msg_lines = _build_group_selection_lines(
-            sess, group_entries, orientation_label, prompt_kind="inline"
-        )
-        await query.answer("Выберите другую группу")
+        sess["state"] = "newcompmusic_wait_folder"
+        msg_text, keyboard = compose_newcomp_folder_prompt(sess)
+        await query.answer("Показываю папки")
+        await query.message.reply_text(msg_text, reply_markup=keyboard)
+        return
+    if mode == "colors":
+        buckets = _bucket_rows_by_color(rows)
+        counts = {info["emoji"]: len(buckets[key]) for key, info in RATEGRP_COLOR_CHOICES.items()}
+        unrated = len(buckets["unrated"])
+        if len(rows) == unrated:
+            return await query.answer("В этой группе нет исходников с оценками.", show_alert=True)
+        combo_counts = {
+            key: len(buckets[key]) for key in ("green_new", *NEWCOMP_COLOR_COMBOS)
+        }
+        sess["music_color_buckets"] = buckets
+        sess["state"] = "newcompmusic_choose_color"
+        await query.answer("Выберите цвет")
         await query.message.reply_text(
-            "\n".join(msg_lines),
-            reply_markup=build_numeric_keyboard("newcomp_group", len(groups)),
+            "Выберите цвет оценки:",
+            reply_markup=build_newcomp_color_keyboard(counts, unrated, combo_counts),
         )
         return
+    return await query.answer("Неизвестный режим", show_alert=True)
 
-    if data.startswith("newcomp_groupmode:"):
-        if sess.get("state") != "newcompmusic_choose_groupmode":
-            return await query.answer("Сначала выберите группу", show_alert=True)
-        mode = data.split(":", 1)[1]
-        rows = sess.get("music_group_rows") or []
-        if not rows:
-            return await query.answer("Не удалось загрузить группу.", show_alert=True)
-        if mode == "folders":
-            available = _count_rows_for_folder_mode(rows, False)
-            if available == 0:
-                return await query.answer("В выбранной группе нет исходников.", show_alert=True)
-            sess["music_color_rows"] = None
-            sess["music_color_choice"] = None
-            sess["music_color_autotag"] = None
-            group_choice = sess.get("music_group_choice") or {}
-            total = group_choice.get("total_count")
-            if total:
-                group_choice["count"] = total
-            sess["music_group_choice"] = group_choice
-            sess["music_folder_only_new"] = False
-            sess["state"] = "newcompmusic_wait_folder"
-            msg_text, keyboard = compose_newcomp_folder_prompt(sess)
-            await query.answer("Показываю папки")
-            await query.message.reply_text(msg_text, reply_markup=keyboard)
-            return
-        if mode == "colors":
-            counts, unrated = _compute_rategrp_color_counts(rows)
-            total_colored = sum(counts.values())
-            if total_colored == 0:
-                return await query.answer("В этой группе нет исходников с оценками.", show_alert=True)
-            green_emoji = RATEGRP_COLOR_CHOICES["green"]["emoji"]
-            yellow_emoji = RATEGRP_COLOR_CHOICES["yellow"]["emoji"]
-            red_emoji = RATEGRP_COLOR_CHOICES["red"]["emoji"]
-            combo_counts = {
-                "green_new": len(_filter_green_new_rows(rows)),
-                "green_yellow": len(
-                    _filter_rows_by_color(rows, {green_emoji, yellow_emoji}, include_unrated=False)
-                ),
-                "green_yellow_red": len(
-                    _filter_rows_by_color(
-                        rows,
-                        {green_emoji, yellow_emoji, red_emoji},
-                        include_unrated=False,
-                    )
-                ),
-            }
-            sess["state"] = "newcompmusic_choose_color"
-            await query.answer("Выберите цвет")
-            await query.message.reply_text(
-                "Выберите цвет оценки:",
-                reply_markup=build_newcomp_color_keyboard(counts, unrated, combo_counts),
-            )
-            return
-        return await query.answer("Неизвестный режим", show_alert=True)
 
-    if data == "newcomp_color_back":
-        if sess.get("state") != "newcompmusic_choose_color":
-            return await query.answer("Сначала выберите режим", show_alert=True)
-        sess["state"] = "newcompmusic_choose_groupmode"
-        sess.pop("music_color_rows", None)
-        sess.pop("music_color_choice", None)
-        sess.pop("music_color_autotag", None)
-        group_choice = sess.get("music_group_choice") or {}
-        total = group_choice.get("total_count")
-        if total:
-            group_choice["count"] = total
-        sess["music_group_choice"] = group_choice
-        await query.answer("Возвращаю выбор")
-        await query.message.reply_text(
+async def _handle_callback_newcomp_color_back(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "newcompmusic_choose_color":
+        return await query.answer("Сначала выберите режим", show_alert=True)
+    sess["state"] = "newcompmusic_choose_groupmode"
+    sess.pop("music_color_rows", None)
+    sess.pop("music_color_choice", None)
+    sess.pop("music_color_autotag", None)
+    _reset_group_count_to_total(sess)
+    await asyncio.gather(
+        query.answer("Возвращаю выбор"),
+        query.message.reply_text(
             "Как будем группировать исходники?",
             reply_markup=build_newcomp_groupmode_keyboard(),
-        )
-        return
+        ),
+    )
+    return
 
-    if data.startswith("newcomp_color:"):
-        if sess.get("state") != "newcompmusic_choose_color":
-            return await query.answer("Сначала выберите режим", show_alert=True)
-        color_key = data.split(":", 1)[1]
-        rows = sess.get("music_group_rows") or []
-        choice = RATEGRP_COLOR_CHOICES.get(color_key)
-        include_unrated = False
-        allowed: Set[str] = set()
-        if choice:
-            emoji = choice["emoji"]
-            allowed = {emoji}
-            filtered = _filter_rows_by_color(rows, allowed, include_unrated=False)
-        elif color_key == "green_new":
-            allowed = {RATEGRP_COLOR_CHOICES["green"]["emoji"]}
-            filtered = _filter_green_new_rows(rows)
-            include_unrated = True
-        elif color_key == "green_yellow":
-            allowed = {
-                RATEGRP_COLOR_CHOICES["green"]["emoji"],
-                RATEGRP_COLOR_CHOICES["yellow"]["emoji"],
-            }
-            filtered = _filter_rows_by_color(rows, allowed, include_unrated=False)
-        elif color_key == "green_yellow_red":
-            allowed = {
-                RATEGRP_COLOR_CHOICES["green"]["emoji"],
-                RATEGRP_COLOR_CHOICES["yellow"]["emoji"],
-                RATEGRP_COLOR_CHOICES["red"]["emoji"],
-            }
-            filtered = _filter_rows_by_color(rows, allowed, include_unrated=False)
-        else:
-            return await query.answer("Неизвестный цвет", show_alert=True)
-        emoji_label = (
-            choice["emoji"]
-            if choice
-            else {
-                "green_new": f"{RATEGRP_COLOR_CHOICES['green']['emoji']}+🆕",
-                "green_yellow": f"{RATEGRP_COLOR_CHOICES['green']['emoji']}+{RATEGRP_COLOR_CHOICES['yellow']['emoji']}",
-                "green_yellow_red": f"{RATEGRP_COLOR_CHOICES['green']['emoji']}+{RATEGRP_COLOR_CHOICES['yellow']['emoji']}+{RATEGRP_COLOR_CHOICES['red']['emoji']}",
-            }.get(color_key, "?")
-        )
-        if not filtered:
-            return await query.answer("Нет исходников с такой оценкой.", show_alert=True)
-        sess["music_color_rows"] = filtered
-        sess["music_color_choice"] = emoji_label
-        autotag = None
-        if include_unrated:
-            autotag_emoji = RATEGRP_COLOR_CHOICES["green"]["emoji"]
-            autotag_ids: List[int] = []
-            for row in filtered:
-                if _rategrp_row_color(row) is None:
-                    try:
-                        autotag_ids.append(int(row["id"]))
-                    except Exception:
-                        continue
-            if autotag_ids:
-                autotag = {"emoji": autotag_emoji, "ids": autotag_ids}
-        else:
-            autotag = None
-        sess["music_color_autotag"] = autotag
-        group_choice = sess.get("music_group_choice") or {}
-        group_choice["count"] = len(filtered)
-        sess["music_group_choice"] = group_choice
-        sess["state"] = "newcompmusic_wait_sources"
-        codec, res = group_choice.get("key") or ("?", "?")
-        msg_lines = [
-            f"Выбран цвет {emoji_label}: {len(filtered)} исходников.",
-            f"Группа: {codec} {res}.",
-            "Сколько исходников задействовать? Пришлите число или выберите на клавиатуре.",
-        ]
-        await query.answer("Цвет выбран")
-        await query.message.reply_text(
+
+async def _handle_callback_newcomp_color(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "newcompmusic_choose_color":
+        return await query.answer("Сначала выберите режим", show_alert=True)
+    color_key = payload
+    buckets = sess.get("music_color_buckets")
+    if buckets is None:
+        buckets = _bucket_rows_by_color(sess.get("music_group_rows") or [])
+        sess["music_color_buckets"] = buckets
+    choice = RATEGRP_COLOR_CHOICES.get(color_key)
+    if color_key in ("unrated", "green_new_unrated") or color_key not in buckets:
+        return await query.answer("Неизвестный цвет", show_alert=True)
+    filtered = buckets[color_key]
+    include_unrated = color_key == "green_new"
+    emoji_label = choice["emoji"] if choice else NEWCOMP_COLOR_COMBO_LABELS.get(color_key, "?")
+    if not filtered:
+        return await query.answer("Нет исходников с такой оценкой.", show_alert=True)
+    sess["music_color_rows"] = filtered
+    sess["music_color_choice"] = emoji_label
+    autotag = None
+    if include_unrated:
+        autotag_ids = [int(row["id"]) for row in buckets["green_new_unrated"]]
+        if autotag_ids:
+            autotag = {"emoji": RATEGRP_GREEN_EMOJI, "ids": autotag_ids}
+    sess["music_color_autotag"] = autotag
+    group_choice = sess.get("music_group_choice") or {}
+    group_choice["count"] = len(filtered)
+    sess["music_group_choice"] = group_choice
+    sess["state"] = "newcompmusic_wait_sources"
+    codec, res = group_choice.get("key") or ("?", "?")
+    msg_lines = [
+        f"Выбран цвет {emoji_label}: {len(filtered)} исходников.",
+        f"Группа: {codec} {res}.",
+        "Сколько исходников задействовать? Пришлите число или выберите на клавиатуре.",
+    ]
+    await asyncio.gather(
+        query.answer("Цвет выбран"),
+        query.message.reply_text(
             "\n".join(msg_lines),
             reply_markup=build_newcomp_sources_keyboard(),
-        )
-        return
+        ),
+    )
+    return
 
-    if data.startswith("newcomp_folder_mode:"):
-        if sess.get("state") != "newcompmusic_wait_folder":
-            return await query.answer("Сначала выберите группу", show_alert=True)
-        mode = data.split(":", 1)[1]
-        target_unused_only = mode == "new"
-        current = bool(sess.get("music_folder_only_new"))
-        if target_unused_only == current:
-            return await query.answer("Этот режим уже активен.")
-        rows = sess.get("music_group_rows") or []
-        if not rows:
-            return await query.answer("Не удалось загрузить исходники группы.", show_alert=True)
-        total_count = _count_rows_for_folder_mode(rows, target_unused_only)
-        if target_unused_only and total_count == 0:
-            return await query.answer("Новых исходников в этой группе нет.", show_alert=True)
-        sess["music_folder_only_new"] = target_unused_only
-        msg_text, keyboard = compose_newcomp_folder_prompt(sess)
-        notice = "Показываю только новые." if target_unused_only else "Возвращаю все исходники."
-        await query.answer(notice)
-        await query.message.reply_text(msg_text, reply_markup=keyboard)
-        return
 
-    if data.startswith("newcomp_sources:"):
-        if sess.get("state") != "newcompmusic_wait_sources":
-            return await query.answer("Сначала выберите группу", show_alert=True)
-        try:
-            count = int(data.split(":", 1)[1])
-        except ValueError:
-            return await query.answer("Неверное число", show_alert=True)
-        available = int((sess.get("music_group_choice") or {}).get("count") or 0)
-        info_line = None
-        if available and count > available:
-            count = available
-            info_line = _source_limit_message(sess, available)
-        sess["music_sources"] = count
-        sess["state"] = "newcompmusic_wait_algo"
-
-        await query.answer("Количество выбрано" if not info_line else "Берём максимум")
-        algo_desc = ", ".join(f"{meta['short']} ({meta['title']})" for meta in CLIP_SEQUENCE_ALGORITHMS.values())
-        msg_lines = []
-        if info_line:
-            msg_lines.append(info_line)
-        msg_lines.append(f"Ок, возьмём {count} исходников.")
-        msg_lines.append(
-            f"Выберите метод рандомизации клипов: {algo_desc}",
-        )
-        await query.message.reply_text(
-            "\n".join(msg_lines),
-            reply_markup=build_newcomp_algo_keyboard(),
-        )
-        return
+async def _handle_callback_newcomp_folder_mode(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "newcompmusic_wait_folder":
+        return await query.answer("Сначала выберите группу", show_alert=True)
+    mode = payload
+    target_unused_only = mode == "new"
+    current = bool(sess.get("music_folder_only_new"))
+    if target_unused_only == current:
+        return await query.answer("Этот режим уже активен.")
+    rows = sess.get("music_group_rows") or []
+    if not rows:
+        return await query.answer("Не удалось загрузить исходники группы.", show_alert=True)
+    _, folder_map = _session_folder_options(sess, target_unused_only)
+    if target_unused_only and folder_map["all"]["count"] == 0:
+        return await query.answer("Новых исходников в этой группе нет.", show_alert=True)
+    sess["music_folder_only_new"] = target_unused_only
+    msg_text, keyboard = compose_newcomp_folder_prompt(sess)
+    notice = "Показываю только новые." if target_unused_only else "Возвращаю все исходники."
+    await asyncio.gather(
+        query.answer(notice),
+        query.message.reply_text(msg_text, reply_markup=keyboard),
+    )
+    return
 
-    if data.startswith("newcomp_algo:"):
-        if sess.get("state") != "newcompmusic_wait_algo":
-            return await query.answer("Сначала выберите количество исходников", show_alert=True)
-        short = data.split(":", 1)[1]
-        resolved_key = normalize_clip_algo_choice(short)
-        if not resolved_key:
-            return await query.answer("Неизвестный алгоритм", show_alert=True)
 
-        async def send_from_query(message: str) -> None:
-            await query.message.reply_text(message)
+async def _handle_callback_newcomp_sources(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "newcompmusic_wait_sources":
+        return await query.answer("Сначала выберите группу", show_alert=True)
+    try:
+        count = int(payload)
+    except ValueError:
+        return await query.answer("Неверное число", show_alert=True)
+    available = int((sess.get("music_group_choice") or {}).get("count") or 0)
+    info_line = None
+    if available and count > available:
+        count = available
+        info_line = _source_limit_message(sess, available)
+    sess["music_sources"] = count
+    sess["state"] = "newcompmusic_wait_algo"
+
+    await query.answer("Количество выбрано" if not info_line else "Берём максимум")
+    msg_lines = []
+    if info_line:
+        msg_lines.append(info_line)
+    msg_lines.append(f"Ок, возьмём {count} исходников.")
+    msg_lines.append(
+        f"Выберите метод рандомизации клипов: {CLIP_ALGO_DESCRIPTION}",
+    )
+    await query.message.reply_text(
+        "\n".join(msg_lines),
+        reply_markup=build_newcomp_algo_keyboard(),
+    )
+    return
+
 
-        await query.answer("Генерация…")
-        return await run_newcompmusic_generation(send_from_query, sess, resolved_key, user_id)
+async def _handle_callback_newcomp_algo(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    sess: Dict[str, Any],
+    user_id: int,
+    payload: str,
+) -> None:
+    if sess.get("state") != "newcompmusic_wait_algo":
+        return await query.answer("Сначала выберите количество исходников", show_alert=True)
+    short = payload
+    resolved_key = normalize_clip_algo_choice(short)
+    if not resolved_key:
+        return await query.answer("Неизвестный алгоритм", show_alert=True)
+
+    async def send_from_query(message: str) -> None:
+        await query.message.reply_text(message)
+
+    await query.answer("Генерация…")
+    return await run_newcompmusic_generation(send_from_query, sess, resolved_key, user_id)
+
+
+# Кнопки с данными вида "<префикс>:<значение>".
+CALLBACK_HANDLERS: Dict[str, CallbackHandler] = {
+    "report_group": _handle_callback_report_group,
+    "randompmv_orient": _handle_callback_randompmv_orient,
+    "randompmv_count": _handle_callback_randompmv_count,
+    "randompmv_newcount": _handle_callback_randompmv_newcount,
+    "find_pick": _handle_callback_find_pick,
+    "ratepmv_select": _handle_callback_ratepmv_select,
+    "ratepmv_rate": _handle_callback_ratepmv_rate,
+    "ratepmv_bulk": _handle_callback_ratepmv_bulk,
+    "musicprep_show": _handle_callback_musicprep_show,
+    "musicprep_track": _handle_callback_musicprep_track,
+    "musicprep_seconds": _handle_callback_musicprep_seconds,
+    "musicprep_mode": _handle_callback_musicprep_mode,
+    "musicprep_sens": _handle_callback_musicprep_sens,
+    "musicprepcheck_project": _handle_callback_musicprepcheck_project,
+    "newcomp_show": _handle_callback_newcomp_show,
+    "newcomp_bucket": _handle_callback_newcomp_bucket,
+    "newcomp_project": _handle_callback_newcomp_project,
+    "newcomp_orient": _handle_callback_newcomp_orient,
+    "rategrp_orient": _handle_callback_rategrp_orient,
+    "rategrp_group": _handle_callback_rategrp_group,
+    "rategrp_color": _handle_callback_rategrp_color,
+    "rategrp_rerate_color": _handle_callback_rategrp_rerate_color,
+    "newcomp_group": _handle_callback_newcomp_group,
+    "newcomp_folder": _handle_callback_newcomp_folder,
+    "newcomp_groupmode": _handle_callback_newcomp_groupmode,
+    "newcomp_color": _handle_callback_newcomp_color,
+    "newcomp_folder_mode": _handle_callback_newcomp_folder_mode,
+    "newcomp_sources": _handle_callback_newcomp_sources,
+    "newcomp_algo": _handle_callback_newcomp_algo,
+}
 
-    await query.answer("Неизвестная кнопка", show_alert=True)
+# Кнопки без значения — callback_data совпадает целиком.
+CALLBACK_EXACT_HANDLERS: Dict[str, CallbackHandler] = {
+    "find_retry": _handle_callback_find_retry,
+    "rategrp_from_pmv": _handle_callback_rategrp_from_pmv,
+    "newcomp_bucket_menu": _handle_callback_newcomp_bucket_menu,
+    "rategrp_rerate_back": _handle_callback_rategrp_rerate_back,
+    "newcomp_folder_back": _handle_callback_newcomp_folder_back,
+    "newcomp_color_back": _handle_callback_newcomp_color_back,
+}
 
 
-async def cmd_badfiles(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
     if not check_access(update):
+        await query.answer("Нет доступа", show_alert=True)
         return await unauthorized(update)
 
+    user_id = query.from_user.id if query.from_user else 0
+    data = (query.data or "").strip()
+    sess = user_sessions.get(user_id)
+
+    if not sess:
+        await query.answer("Сессия устарела", show_alert=True)
+        return
+
+    prefix, sep, payload = data.partition(":")
+    handler = (CALLBACK_HANDLERS.get(prefix) if sep else None) or CALLBACK_EXACT_HANDLERS.get(data)
+    if handler is not None:
+        return await handler(update, context, query, sess, user_id, payload)
+
+    await query.answer("Неизвестная кнопка", show_alert=True)
+
+
+@authed
+async def cmd_badfiles(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     rows = db_get_problem_sources()
     if not rows:
         return await update.message.reply_text("Проблемные файлы не обнаружены.")
@@ -7993,10 +8934,8 @@ async def cmd_badfiles(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.message.reply_text("\n".join(lines))
 
 
+@authed
 async def cmd_strategy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     global CURRENT_STRATEGY
 
     args = context.args
@@ -8015,10 +8954,8 @@ async def cmd_strategy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     return await update.message.reply_text(f"Ок, стратегия установлена: {CURRENT_STRATEGY}")
 
 
+@authed
 async def cmd_videofx(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     global GLITCH_EFFECTS_PER_VIDEO, TRANSITION_EFFECTS_PER_VIDEO
 
     args = context.args
@@ -8048,36 +8985,23 @@ async def cmd_videofx(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 
 
+@authed
 async def cmd_ratepmv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
-    rows = db_get_all_compilations()
-    if not rows:
-        return await update.message.reply_text("Похоже, пока нет готовых PMV и оценивать нечего.")
-
-    unrated = []
-    for r in rows:
-        comments = (r["comments"] or "").lower()
-        if "pmv_rating=" not in comments:
-            unrated.append(r)
-
-    if not unrated:
+    unrated_total = db_count_unrated_compilations()
+    if not unrated_total:
+        if not db_get_all_compilations():
+            return await update.message.reply_text("Похоже, пока нет готовых PMV и оценивать нечего.")
         return await update.message.reply_text("Все PMV уже получили оценки! 🔥")
 
-    unrated_sorted = sorted(
-        unrated,
-        key=lambda row: ((row["pmv_date"] or ""), int(row["id"] or 0)),
-    )
-    display_rows = unrated_sorted[:10]
-    remaining = max(0, len(unrated_sorted) - len(display_rows))
+    display_rows = db_get_unrated_compilations(10)
+    remaining = max(0, unrated_total - len(display_rows))
 
-    lines = [f"Без оценки осталось PMV: {len(unrated_sorted)}."]
+    lines = [f"Без оценки осталось PMV: {unrated_total}."]
     if remaining > 0:
         lines.append(f"Показываю 10 самых старых, ещё ждут своей очереди: {remaining}.")
     lines.append("")
     for idx, r in enumerate(display_rows, 1):
-        name = Path(r["video_path"]).name
+        name = os.path.basename(r["video_path"])
         date_str = r["pmv_date"]
         lines.append(f"{idx}. {name} (дата: {date_str}, id={r['id']})")
 
@@ -8109,16 +9033,50 @@ def get_source_groups_prefer_unused() -> List[Tuple[Tuple[str, str], List[sqlite
         if len(rows_all) <= 5:
             continue
         unused_count = len(unused.get(key) or [])
-        entries.append(SourceGroupEntry(key=key, rows=list(rows_all), unused_count=unused_count))
+        entries.append(SourceGroupEntry(key=key, rows=rows_all, unused_count=unused_count))
 
     sorted_entries = sort_source_group_entries(entries)
     return [(entry.key, entry.rows, entry.unused_count) for entry in sorted_entries]
 
 
-async def cmd_newcompmusic(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
+def _db_state_token() -> Tuple[int, ...]:
+    """
+    Дешёвый отпечаток состояния БД: счётчик записей этого процесса плюс mtime/размер
+    основного файла и WAL-журнала (последние ловят запись из других процессов, например move_output).
+    """
+    parts: List[int] = [_DB_WRITE_GENERATION]
+    for path in (DB_PATH, DB_PATH.with_name(DB_PATH.name + "-wal")):
+        try:
+            st = os.stat(path)
+        except OSError:
+            parts.extend((0, 0))
+        else:
+            parts.extend((st.st_mtime_ns, st.st_size))
+    return tuple(parts)
+
+
+@functools.lru_cache(maxsize=4)
+def _sorted_source_group_entries_cached(
+    db_token: Tuple[int, ...],
+) -> Tuple[List[SourceGroupEntry], Dict[Tuple[str, str], str]]:
+    group_entries = [
+        SourceGroupEntry(key=key, rows=rows, unused_count=unused_count)
+        for key, rows, unused_count in get_source_groups_prefer_unused()
+    ]
+    return sort_group_entries_with_orientation(group_entries)
+
+
+def get_sorted_source_group_entries() -> Tuple[List[SourceGroupEntry], Dict[Tuple[str, str], str]]:
+    """
+    Группы исходников, отсортированные по ориентации, и карта ориентаций.
+    Результат кэшируется, пока не изменилась БД.
+    Списки общие для всех вызовов — их нельзя менять на месте.
+    """
+    return _sorted_source_group_entries_cached(_db_state_token())
 
+
+@authed
+async def cmd_newcompmusic(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     projects = load_music_projects()
     if not projects:
         return await update.message.reply_text(
@@ -8158,10 +9116,8 @@ async def cmd_newcompmusic(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await update.message.reply_text(text, reply_markup=keyboard)
 
 
+@authed
 async def cmd_randompmv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     user_sessions[update.effective_user.id] = {
         "state": "randompmv_choose_orientation",
     }
@@ -8174,26 +9130,18 @@ async def cmd_randompmv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await update.message.reply_text(msg, reply_markup=build_randompmv_orientation_keyboard())
 
 
+@authed
 async def cmd_rategrp(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
-    groups = get_source_groups_prefer_unused()
-    if not groups:
+    sorted_entries, orientation_map = get_sorted_source_group_entries()
+    if not sorted_entries:
         return await update.message.reply_text("Нет групп исходников. Сначала просканируйте /scan.")
 
-    group_entries = [
-        SourceGroupEntry(key=key, rows=list(rows), unused_count=unused_count)
-        for key, rows, unused_count in groups
-    ]
-    sorted_entries, orientation_map = sort_group_entries_with_orientation(group_entries)
-
+    groups_all = [(entry.key, entry.rows, entry.unused_count) for entry in sorted_entries]
     session_payload = {
         "state": "rategrp_choose_orientation",
         "rategrp_group_orientations": orientation_map,
-        "rategrp_groups_all": [
-            (entry.key, entry.rows, entry.unused_count) for entry in sorted_entries
-        ],
+        "rategrp_groups_all": groups_all,
+        "rategrp_groups_by_orientation": index_groups_by_orientation(groups_all, orientation_map),
         "rategrp_groups": [],
         "rategrp_orientation_preference": None,
     }
@@ -8210,10 +9158,8 @@ async def cmd_rategrp(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     )
 
 
+@authed
 async def cmd_reports(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     user_sessions[update.effective_user.id] = {
         "state": "reports_wait_choice",
     }
@@ -8223,9 +9169,8 @@ async def cmd_reports(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     )
 
 
+@authed
 async def cmd_find(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
     user_id = update.effective_user.id
     user_sessions[user_id] = {
         "state": "find_wait_term",
@@ -8238,27 +9183,29 @@ async def cmd_find(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+@authed
 async def cmd_musicprep(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
-    files = list_music_input_files()
-    if not files:
+    tracks = list_music_input_tracks()
+    if not tracks:
         return await update.message.reply_text(
             f"Папка {MUSIC_INPUT_DIR} пуста. Добавьте туда MP3/FLAC/M4A и повторите команду."
         )
 
-    usage_map = collect_music_track_usage()
+    usage_map = collect_music_track_usage(tracks)
+    usage_get = usage_map.get
     track_map: Dict[str, Dict[str, Any]] = {}
     unused_tokens: List[str] = []
     used_tokens: List[str] = []
 
-    for idx, path in enumerate(sorted(files, key=lambda p: p.name.lower()), 1):
+    for idx, (path, norm) in enumerate(tracks, 1):
         token = f"mt{idx}"
-        norm = _normalize_path_str(path)
-        count = usage_map.get(norm, 0)
+        count = usage_get(norm, 0)
+        _, title = extract_track_title_components(path)
         track_map[token] = {
             "path": str(path),
+            "name": path.name,
+            "stem": path.stem,
+            "title": title,
             "usage": count,
         }
         if count:
@@ -8279,10 +9226,8 @@ async def cmd_musicprep(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await update.message.reply_text(text, reply_markup=keyboard)
 
 
+@authed
 async def cmd_musicprepcheck(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     projects = load_music_projects()
     if not projects:
         return await update.message.reply_text(
@@ -8305,10 +9250,8 @@ async def cmd_musicprepcheck(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
 
 
+@authed
 async def cmd_move2oculus(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not check_access(update):
-        return await unauthorized(update)
-
     script_path = SCRIPT_DIR / "move2oculus.py"
     if not script_path.exists():
         return await update.message.reply_text("move2oculus.py не найден рядом со скриптом.")
@@ -8322,10 +9265,12 @@ async def cmd_move2oculus(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         stderr=asyncio.subprocess.PIPE,
     )
 
-    stdout_lines: List[str] = []
-    stderr_lines: List[str] = []
+    # Для итогового сообщения нужны только последние строки.
+    stdout_lines: Deque[str] = deque(maxlen=20)
+    stderr_lines: Deque[str] = deque(maxlen=20)
     chunk_size = 3500
-    output_queue: asyncio.Queue[Tuple[str, str]] = asyncio.Queue()
+    flush_interval = 0.5
+    output_queue: asyncio.Queue[Optional[Tuple[str, str]]] = asyncio.Queue()
 
     async def send_chunks(msg: str) -> None:
         if not msg:
@@ -8333,23 +9278,52 @@ async def cmd_move2oculus(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         for i in range(0, len(msg), chunk_size):
             await update.message.reply_text(msg[i : i + chunk_size])
 
-    async def read_stream(stream, label: str, collector: List[str]) -> None:
+    async def read_stream(stream, label: str, collector: Deque[str]) -> None:
+        # Читаем блоками и режем на строки сами: меньше пробуждений цикла событий,
+        # и длинная строка без перевода строки не упирается в лимит readline().
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        leftover = ""
         while True:
-            line = await stream.readline()
-            if not line:
+            chunk = await stream.read(65536)
+            if chunk:
+                leftover += decoder.decode(chunk)
+                *lines, leftover = leftover.split("\n")
+            else:
+                lines = [leftover + decoder.decode(b"", final=True)]
+            for line in lines:
+                text = line.rstrip()
+                if not text:
+                    continue
+                collector.append(text)
+                await output_queue.put((label, text))
+            if not chunk:
                 break
-            text = line.decode(errors="ignore").rstrip()
-            if not text:
-                continue
-            collector.append(text)
-            await output_queue.put((label, text))
 
     async def pump_output() -> None:
+        # Копим строки и отправляем пачкой: по заполнению chunk_size или после паузы в выводе.
+        buf: List[str] = []
+        buf_len = 0
         while True:
-            label, text = await output_queue.get()
-            prefix = "STDOUT" if label == "stdout" else "STDERR"
-            await send_chunks(f"{prefix}: {text}")
-            output_queue.task_done()
+            try:
+                item = await asyncio.wait_for(
+                    output_queue.get(), timeout=flush_interval if buf else None
+                )
+            except asyncio.TimeoutError:
+                item = ()
+            if item:
+                label, text = item
+                prefix = "STDOUT" if label == "stdout" else "STDERR"
+                line = f"{prefix}: {text}"
+                buf.append(line)
+                buf_len += len(line) + 1
+                if buf_len < chunk_size:
+                    continue
+            if buf:
+                await send_chunks("\n".join(buf))
+                buf.clear()
+                buf_len = 0
+            if item is None:
+                return
 
     stdout_task = asyncio.create_task(read_stream(process.stdout, "stdout", stdout_lines))
     stderr_task = asyncio.create_task(read_stream(process.stderr, "stderr", stderr_lines))
@@ -8358,10 +9332,8 @@ async def cmd_move2oculus(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await process.wait()
     await stdout_task
     await stderr_task
-    await output_queue.join()
-    pump_task.cancel()
-    with contextlib.suppress(asyncio.CancelledError):
-        await pump_task
+    await output_queue.put(None)
+    await pump_task
 
     returncode = process.returncode or 0
     if returncode == 0:
@@ -8369,8 +9341,8 @@ async def cmd_move2oculus(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     else:
         header = f"❌ Ошибка (код {returncode})."
 
-    tail_stdout = "\n".join(stdout_lines[-20:])
-    tail_stderr = "\n".join(stderr_lines[-20:])
+    tail_stdout = "\n".join(stdout_lines)
+    tail_stderr = "\n".join(stderr_lines)
     parts = [header]
     if tail_stdout:
         parts.append("Последние сообщения:\n" + tail_stdout)
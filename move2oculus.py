@@ -10,19 +10,28 @@ from __future__ import annotations
 
 import atexit
 import os
+import select
+import shlex
 import shutil
 import signal
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path, PurePosixPath
-from typing import Dict, Iterable, List, Optional, Set, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 from main import NETWORK_OUTPUT_ROOT
 
 SCRIPT_DIR = Path(__file__).resolve().parent
 REMOTE_OUTPUT_ROOT = PurePosixPath("/sdcard/Movies/output")
 LOCK_PATH = SCRIPT_DIR / "move2oculus.lock"
+# Сколько файлов отдавать одной команде adb push / папок одной mkdir -p
+# (держим командную строку короткой и прогресс — частым).
+PUSH_BATCH_MAX_FILES = 20
+MKDIR_BATCH_MAX_DIRS = 50
+# Сколько пачек adb push держать в работе одновременно.
+PUSH_WORKERS = 4
 
 
 class AdbError(RuntimeError):
@@ -73,17 +82,40 @@ def read_lock_pid() -> Optional[int]:
         return None
 
 
+WIN_PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+WIN_ERROR_ACCESS_DENIED = 5
+WIN_STILL_ACTIVE = 259
+
+
+def _windows_process_running(pid: int) -> bool:
+    """Проверка PID через OpenProcess/GetExitCodeProcess — без запуска tasklist."""
+    import ctypes
+    from ctypes import wintypes
+
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+
+    handle = kernel32.OpenProcess(WIN_PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        # Чужой процесс с более высокими правами: он есть, но открыть его нельзя.
+        return ctypes.get_last_error() == WIN_ERROR_ACCESS_DENIED
+    try:
+        exit_code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+            return True
+        return exit_code.value == WIN_STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+
 def process_running(pid: int) -> bool:
     if pid <= 0:
         return False
     if os.name == "nt":
-        proc = subprocess.run(
-            ["tasklist", "/FI", f"PID eq {pid}"],
-            capture_output=True,
-            text=True,
-        )
-        needle = f"{pid}"
-        return needle in proc.stdout
+        return _windows_process_running(pid)
     try:
         os.kill(pid, 0)
         return True
@@ -91,20 +123,50 @@ def process_running(pid: int) -> bool:
         return False
 
 
-def terminate_process(pid: int) -> None:
+def _open_pidfd(pid: int) -> Optional[int]:
+    if not hasattr(os, "pidfd_open"):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def _wait_pidfd(pidfd: int, timeout: float) -> bool:
+    """Ждёт завершения процесса по pidfd не дольше timeout секунд; True — процесс завершился."""
+    poller = select.poll()
+    poller.register(pidfd, select.POLLIN)
+    return bool(poller.poll(int(timeout * 1000)))
+
+
+def terminate_process(pid: int) -> bool:
+    """
+    Завершает процесс. Возвращает True, если его завершение точно дождались
+    (Linux с pidfd) — тогда дополнительная пауза перед перезапуском не нужна.
+    """
     if os.name == "nt":
         subprocess.run(
             ["taskkill", "/PID", str(pid), "/F"],
             capture_output=True,
             text=True,
         )
-    else:
+        return False
+    # pidfd открываем до сигнала, чтобы не перепутать процесс при переиспользовании PID.
+    pidfd = _open_pidfd(pid)
+    try:
         for sig in (signal.SIGTERM, signal.SIGKILL):
             try:
                 os.kill(pid, sig)
-                time.sleep(1)
             except OSError:
-                break
+                return pidfd is not None
+            if pidfd is None:
+                time.sleep(1)
+            elif _wait_pidfd(pidfd, 1.0):
+                return True
+        return False
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
 
 
 def ensure_single_instance() -> None:
@@ -113,8 +175,8 @@ def ensure_single_instance() -> None:
     if existing and existing != current_pid:
         if process_running(existing):
             print(f"Обнаружен предыдущий процесс move2oculus (PID {existing}). Завершаю...", flush=True)
-            terminate_process(existing)
-            time.sleep(2)
+            if not terminate_process(existing):
+                time.sleep(2)
         LOCK_PATH.unlink(missing_ok=True)
     LOCK_PATH.write_text(str(current_pid))
 
@@ -159,45 +221,83 @@ def ensure_remote_root() -> None:
 
 def list_remote_files() -> Set[PurePosixPath]:
     ensure_remote_root()
-    proc = run_adb(["shell", "find", str(REMOTE_OUTPUT_ROOT), "-type", "f", "-print"])
+    # find из самой папки печатает относительные пути вида ./a/b.mp4.
+    proc = run_adb(["shell", f"cd {shlex.quote(str(REMOTE_OUTPUT_ROOT))} && find . -type f"])
     files: Set[PurePosixPath] = set()
-    prefix = str(REMOTE_OUTPUT_ROOT)
-    for line in proc.stdout.strip().splitlines():
+    for line in proc.stdout.splitlines():
         line = line.strip()
-        if not line:
-            continue
-        if not line.startswith(prefix):
-            continue
-        rel = line[len(prefix) :].lstrip("/")
-        if rel:
-            files.add(PurePosixPath(rel))
+        if line.startswith("./") and len(line) > 2:
+            files.add(PurePosixPath(line[2:]))
     return files
 
 
-def list_local_files() -> Dict[PurePosixPath, Tuple[Path, int]]:
+def _scandir_files(
+    directory: str, rel_parts: Tuple[str, ...] = ()
+) -> Iterator[Tuple[Tuple[str, ...], os.DirEntry]]:
+    """Рекурсивный обход через os.scandir: файлы вместе с путём относительно корня.
+
+    Как и rglob, в симлинки на папки не заходит, а симлинки на файлы отдаёт.
+    """
+    with os.scandir(directory) as it:
+        entries = list(it)
+    for entry in entries:
+        parts = rel_parts + (entry.name,)
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scandir_files(entry.path, parts)
+        elif entry.is_file():
+            yield parts, entry
+
+
+def list_local_files(
+    skip: Optional[Set[PurePosixPath]] = None,
+) -> Dict[PurePosixPath, Tuple[Path, int]]:
+    """Локальные файлы с размерами; пути из skip (уже есть на шлеме) не stat-ятся и не попадают в результат."""
     root = Path(NETWORK_OUTPUT_ROOT)
     if not root.exists():
         raise RuntimeError(f"Локальная папка не найдена: {root}")
     files: Dict[PurePosixPath, Tuple[Path, int]] = {}
-    for path in root.rglob("*"):
-        if path.is_file():
-            rel = path.relative_to(root)
-            try:
-                size = path.stat().st_size
-            except OSError:
-                size = 0
-            files[PurePosixPath(*rel.parts)] = (path, size)
+    for parts, entry in _scandir_files(str(root)):
+        rel = PurePosixPath(*parts)
+        if skip and rel in skip:
+            continue
+        try:
+            size = entry.stat().st_size
+        except OSError:
+            size = 0
+        files[rel] = (Path(entry.path), size)
     return files
 
 
-def push_file(local_path: Path, rel_posix: PurePosixPath) -> None:
-    remote_path = REMOTE_OUTPUT_ROOT / rel_posix
-    remote_dir = remote_path.parent
-    run_adb(["shell", "mkdir", "-p", str(remote_dir)])
-    print(f"[ADB] push {local_path} -> {remote_path}")
-    proc = run_adb(["push", str(local_path), str(remote_path)])
-    if proc.stdout.strip():
-        print(proc.stdout.strip())
+def ensure_remote_dirs(remote_dirs: Iterable[PurePosixPath]) -> None:
+    """Создаёт папки на шлеме пачками: одна adb shell mkdir -p на MKDIR_BATCH_MAX_DIRS папок."""
+    dirs = sorted({str(d) for d in remote_dirs})
+    for start in range(0, len(dirs), MKDIR_BATCH_MAX_DIRS):
+        batch = dirs[start : start + MKDIR_BATCH_MAX_DIRS]
+        run_adb(["shell", "mkdir -p " + " ".join(shlex.quote(d) for d in batch)])
+
+
+def push_files(local_paths: List[Path], remote_dir: PurePosixPath) -> str:
+    """Один adb push на несколько файлов одной папки; имена на шлеме совпадают с локальными.
+
+    Возвращает вывод adb: печатает его вызывающий, чтобы строки параллельных пачек не перемешивались.
+    """
+    proc = run_adb(["push", *(str(p) for p in local_paths), f"{remote_dir}/"])
+    return proc.stdout.strip()
+
+
+def group_missing_by_remote_dir(
+    missing: List[Tuple[PurePosixPath, Path, int]],
+) -> List[Tuple[PurePosixPath, List[Tuple[PurePosixPath, Path, int]]]]:
+    """Разбивает недостающие файлы на пачки для push_files: по папке на шлеме, не больше PUSH_BATCH_MAX_FILES."""
+    by_dir: Dict[PurePosixPath, List[Tuple[PurePosixPath, Path, int]]] = {}
+    # Сортируем по строке пути: сравнение PurePosixPath заметно дороже.
+    for item in sorted(missing, key=lambda item: str(item[0])):
+        by_dir.setdefault((REMOTE_OUTPUT_ROOT / item[0]).parent, []).append(item)
+    batches: List[Tuple[PurePosixPath, List[Tuple[PurePosixPath, Path, int]]]] = []
+    for remote_dir, items in by_dir.items():
+        for start in range(0, len(items), PUSH_BATCH_MAX_FILES):
+            batches.append((remote_dir, items[start : start + PUSH_BATCH_MAX_FILES]))
+    return batches
 
 
 def main() -> None:
@@ -206,14 +306,14 @@ def main() -> None:
     devices = ensure_device_connected()
     print(f"Найдено устройств ADB: {', '.join(devices)}")
 
-    local_files = list_local_files()
     remote_files = list_remote_files()
-    print(f"Локальных файлов: {len(local_files)}, на Oculus: {len(remote_files)}")
+    # Файлы, которые уже есть на шлеме, пропускаем ещё при обходе — без stat.
+    local_files = list_local_files(skip=remote_files)
+    print(f"На Oculus файлов: {len(remote_files)}, локальных файлов, которых там нет: {len(local_files)}")
 
-    missing: List[Tuple[PurePosixPath, Path, int]] = []
-    for rel, (local_path, size_bytes) in local_files.items():
-        if rel not in remote_files:
-            missing.append((rel, local_path, size_bytes))
+    missing: List[Tuple[PurePosixPath, Path, int]] = [
+        (rel, local_path, size_bytes) for rel, (local_path, size_bytes) in local_files.items()
+    ]
 
     if not missing:
         print("Все файлы уже есть на шлеме. Синхронизация не требуется.")
@@ -225,22 +325,45 @@ def main() -> None:
     )
     errors: List[str] = []
     copied_bytes = 0
+    done_files = 0
     total_files = len(missing)
-    for idx, (rel, local_path, size_bytes) in enumerate(sorted(missing), start=1):
-        try:
-            print(
-                f"[{idx}/{total_files}] {rel} ({format_bytes(size_bytes)})",
-                flush=True,
+    batches = group_missing_by_remote_dir(missing)
+    try:
+        ensure_remote_dirs(remote_dir for remote_dir, _ in batches)
+    except AdbError as exc:
+        print(f"Не удалось создать папки на шлеме: {exc}", file=sys.stderr)
+        sys.exit(1)
+    # Пачки уходят параллельно; прогресс печатает только главный поток по мере завершения.
+    with ThreadPoolExecutor(max_workers=min(PUSH_WORKERS, len(batches))) as pool:
+        futures = {
+            pool.submit(push_files, [local_path for _, local_path, _ in items], remote_dir): (
+                remote_dir,
+                items,
             )
-            push_file(local_path, rel)
-            copied_bytes += size_bytes
+            for remote_dir, items in batches
+        }
+        for future in as_completed(futures):
+            remote_dir, items = futures[future]
+            for offset, (rel, _, size_bytes) in enumerate(items, start=1):
+                print(
+                    f"[{done_files + offset}/{total_files}] {rel} ({format_bytes(size_bytes)})",
+                    flush=True,
+                )
+            done_files += len(items)
+            try:
+                output = future.result()
+            except Exception as exc:  # noqa: BLE001
+                errors.extend(f"{rel}: {exc}" for rel, _, _ in items)
+                continue
+            print(f"[ADB] push {len(items)} файл(ов) -> {remote_dir}/")
+            if output:
+                print(output)
+            copied_bytes += sum(size for _, _, size in items)
             remaining = max(total_bytes - copied_bytes, 0)
             print(
-                f"    ✓ Осталось {total_files - idx} файлов / {format_bytes(remaining)}",
+                f"    ✓ Осталось {total_files - done_files} файлов / {format_bytes(remaining)}",
                 flush=True,
             )
-        except Exception as exc:  # noqa: BLE001
-            errors.append(f"{rel}: {exc}")
 
     print("=" * 60)
     print(f"Успешно скопировано: {len(missing) - len(errors)}")
@@ -12,9 +12,11 @@
 from __future__ import annotations
 
 import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, date
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, List, Optional, Tuple, TypeVar
 import sqlite3
 import time
 
@@ -39,8 +41,41 @@ def daterange(start: date, end: date):
         current += timedelta(days=1)
 
 
-def _move_for_date_once(target_date: date) -> Tuple[List[int], List[Tuple[int, str]]]:
-    iso_date = target_date.isoformat()
+PROBE_WORKERS = 16
+
+T = TypeVar("T")
+
+
+def _probe_path(path: str) -> Optional[os.stat_result]:
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def probe_paths(paths: List[str]) -> List[Optional[os.stat_result]]:
+    """os.stat для всех путей параллельно (на сетевом диске stat упирается в задержку, а не в CPU)."""
+    if len(paths) <= 1:
+        return [_probe_path(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(paths))) as pool:
+        return list(pool.map(_probe_path, paths))
+
+
+def _retry_on_locked(target_date: date, action: Callable[[], T]) -> T:
+    attempts = 5
+    for attempt in range(1, attempts):
+        try:
+            return action()
+        except sqlite3.OperationalError as exc:
+            if "database is locked" not in str(exc).lower():
+                raise
+            wait = attempt * 2
+            print(f"[{target_date}] БД занята, повтор через {wait}с...")
+            time.sleep(wait)
+    return action()
+
+
+def _fetch_rows_for_date(iso_date: str) -> List[sqlite3.Row]:
     conn = get_conn()
     conn.execute("PRAGMA busy_timeout = 5000")
     try:
@@ -49,47 +84,62 @@ def _move_for_date_once(target_date: date) -> Tuple[List[int], List[Tuple[int, s
             "SELECT id, video_path, comments FROM compilations WHERE pmv_date = ? ORDER BY id",
             (iso_date,),
         )
-        rows = cur.fetchall()
-        moved_ids: List[int] = []
-        skipped: List[Tuple[int, str]] = []
-
-        for row in rows:
-            pmv_id = int(row["id"])
-            old_path = Path(row["video_path"])
-            if not old_path.exists():
-                skipped.append((pmv_id, f"файл отсутствует: {old_path}"))
-                continue
-            try:
-                new_path, move_note = move_output_to_network_storage(old_path, date_folder=iso_date)
-            except Exception as exc:  # noqa: BLE001
-                skipped.append((pmv_id, f"ошибка переноса: {exc}"))
-                continue
-
-            updated_comments = combine_comments(row["comments"], move_note)
-            cur.execute(
-                "UPDATE compilations SET video_path = ?, comments = ? WHERE id = ?",
-                (str(new_path.resolve()), updated_comments, pmv_id),
-            )
-            moved_ids.append(pmv_id)
+        return cur.fetchall()
+    finally:
+        conn.close()
+
 
+def _write_move_updates(updates: List[Tuple[str, str, int]]) -> None:
+    conn = get_conn()
+    conn.execute("PRAGMA busy_timeout = 5000")
+    try:
+        conn.executemany(
+            "UPDATE compilations SET video_path = ?, comments = ? WHERE id = ?",
+            updates,
+        )
         conn.commit()
-        return moved_ids, skipped
+    except Exception:
+        conn.rollback()
+        raise
     finally:
         conn.close()
 
 
 def move_for_date(target_date: date) -> Tuple[List[int], List[Tuple[int, str]]]:
-    attempts = 5
-    for attempt in range(1, attempts + 1):
+    """
+    Переносит PMV за дату и обновляет их пути в БД.
+    Файлы переносятся без открытой транзакции, а при "database is locked" повторяются только
+    чтение списка и итоговая запись: повтор переносов увидел бы уже перенесённые файлы
+    как отсутствующие, и обновления путей потерялись бы.
+    """
+    iso_date = target_date.isoformat()
+    rows = _retry_on_locked(target_date, lambda: _fetch_rows_for_date(iso_date))
+    moved_ids: List[int] = []
+    skipped: List[Tuple[int, str]] = []
+    updates: List[Tuple[str, str, int]] = []
+
+    probes = probe_paths([row["video_path"] for row in rows])
+    for row, probe in zip(rows, probes):
+        pmv_id = int(row["id"])
+        old_path = Path(row["video_path"])
+        if probe is None:
+            skipped.append((pmv_id, f"файл отсутствует: {old_path}"))
+            continue
         try:
-            return _move_for_date_once(target_date)
-        except sqlite3.OperationalError as exc:
-            if "database is locked" in str(exc).lower() and attempt < attempts:
-                wait = attempt * 2
-                print(f"[{target_date}] БД занята, повтор через {wait}с...")
-                time.sleep(wait)
-                continue
-            raise
+            new_path, move_note = move_output_to_network_storage(old_path, date_folder=iso_date)
+        except Exception as exc:  # noqa: BLE001
+            skipped.append((pmv_id, f"ошибка переноса: {exc}"))
+            continue
+
+        updated_comments = combine_comments(row["comments"], move_note)
+        updates.append((str(new_path.resolve()), updated_comments, pmv_id))
+        moved_ids.append(pmv_id)
+
+    # Пишем в БД одним пакетом после всех переносов: блокировка на запись
+    # не держится, пока файлы копируются на сетевой диск.
+    if updates:
+        _retry_on_locked(target_date, lambda: _write_move_updates(updates))
+    return moved_ids, skipped
 
 
 def build_arg_parser() -> argparse.ArgumentParser:
@@ -23,13 +23,16 @@ Music-guided PMV pre-processor.
 from __future__ import annotations
 
 import argparse
+import hashlib
 import json
+import os
+import re
 import shutil
 import sys
 import time
-from dataclasses import asdict, dataclass, field
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional
+from typing import Any, Dict, Iterable, List, Optional
 
 try:
     import numpy as np
@@ -46,14 +49,20 @@ PROJECTS_ROOT = SCRIPT_DIR / "music_projects"
 DEFAULT_TARGET_SEGMENT = 1.0  # seconds (минимальная длительность сегмента)
 DEFAULT_SEGMENT_MODE = "beat"
 SEGMENT_MODES = ("beat", "onset", "uniform")
+# Кэш тяжёлых librosa-признаков: ключ — хэш содержимого трека и параметров анализа.
+ANALYSIS_CACHE_DIR = SCRIPT_DIR / "tmp" / "music_analysis_cache"
+ANALYSIS_CACHE_VERSION = 1
+# Частота анализа: биты/онсеты/RMS считаются с hop_length в отсчётах этой частоты.
+ANALYSIS_SAMPLE_RATE = 22050
+
+
+# Каждый символ вне [a-z0-9-_] заменяется на "-" (серии не схлопываются —
+# иначе у уже созданных проектов поменялись бы слаги).
+SLUG_DISALLOWED_RE = re.compile(r"[^a-z0-9_-]")
 
 
 def slugify(text: str) -> str:
-    allowed = "abcdefghijklmnopqrstuvwxyz0123456789-_"
-    slug = []
-    for ch in text.lower():
-        slug.append(ch if ch in allowed else "-")
-    compact = "".join(slug).strip("-")
+    compact = SLUG_DISALLOWED_RE.sub("-", text.lower()).strip("-")
     return compact or f"project-{int(time.time())}"
 
 
@@ -70,16 +79,24 @@ class Segment:
 class MusicAnalysis:
     sample_rate: int
     tempo: float
-    beat_times: List[float]
-    beat_intensity: List[float]
-    rms_curve: List[float]
+    # Кривые храним массивами numpy; в списки float они превращаются только в to_dict().
+    beat_times: np.ndarray
+    beat_intensity: np.ndarray
+    rms_curve: np.ndarray
     segments: List[Segment] = field(default_factory=list)
     mode: str = DEFAULT_SEGMENT_MODE
 
     def to_dict(self) -> Dict:
-        payload = asdict(self)
-        payload["segments"] = [asdict(seg) for seg in self.segments]
-        return payload
+        # Без asdict(): он глубоко копирует длинные кривые beat_times / rms_curve.
+        return {
+            "sample_rate": self.sample_rate,
+            "tempo": self.tempo,
+            "beat_times": np.asarray(self.beat_times).tolist(),
+            "beat_intensity": np.asarray(self.beat_intensity).tolist(),
+            "rms_curve": np.asarray(self.rms_curve).tolist(),
+            "segments": [dict(vars(seg)) for seg in self.segments],
+            "mode": self.mode,
+        }
 
 
 @dataclass
@@ -102,6 +119,89 @@ class ProjectManifest:
         }
 
 
+def _analysis_cache_path(
+    mp3_path: Path,
+    hop_length: int,
+    beat_tightness: Optional[float],
+) -> Path:
+    digest = hashlib.sha1()
+    with mp3_path.open("rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(chunk)
+    params = (
+        ANALYSIS_CACHE_VERSION,
+        librosa.__version__,
+        ANALYSIS_SAMPLE_RATE,
+        hop_length,
+        beat_tightness,
+    )
+    digest.update(repr(params).encode("utf-8"))
+    return ANALYSIS_CACHE_DIR / f"{digest.hexdigest()}.npz"
+
+
+def load_audio_features(
+    mp3_path: Path,
+    hop_length: int = 512,
+    beat_tightness: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Декодирует трек и считает beat_track / onset_strength / rms.
+    Результат кэшируется на диске, повторный анализ того же файла обходится без librosa.load.
+    """
+    try:
+        cache_path: Optional[Path] = _analysis_cache_path(mp3_path, hop_length, beat_tightness)
+    except OSError:
+        cache_path = None
+    if cache_path is not None and cache_path.exists():
+        try:
+            with np.load(cache_path) as data:
+                return {
+                    "sr": int(data["sr"]),
+                    "n_samples": int(data["n_samples"]),
+                    "tempo": float(data["tempo"]),
+                    "beat_frames": data["beat_frames"],
+                    "onset_env": data["onset_env"],
+                    "rms": data["rms"],
+                }
+        except Exception:
+            pass  # битый кэш — просто пересчитываем
+
+    y, sr = librosa.load(mp3_path, sr=ANALYSIS_SAMPLE_RATE, mono=True, dtype=np.float32)
+    # Одна mel-спектрограмма на оба онсет-профиля: beat_track и onset_strength(y=...)
+    # иначе считают её каждый сам. Агрегаты те же, что librosa берёт по умолчанию.
+    mel_db = librosa.power_to_db(
+        np.abs(librosa.feature.melspectrogram(y=y, sr=sr, n_fft=2048, hop_length=hop_length))
+    )
+    beat_env = librosa.onset.onset_strength(
+        S=mel_db, sr=sr, hop_length=hop_length, aggregate=np.median
+    )
+    beat_kwargs = {}
+    if beat_tightness is not None:
+        beat_kwargs["tightness"] = beat_tightness
+    tempo, beat_frames = librosa.beat.beat_track(
+        onset_envelope=beat_env, sr=sr, hop_length=hop_length, **beat_kwargs
+    )
+    features = {
+        "sr": int(sr),
+        "n_samples": int(len(y)),
+        "tempo": float(np.asarray(tempo).reshape(-1)[0]) if np.size(tempo) else 0.0,
+        "beat_frames": np.asarray(beat_frames, dtype=int),
+        "onset_env": librosa.onset.onset_strength(S=mel_db, sr=sr, hop_length=hop_length),
+        "rms": librosa.feature.rms(y=y, frame_length=2048, hop_length=hop_length)[0],
+    }
+
+    if cache_path is not None:
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_name(cache_path.name + ".part")
+            with tmp_path.open("wb") as fh:
+                np.savez(fh, **features)
+            os.replace(tmp_path, cache_path)
+        except OSError as exc:
+            print(f"[WARN] Не удалось сохранить кэш анализа {cache_path}: {exc}")
+    return features
+
+
 def analyze_mp3(
     mp3_path: Path,
     hop_length: int = 512,
@@ -112,24 +212,23 @@ def analyze_mp3(
     sensitivity_scale: float = 1.0,
 ) -> MusicAnalysis:
     """Анализирует MP3 для получения темпа и beat-тактов."""
-    y, sr = librosa.load(mp3_path, mono=True)
-    beat_kwargs = {}
-    if beat_tightness is not None:
-        beat_kwargs["tightness"] = beat_tightness
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr, hop_length=hop_length, **beat_kwargs)
+    features = load_audio_features(mp3_path, hop_length=hop_length, beat_tightness=beat_tightness)
+    sr = features["sr"]
+    tempo = features["tempo"]
+    beat_frames = features["beat_frames"]
     beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=hop_length)
 
-    onset_env = librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop_length)
+    onset_env = features["onset_env"]
     beat_strengths = onset_env[beat_frames] if len(beat_frames) else np.zeros(0)
     if beat_strengths.size:
         max_strength = beat_strengths.max()
         if max_strength > 0:
             beat_strengths = beat_strengths / max_strength
 
-    rms = librosa.feature.rms(y=y, frame_length=2048, hop_length=hop_length)[0]
+    rms = features["rms"]
     rms = rms / rms.max() if rms.size and rms.max() > 0 else rms
 
-    beat_intensity = beat_strengths.tolist()
+    beat_intensity = beat_strengths
 
     mode = (segment_mode or DEFAULT_SEGMENT_MODE).lower()
     if mode not in SEGMENT_MODES:
@@ -139,7 +238,7 @@ def analyze_mp3(
         sensitivity_scale = 1.0
     adjusted_segment = max(0.2, target_segment / sensitivity_scale)
 
-    total_duration = len(y) / sr
+    total_duration = features["n_samples"] / sr
     dynamic_mins = compute_dynamic_min_durations(
         beat_times,
         rms,
@@ -152,12 +251,14 @@ def analyze_mp3(
         segments = build_uniform_segments(total_duration, adjusted_segment)
     elif mode == "onset":
         segments = build_onset_segments(
-            y,
+            None,
             sr,
             hop_length=hop_length,
             default_len=adjusted_segment,
             rms_curve=rms,
             onset_delta=onset_delta,
+            onset_envelope=onset_env,
+            total_duration=total_duration,
         )
     else:
         segments = build_segments(
@@ -171,14 +272,20 @@ def analyze_mp3(
     return MusicAnalysis(
         sample_rate=sr,
         tempo=float(tempo),
-        beat_times=beat_times.tolist(),
+        beat_times=beat_times,
         beat_intensity=beat_intensity,
-        rms_curve=rms.tolist(),
+        rms_curve=rms,
         segments=segments,
         mode=mode,
     )
 
 
+def _as_float_array(values: Iterable[float]) -> np.ndarray:
+    if isinstance(values, np.ndarray):
+        return values.astype(float, copy=False)
+    return np.asarray(list(values), dtype=float)
+
+
 def build_segments(
     beat_times: Iterable[float],
     beat_strengths: Iterable[float],
@@ -186,78 +293,121 @@ def build_segments(
     min_duration: float,
     dynamic_min_durations: Optional[List[float]] = None,
 ) -> List[Segment]:
-    beats = list(beat_times)
-    strengths = list(beat_strengths)
-    if len(strengths) < len(beats):
-        strengths.extend([0.0] * (len(beats) - len(strengths)))
+    beats = _as_float_array(beat_times)
+    count = beats.size
+    if count == 0:
+        return []
+    strengths = np.zeros(count)
+    given = _as_float_array(beat_strengths)[:count]
+    strengths[: given.size] = given
+
+    ends = np.empty(count)
+    ends[:-1] = beats[1:]
+    ends[-1] = beats[-1] + default_len
+    durations = np.maximum(0.1, ends - beats)
+
+    starts_r = np.round(beats, 3)
+    ends_r = np.round(ends, 3)
+    durations_r = np.round(durations, 3)
+    strengths_r = np.round(strengths, 3)
+    if min_duration > 0 or dynamic_min_durations:
+        merged = _merge_segment_arrays(
+            starts_r, ends_r, durations_r, strengths_r, min_duration, dynamic_min_durations
+        )
+        if merged:
+            return merged
+    return _segments_from_arrays(starts_r, ends_r, durations_r, strengths_r)
 
-    segments: List[Segment] = []
-    for idx, start in enumerate(beats):
-        end = beats[idx + 1] if idx + 1 < len(beats) else start + default_len
-        duration = max(0.1, end - start)
-        segments.append(
-            Segment(
-                index=idx,
-                start=round(float(start), 3),
-                end=round(float(end), 3),
-                duration=round(float(duration), 3),
-                intensity=round(float(strengths[idx]), 3),
-            )
+
+def _segments_from_arrays(
+    starts: np.ndarray,
+    ends: np.ndarray,
+    durations: np.ndarray,
+    intensities: np.ndarray,
+) -> List[Segment]:
+    return [
+        Segment(index=idx, start=start, end=end, duration=duration, intensity=intensity)
+        for idx, (start, end, duration, intensity) in enumerate(
+            zip(starts.tolist(), ends.tolist(), durations.tolist(), intensities.tolist())
         )
-    if min_duration <= 0 and not dynamic_min_durations:
-        return segments
-    return merge_segments_by_duration(segments, min_duration, dynamic_min_durations)
+    ]
 
 
-def merge_segments_by_duration(
-    segments: List[Segment],
+def _merge_segment_arrays(
+    starts: np.ndarray,
+    ends: np.ndarray,
+    durations: np.ndarray,
+    intensities: np.ndarray,
     min_duration: float,
     dynamic_min_durations: Optional[List[float]] = None,
 ) -> List[Segment]:
+    """
+    Склеивает подряд идущие сегменты, пока суммарная длительность не достигнет порога.
+    Порог берётся по первому сегменту пачки; границы пачек ищутся по префиксным суммам.
+    """
+    count = len(starts)
+    if count == 0:
+        return []
+    thresholds = np.full(count, max(0.1, min_duration))
+    if dynamic_min_durations:
+        limit = min(count, len(dynamic_min_durations))
+        thresholds[:limit] = np.maximum(0.1, np.asarray(dynamic_min_durations[:limit], dtype=float))
+    cum_duration = np.concatenate(([0.0], np.cumsum(durations)))
+    # Сами суммы пачки считаем последовательно (как раньше в цикле), чтобы
+    # погрешность cumsum не сдвигала границы и округление.
+    duration_list = durations.tolist()
+    energy_list = (intensities * durations).tolist()
+    threshold_list = thresholds.tolist()
+
     merged: List[Segment] = []
-    acc_start = None
-    acc_end = None
-    acc_duration = 0.0
-    acc_energy = 0.0
-    acc_idx = 0
-    current_threshold = max(0.1, min_duration)
-
-    def flush(index_hint: int) -> None:
-        nonlocal acc_start, acc_end, acc_duration, acc_energy, acc_idx
-        if acc_start is None or acc_end is None or acc_duration <= 0:
-            acc_start = acc_end = None
-            acc_duration = acc_energy = 0.0
-            return
-        intensity = max(0.0, min(1.0, acc_energy / acc_duration))
-        merged.append(
-            Segment(
-                index=index_hint,
-                start=round(acc_start, 3),
-                end=round(acc_end, 3),
-                duration=round(acc_duration, 3),
-                intensity=round(intensity, 3),
+    first = 0
+    while first < count:
+        threshold = threshold_list[first]
+        stop = int(np.searchsorted(cum_duration, cum_duration[first] + threshold, side="left"))
+        stop = min(max(stop, first + 1), count)
+        duration = sum(duration_list[first:stop])
+        if duration < threshold:
+            while duration < threshold and stop < count:
+                duration += duration_list[stop]
+                stop += 1
+        else:
+            while stop - 1 > first:
+                shorter = sum(duration_list[first : stop - 1])
+                if shorter < threshold:
+                    break
+                stop -= 1
+                duration = shorter
+        if duration > 0:
+            energy = sum(energy_list[first:stop])
+            intensity = max(0.0, min(1.0, energy / duration))
+            merged.append(
+                Segment(
+                    index=len(merged),
+                    start=round(float(starts[first]), 3),
+                    end=round(float(ends[stop - 1]), 3),
+                    duration=round(duration, 3),
+                    intensity=round(intensity, 3),
+                )
             )
-        )
-        acc_start = acc_end = None
-        acc_duration = acc_energy = 0.0
-
-    for idx, seg in enumerate(segments):
-        if acc_start is None:
-            acc_start = seg.start
-            if dynamic_min_durations and idx < len(dynamic_min_durations):
-                current_threshold = max(0.1, dynamic_min_durations[idx])
-            else:
-                current_threshold = max(0.1, min_duration)
-        acc_end = seg.end
-        acc_duration += seg.duration
-        acc_energy += seg.intensity * seg.duration
-        if acc_duration >= current_threshold:
-            flush(acc_idx)
-            acc_idx += 1
-
-    if acc_duration > 0 and acc_start is not None and acc_end is not None:
-        flush(acc_idx)
+        first = stop
+    return merged
 
+
+def merge_segments_by_duration(
+    segments: List[Segment],
+    min_duration: float,
+    dynamic_min_durations: Optional[List[float]] = None,
+) -> List[Segment]:
+    if not segments:
+        return segments
+    merged = _merge_segment_arrays(
+        np.array([seg.start for seg in segments], dtype=float),
+        np.array([seg.end for seg in segments], dtype=float),
+        np.array([seg.duration for seg in segments], dtype=float),
+        np.array([seg.intensity for seg in segments], dtype=float),
+        min_duration,
+        dynamic_min_durations,
+    )
     return merged or segments
 
 
@@ -268,11 +418,11 @@ def compute_dynamic_min_durations(
     sr: int,
     base_len: float,
 ) -> List[float]:
-    times = list(times)
-    if not times:
+    times_array = _as_float_array(times)
+    if not times_array.size:
         return []
     if rms_curve is None or rms_curve.size == 0:
-        return [base_len] * len(times)
+        return [base_len] * times_array.size
 
     rms_array = np.asarray(rms_curve, dtype=float)
     max_val = float(rms_array.max())
@@ -285,12 +435,8 @@ def compute_dynamic_min_durations(
     fast_len = max(0.35, base_len * 0.5)
     slow_len = max(base_len, base_len * 1.8)
 
-    result: List[float] = []
-    for t in times:
-        energy = float(np.interp(t, sample_times, norm))
-        min_len = float(np.interp(energy, [0.0, 1.0], [slow_len, fast_len]))
-        result.append(min_len)
-    return result
+    energy = np.interp(times_array, sample_times, norm)
+    return np.interp(energy, [0.0, 1.0], [slow_len, fast_len]).tolist()
 
 
 def build_uniform_segments(total_duration: float, segment_len: float) -> List[Segment]:
@@ -318,26 +464,38 @@ def build_uniform_segments(total_duration: float, segment_len: float) -> List[Se
 
 
 def build_onset_segments(
-    y: np.ndarray,
+    y: Optional[np.ndarray],
     sr: int,
     hop_length: int,
     default_len: float,
     rms_curve: Optional[np.ndarray] = None,
     onset_delta: Optional[float] = None,
+    onset_envelope: Optional[np.ndarray] = None,
+    total_duration: Optional[float] = None,
 ) -> List[Segment]:
+    """
+    Сегменты по онсетам. Можно передать готовый onset_envelope и total_duration —
+    тогда сам сигнал y не нужен (None).
+    """
+    if total_duration is None:
+        total_duration = len(y) / sr
     onset_kwargs = {}
     if onset_delta is not None:
         onset_kwargs["delta"] = onset_delta
     onset_frames = librosa.onset.onset_detect(
-        y=y, sr=sr, hop_length=hop_length, units="frames", **onset_kwargs
+        y=y,
+        sr=sr,
+        onset_envelope=onset_envelope,
+        hop_length=hop_length,
+        units="frames",
+        **onset_kwargs,
     )
     onset_times = librosa.frames_to_time(onset_frames, sr=sr, hop_length=hop_length)
     if onset_times.size == 0:
-        total_duration = len(y) / sr
         return build_uniform_segments(total_duration, default_len)
     strengths = np.ones_like(onset_times)
     dynamic_mins = compute_dynamic_min_durations(
-        onset_times.tolist(),
+        onset_times,
         rms_curve=rms_curve,
         hop_length=hop_length,
         sr=sr,
@@ -351,7 +509,6 @@ def build_onset_segments(
         dynamic_min_durations=dynamic_mins,
     )
     if not segments:
-        total_duration = len(y) / sr
         return build_uniform_segments(total_duration, default_len)
     return segments
 
@@ -367,11 +524,20 @@ def ensure_project_paths(slug: str) -> Dict[str, Path]:
     }
 
 
+TIMECODES_HEADER = "# start_seconds,end_seconds,intensity"
+TIMECODES_ROW_FORMAT = "%.3f,%.3f,%.3f"
+
+
 def save_timecodes_txt(segments: List[Segment], dst: Path) -> None:
-    lines = ["# start_seconds,end_seconds,intensity"]
-    for seg in segments:
-        lines.append(f"{seg.start:.3f},{seg.end:.3f},{seg.intensity:.3f}")
-    dst.write_text("\n".join(lines), encoding="utf-8")
+    if not segments:
+        dst.write_text(TIMECODES_HEADER, encoding="utf-8")
+        return
+    # Один вызов %-форматирования на весь файл вместо f-строки на каждую строку.
+    values = tuple(
+        value for seg in segments for value in (seg.start, seg.end, seg.intensity)
+    )
+    body = "\n".join([TIMECODES_ROW_FORMAT] * len(segments)) % values
+    dst.write_text(f"{TIMECODES_HEADER}\n{body}", encoding="utf-8")
 
 
 def create_music_project(
@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import sqlite3
 from dataclasses import dataclass
 from typing import Callable, Dict, Iterable, List, Tuple
 
@@ -10,7 +9,8 @@ GroupKey = Tuple[str, str]
 
 @dataclass
 class ReportEnvironment:
-    db_get_groups: Callable[[], Dict[GroupKey, List[sqlite3.Row]]]
+    # emoji -> [((codec, resolution), количество, суммарный размер)] по исходникам с этой меткой в комментарии
+    db_color_group_stats: Callable[[str], List[Tuple[GroupKey, int, int]]]
     color_choices: Dict[str, Dict[str, str]]
 
 
@@ -26,11 +26,6 @@ def _format_size(num_bytes: int) -> str:
     return f"{value:.1f} {units[-1]}"
 
 
-def _row_has_color(row: sqlite3.Row, emoji: str) -> bool:
-    comments = (row["comments"] or "") if row else ""
-    return emoji in comments
-
-
 def build_color_group_report(
     env: ReportEnvironment,
     color_key: str,
@@ -42,26 +37,9 @@ def build_color_group_report(
     emoji = choice["emoji"]
     label = choice["label"]
 
-    groups = env.db_get_groups()
-    entries: List[Tuple[GroupKey, int, int]] = []
-    total_count = 0
-    total_size = 0
-
-    for key, rows in groups.items():
-        count = 0
-        size = 0
-        for row in rows:
-            if not _row_has_color(row, emoji):
-                continue
-            count += 1
-            try:
-                size += int(row["size_bytes"] or 0)
-            except Exception:
-                continue
-        if count:
-            entries.append((key, count, size))
-            total_count += count
-            total_size += size
+    entries = [entry for entry in env.db_color_group_stats(emoji) if entry[1]]
+    total_count = sum(count for _key, count, _size in entries)
+    total_size = sum(size for _key, _count, size in entries)
 
     if not entries:
         return f"Нет исходников цвета {emoji} ({label})."
@@ -76,9 +54,10 @@ def build_color_group_report(
     ]
 
     limited = entries[:top_n]
-    for idx, (key, count, size) in enumerate(limited, 1):
-        codec, resolution = key
-        lines.append(f"{idx}. {codec} {resolution} — {count} шт · {_format_size(size)}")
+    lines.extend(
+        f"{idx}. {codec} {resolution} — {count} шт · {_format_size(size)}"
+        for idx, ((codec, resolution), count, size) in enumerate(limited, 1)
+    )
 
     if len(entries) > len(limited):
         lines.append(f"... и ещё {len(entries) - len(limited)} групп.")
@@ -1,16 +1,23 @@
 from __future__ import annotations
 
 import os
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import date, datetime
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
-import shutil
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+import sqlite3
 
 
 PathLike = Union[str, Path]
 RowLike = Union[Dict[str, Any], Any]
 
+# Сколько ждать чужую блокировку записи перед BEGIN IMMEDIATE, прежде чем упасть с "database is locked".
+SCAN_DB_BUSY_TIMEOUT_MS = 10000
+# Сколько ffprobe запускать одновременно при сканировании.
+VIDEO_PROBE_WORKERS = os.cpu_count() or 4
+
 
 @dataclass
 class ScanEnvironment:
@@ -20,20 +27,148 @@ class ScanEnvironment:
     """
 
     default_exts: Set[str]
-    normalize_path_str: Callable[[PathLike], str]
     normalize_path_prefix: Callable[[PathLike], str]
-    is_path_under_prefixes: Callable[[PathLike, Iterable[str]], bool]
     combine_comments: Callable[[Optional[str], Optional[str]], str]
     merge_pmv_lists: Callable[[Optional[str], Optional[str]], str]
     video_info_sort: Callable[[Path], Tuple[str, str]]
+    db_connect: Callable[[], sqlite3.Connection]
     db_get_sources_full: Callable[[], Sequence[RowLike]]
-    db_update_source_fields: Callable[..., None]
+    db_update_sources_many: Callable[..., None]
     db_insert_source: Callable[..., Optional[int]]
     db_delete_sources_by_ids: Callable[[Iterable[int]], int]
     db_path: Path
     backup_dir: Path
 
 
+def _resolve_str(path_str: str) -> str:
+    try:
+        return str(Path(path_str).resolve())
+    except Exception:
+        return os.path.abspath(path_str)
+
+
+def _path_key(resolved_path: str) -> str:
+    """Ключ path_map: то же, что normalize_path_str, но для уже resolve-нутого пути (без повторного resolve())."""
+    return resolved_path.lower()
+
+
+def _resolve_exists_one(raw_path: str) -> Tuple[str, bool]:
+    try:
+        resolved_path = str(Path(raw_path).resolve(strict=False))
+    except Exception:
+        resolved_path = raw_path
+    try:
+        return resolved_path, Path(resolved_path).exists()
+    except Exception:
+        return resolved_path, False
+
+
+def _resolve_stored_paths(raw_paths: Sequence[str]) -> List[Tuple[str, bool]]:
+    """
+    resolve() + exists() для путей из базы: одна resolve() и один os.scandir на папку вместо
+    resolve (lstat на каждый компонент) и stat на каждую строку. Симлинки, отсутствующие в листинге
+    имена и пути без нормальной родительской папки проверяются по одному, как раньше.
+    """
+    dir_cache: Dict[str, Optional[Tuple[str, Dict[str, os.DirEntry]]]] = {}
+    results: List[Tuple[str, bool]] = []
+    for raw_path in raw_paths:
+        parent, name = os.path.split(raw_path)
+        if not parent or name in ("", ".", ".."):
+            results.append(_resolve_exists_one(raw_path))
+            continue
+        if parent not in dir_cache:
+            try:
+                with os.scandir(parent) as it:
+                    listing = {os.path.normcase(entry.name): entry for entry in it}
+                dir_cache[parent] = (_resolve_str(parent), listing)
+            except OSError:
+                dir_cache[parent] = None
+        cached = dir_cache[parent]
+        entry = cached[1].get(os.path.normcase(name)) if cached else None
+        if entry is None or entry.is_symlink():
+            results.append(_resolve_exists_one(raw_path))
+            continue
+        results.append((os.path.join(cached[0], entry.name), True))
+    return results
+
+
+def _prefix_key(resolved_path: str) -> str:
+    """Ключ сравнения с игнор-префиксами: то же, что normalize_path_prefix, но без повторного resolve()."""
+    return resolved_path.lower().replace("\\", "/").rstrip("/") + "/"
+
+
+def _build_prefix_matcher(prefixes: Iterable[str]) -> Callable[[str], bool]:
+    """
+    Проверка «resolve-путь лежит в одном из префиксов» за O(log P) через bisect.
+    Вложенные префиксы отбрасываются: тогда совпасть может только наибольший ключ, не превосходящий путь.
+    """
+    keys: List[str] = []
+    for key in sorted({prefix.rstrip("/") + "/" for prefix in prefixes if prefix}):
+        if keys and key.startswith(keys[-1]):
+            continue
+        keys.append(key)
+
+    def _matches(resolved_path: str) -> bool:
+        if not keys:
+            return False
+        key = _prefix_key(resolved_path)
+        idx = bisect_right(keys, key) - 1
+        return idx >= 0 and key.startswith(keys[idx])
+
+    return _matches
+
+
+def _probe_videos(
+    paths: Sequence[Path],
+    probe: Callable[[Path], Tuple[str, str]],
+) -> Dict[Path, Tuple[str, str]]:
+    """ffprobe по всем путям параллельно: время уходит на запуск подпроцессов и чтение файлов, а не на CPU."""
+    unique = list(dict.fromkeys(paths))
+    if len(unique) <= 1:
+        return {path: probe(path) for path in unique}
+    with ThreadPoolExecutor(max_workers=min(VIDEO_PROBE_WORKERS, len(unique))) as pool:
+        return dict(zip(unique, pool.map(probe, unique)))
+
+
+def _iter_dir_files(
+    root: str,
+    skip_dir: Callable[[str], bool],
+) -> Iterator[Tuple[os.DirEntry, str]]:
+    """
+    Обход дерева через os.scandir в порядке os.walk: сверху вниз, в симлинки на папки не заходит.
+    Отдаёт (DirEntry файла, resolve-путь его папки). Подпапки, для resolve-пути которых
+    skip_dir истинно, пропускаются.
+    """
+    stack: List[Tuple[str, str]] = [(root, _resolve_str(root))]
+    while stack:
+        dir_path, resolved_dir = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        subdirs: List[Tuple[str, str]] = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                yield entry, resolved_dir
+                continue
+            try:
+                is_link = entry.is_symlink()
+            except OSError:
+                is_link = False
+            if is_link:
+                continue
+            # resolve() делаем один раз на папку, а не на каждый файл.
+            resolved_sub = _resolve_str(entry.path)
+            if not skip_dir(resolved_sub):
+                subdirs.append((entry.path, resolved_sub))
+        stack.extend(reversed(subdirs))
+
+
 def run_scan(
     upload_folders: Sequence[RowLike],
     ignored_rows: Sequence[RowLike],
@@ -51,7 +186,17 @@ def run_scan(
             env.backup_dir.mkdir(parents=True, exist_ok=True)
             stamp = datetime.now().strftime("%y%m%d_%H%M")
             backup_path = env.backup_dir / f"bd_backup_{stamp}.db"
-            shutil.copy2(env.db_path, backup_path)
+            # Online Backup API копирует страницы под блокировкой чтения — копия согласованная,
+            # даже если бот пишет в базу во время /scan (copy2 мог поймать файл посреди записи).
+            src = env.db_connect()
+            try:
+                dst = sqlite3.connect(backup_path)
+                try:
+                    src.backup(dst)
+                finally:
+                    dst.close()
+            finally:
+                src.close()
             backup_lines.append(f"💾 Резервная копия БД: {backup_path}")
         except Exception as exc:
             backup_lines.append(f"⚠️ Не удалось создать бэкап БД: {exc}")
@@ -63,45 +208,61 @@ def run_scan(
         for row in ignored_rows
         if row.get("folder_path")
     ]
+    is_ignored = _build_prefix_matcher(ignore_prefixes)
 
-    def _safe_exists(path_str: str) -> bool:
-        try:
-            return Path(path_str).exists()
-        except Exception:
-            return False
+    # Изменения полей копятся и пишутся пачками executemany в конце транзакции.
+    # Смена video_path идёт отдельной очередью в исходном порядке: колонка UNIQUE,
+    # и переезды должны применяться до любого INSERT, который может занять освободившийся путь.
+    path_updates: List[Tuple[int, Dict[str, Any]]] = []
+    field_updates: Dict[int, Dict[str, Any]] = {}
+
+    def _queue_update(source_id: int, fields: Dict[str, Any]) -> None:
+        fields = dict(fields)
+        new_path = fields.pop("video_path", None)
+        if new_path is not None:
+            path_updates.append((source_id, {"video_path": new_path}))
+        if fields:
+            field_updates.setdefault(source_id, {}).update(fields)
 
+    def _flush_path_updates(conn: sqlite3.Connection) -> None:
+        if path_updates:
+            env.db_update_sources_many(path_updates, conn)
+            path_updates.clear()
+
+    # Корзины по размеру: {size_bytes: {id: запись}} — удаление по id за O(1), порядок вставки сохраняется.
     def _remove_from_bucket(
         entry: Dict[str, Any],
-        size_buckets: Dict[int, List[Dict[str, Any]]],
+        size_buckets: Dict[int, Dict[int, Dict[str, Any]]],
         size_value: Optional[int] = None,
     ) -> None:
         bucket_size = size_value if size_value is not None else entry["size_bytes"]
         bucket = size_buckets.get(bucket_size)
         if not bucket:
             return
-        try:
-            bucket.remove(entry)
-        except ValueError:
+        if bucket.pop(entry["id"], None) is None:
             return
         if not bucket:
             size_buckets.pop(bucket_size, None)
 
     def _add_to_bucket(
         entry: Dict[str, Any],
-        size_buckets: Dict[int, List[Dict[str, Any]]],
+        size_buckets: Dict[int, Dict[int, Dict[str, Any]]],
         size_value: Optional[int] = None,
     ) -> None:
         bucket_size = size_value if size_value is not None else entry["size_bytes"]
-        size_buckets.setdefault(bucket_size, []).append(entry)
+        size_buckets.setdefault(bucket_size, {})[entry["id"]] = entry
 
     def _merge_duplicates(
         entry: Dict[str, Any],
-        size_buckets: Dict[int, List[Dict[str, Any]]],
+        size_buckets: Dict[int, Dict[int, Dict[str, Any]]],
         path_map: Dict[str, Dict[str, Any]],
         obsolete_ids: Set[int],
     ) -> int:
         merged_local = 0
-        bucket = list(size_buckets.get(entry["size_bytes"], []))
+        # Поля записей всегда заполнены при загрузке и вставке, поэтому читаем их напрямую;
+        # изменения от всех доноров копятся и ставятся в очередь одним _queue_update.
+        updates: Dict[str, Any] = {}
+        bucket = list(size_buckets.get(entry["size_bytes"], {}).values())
         for donor in bucket:
             if donor["id"] == entry["id"]:
                 continue
@@ -109,79 +270,74 @@ def run_scan(
                 continue
             if donor["file_exists"]:
                 continue
-            updates: Dict[str, Any] = {}
-            merged_comments = env.combine_comments(entry.get("comments"), donor.get("comments"))
-            if merged_comments != entry.get("comments"):
+            merged_comments = env.combine_comments(entry["comments"], donor["comments"])
+            if merged_comments != entry["comments"]:
                 entry["comments"] = merged_comments
                 updates["comments"] = merged_comments
-            merged_pmv = env.merge_pmv_lists(entry.get("pmv_list"), donor.get("pmv_list"))
-            if merged_pmv != entry.get("pmv_list"):
+            merged_pmv = env.merge_pmv_lists(entry["pmv_list"], donor["pmv_list"])
+            if merged_pmv != entry["pmv_list"]:
                 entry["pmv_list"] = merged_pmv
                 updates["pmv_list"] = merged_pmv
-            donor_date = donor.get("date_added") or ""
-            target_date = entry.get("date_added") or ""
-            if donor_date:
-                if not target_date or donor_date < target_date:
-                    entry["date_added"] = donor_date
-                    updates["date_added"] = donor_date
-            if updates:
-                env.db_update_source_fields(entry["id"], **updates)
+            donor_date = donor["date_added"]
+            if donor_date and (not entry["date_added"] or donor_date < entry["date_added"]):
+                entry["date_added"] = donor_date
+                updates["date_added"] = donor_date
             obsolete_ids.add(donor["id"])
             _remove_from_bucket(donor, size_buckets)
             path_map.pop(donor["norm_path"], None)
             merged_local += 1
+        if updates:
+            _queue_update(entry["id"], updates)
         return merged_local
 
     def _pick_candidate(
-        size_bucket: List[Dict[str, Any]],
+        size_bucket: Dict[int, Dict[str, Any]],
         file_name: str,
         obsolete_ids: Set[int],
         seen_ids: Set[int],
     ) -> Optional[Dict[str, Any]]:
-        if not size_bucket:
-            return None
+        # Приоритет: пропавший файл с тем же именем → любой пропавший → то же имя →
+        # ещё не встреченный в этом скане → любой. При равном приоритете — первый в корзине.
         lower_name = file_name.lower()
-        pool = [e for e in size_bucket if e["id"] not in obsolete_ids]
-        if not pool:
-            return None
-        priority_sets = [
-            [e for e in pool if not e["file_exists"] and e["video_name"].lower() == lower_name],
-            [e for e in pool if not e["file_exists"]],
-            [e for e in pool if e["video_name"].lower() == lower_name],
-            [e for e in pool if e["id"] not in seen_ids],
-            pool,
-        ]
-        for subset in priority_sets:
-            if subset:
-                return subset[0]
-        return None
-
-    sources: List[Dict[str, Any]] = []
+        best: Optional[Dict[str, Any]] = None
+        best_rank = 5
+        for e in size_bucket.values():
+            if e["id"] in obsolete_ids:
+                continue
+            name_match = e["video_name_lc"] == lower_name
+            if not e["file_exists"]:
+                if name_match:
+                    return e
+                rank = 1
+            elif name_match:
+                rank = 2
+            elif e["id"] not in seen_ids:
+                rank = 3
+            else:
+                rank = 4
+            if rank < best_rank:
+                best, best_rank = e, rank
+        return best
+
+    # Записи, чьих файлов нет на месте: кандидаты в удаление, если скан их так и не встретит.
+    missing_ids: Set[int] = set()
     path_map: Dict[str, Dict[str, Any]] = {}
-    size_buckets: Dict[int, List[Dict[str, Any]]] = {}
-    for raw in env.db_get_sources_full():
-        entry: Dict[str, Any] = dict(raw)
-        entry["id"] = int(entry.get("id") or 0)
-        raw_path = str(entry.get("video_path") or "")
-        try:
-            resolved_path = str(Path(raw_path).resolve(strict=False))
-        except Exception:
-            resolved_path = raw_path
+    size_buckets: Dict[int, Dict[int, Dict[str, Any]]] = {}
+    raw_entries: List[Dict[str, Any]] = [dict(raw) for raw in env.db_get_sources_full()]
+    probed = _resolve_stored_paths([entry["video_path"] for entry in raw_entries])
+    for entry, (resolved_path, file_exists) in zip(raw_entries, probed):
         entry["video_path"] = resolved_path
-        entry["video_name"] = entry.get("video_name") or Path(resolved_path).name
-        entry["size_bytes"] = int(entry.get("size_bytes") or 0)
-        entry["codec"] = entry.get("codec") or ""
-        entry["resolution"] = entry.get("resolution") or ""
-        entry["pmv_list"] = entry.get("pmv_list") or ""
-        entry["comments"] = entry.get("comments") or ""
-        entry["date_added"] = entry.get("date_added") or date.today().isoformat()
-        entry["norm_path"] = env.normalize_path_str(resolved_path)
-        entry["file_exists"] = _safe_exists(resolved_path)
-        sources.append(entry)
+        entry["video_name"] = entry["video_name"] or Path(resolved_path).name
+        # video_name_lc держим рядом с video_name: _pick_candidate сравнивает имена без учёта регистра.
+        entry["video_name_lc"] = entry["video_name"].lower()
+        entry["date_added"] = entry["date_added"] or date.today().isoformat()
+        entry["norm_path"] = _path_key(resolved_path)
+        entry["file_exists"] = file_exists
+        if not file_exists:
+            missing_ids.add(entry["id"])
         path_map[entry["norm_path"]] = entry
         _add_to_bucket(entry, size_buckets)
 
-    total_files = 0
     added = 0
     skipped = 0
     relocated = 0
@@ -194,128 +350,161 @@ def run_scan(
     seen_ids: Set[int] = set()
     obsolete_ids: Set[int] = set()
 
+    # Обход папок и ffprobe идут до транзакции: блокировка записи не держится, пока читается диск.
+    scanned: List[Tuple[Path, str, int, str]] = []
     for row in upload_folders:
         root = Path(row["folder_path"])
         if not root.exists():
             continue
-        for dirpath, dirnames, filenames in os.walk(root):
-            cur_dir = Path(dirpath)
-            if env.is_path_under_prefixes(cur_dir, ignore_prefixes):
-                ignored_dirs += 1
-                dirnames[:] = []
+        if is_ignored(_resolve_str(str(root))):
+            ignored_dirs += 1
+            continue
+        for entry, resolved_dir in _iter_dir_files(str(root), is_ignored):
+            name = entry.name
+            if entry.is_symlink():
+                resolved_path = _resolve_str(entry.path)
+            else:
+                resolved_path = os.path.join(resolved_dir, name)
+            if is_ignored(resolved_path):
+                ignored_files += 1
+                continue
+            if os.path.splitext(name)[1].lower() not in env.default_exts:
                 continue
-            dirnames[:] = [
-                name
-                for name in dirnames
-                if not env.is_path_under_prefixes(Path(dirpath) / name, ignore_prefixes)
-            ]
-            for name in filenames:
-                path = cur_dir / name
-                if env.is_path_under_prefixes(path, ignore_prefixes):
-                    ignored_files += 1
-                    continue
-                if path.suffix.lower() not in env.default_exts:
-                    continue
-                total_files += 1
+            scanned.append(
+                (Path(entry.path), resolved_path, entry.stat().st_size, _path_key(resolved_path))
+            )
+    total_files = len(scanned)
+
+    def _has_stored_info(existing: Optional[Dict[str, Any]], size_bytes: int) -> bool:
+        # Файл на прежнем месте и того же размера — кодек и разрешение берём из базы без ffprobe.
+        return bool(
+            existing
+            and existing["size_bytes"] == size_bytes
+            and existing["codec"]
+            and existing["resolution"]
+        )
+
+    probed_info = _probe_videos(
+        [
+            path
+            for path, _resolved, size_bytes, norm_path in scanned
+            if not _has_stored_info(path_map.get(norm_path), size_bytes)
+        ],
+        env.video_info_sort,
+    )
+
+    # Все записи сканирования идут одной транзакцией: без неё каждый UPDATE/INSERT
+    # коммитился отдельно (fsync на строку), а при ошибке база оставалась наполовину обновлённой.
+    conn = env.db_connect()
+    try:
+        conn.execute(f"PRAGMA busy_timeout = {SCAN_DB_BUSY_TIMEOUT_MS}")
+        conn.execute("BEGIN IMMEDIATE")
+        for path, resolved_path, size_bytes, norm_path in scanned:
+            existing = path_map.get(norm_path)
+            if _has_stored_info(existing, size_bytes):
+                codec, res = existing["codec"], existing["resolution"]
+            elif path in probed_info:
+                codec, res = probed_info[path]
+            else:
                 codec, res = env.video_info_sort(path)
-                size_bytes = path.stat().st_size
-                resolved_path = str(path.resolve())
-                norm_path = env.normalize_path_str(resolved_path)
-                existing = path_map.get(norm_path)
-                if existing:
-                    seen_ids.add(existing["id"])
-                    updates: Dict[str, Any] = {}
-                    if existing["video_name"] != path.name:
-                        existing["video_name"] = path.name
-                        updates["video_name"] = path.name
-                    if existing["size_bytes"] != size_bytes:
-                        old_size = existing["size_bytes"]
-                        existing["size_bytes"] = size_bytes
-                        _remove_from_bucket(existing, size_buckets, old_size)
-                        _add_to_bucket(existing, size_buckets)
-                        updates["size_bytes"] = size_bytes
-                    if existing["codec"] != codec:
-                        existing["codec"] = codec
-                        updates["codec"] = codec
-                    if existing["resolution"] != res:
-                        existing["resolution"] = res
-                        updates["resolution"] = res
-                    if updates:
-                        env.db_update_source_fields(existing["id"], **updates)
-                        meta_updates += 1
-                    existing["file_exists"] = True
-                    merged_duplicates += _merge_duplicates(
-                        existing, size_buckets, path_map, obsolete_ids
-                    )
-                    continue
-
-                candidates = size_buckets.get(size_bytes, [])
-                candidate = _pick_candidate(candidates, path.name, obsolete_ids, seen_ids)
-                if candidate:
-                    seen_ids.add(candidate["id"])
-                    old_norm = candidate["norm_path"]
-                    if old_norm in path_map:
-                        path_map.pop(old_norm, None)
-                    candidate_updates = {
-                        "video_path": resolved_path,
-                        "video_name": path.name,
-                        "size_bytes": size_bytes,
-                        "codec": codec,
-                        "resolution": res,
-                    }
-                    candidate["video_path"] = resolved_path
-                    candidate["video_name"] = path.name
-                    candidate["size_bytes"] = size_bytes
-                    candidate["codec"] = codec
-                    candidate["resolution"] = res
-                    candidate["norm_path"] = norm_path
-                    candidate["file_exists"] = True
-                    path_map[norm_path] = candidate
-                    env.db_update_source_fields(candidate["id"], **candidate_updates)
-                    relocated += 1
-                    relocated_paths.append(resolved_path)
-                    merged_duplicates += _merge_duplicates(
-                        candidate, size_buckets, path_map, obsolete_ids
-                    )
-                    continue
-
-                inserted_id = env.db_insert_source(path, codec, res, size_bytes=size_bytes, video_name=path.name)
-                if inserted_id:
-                    entry = {
-                        "id": inserted_id,
-                        "video_path": resolved_path,
-                        "video_name": path.name,
-                        "size_bytes": size_bytes,
-                        "codec": codec,
-                        "resolution": res,
-                        "pmv_list": "",
-                        "comments": "",
-                        "date_added": date.today().isoformat(),
-                        "norm_path": norm_path,
-                        "file_exists": True,
-                    }
-                    sources.append(entry)
-                    path_map[norm_path] = entry
-                    _add_to_bucket(entry, size_buckets)
-                    seen_ids.add(inserted_id)
-                    added += 1
-                    added_paths.append(resolved_path)
-                else:
-                    skipped += 1
-
-    stale_ids: Set[int] = set()
-    for entry in sources:
-        sid = entry["id"]
-        if sid in seen_ids:
-            continue
-        if sid in obsolete_ids:
-            continue
-        if entry["file_exists"]:
-            continue
-        stale_ids.add(sid)
+            if existing:
+                seen_ids.add(existing["id"])
+                updates: Dict[str, Any] = {}
+                if existing["video_name"] != path.name:
+                    existing["video_name"] = path.name
+                    existing["video_name_lc"] = path.name.lower()
+                    updates["video_name"] = path.name
+                if existing["size_bytes"] != size_bytes:
+                    old_size = existing["size_bytes"]
+                    existing["size_bytes"] = size_bytes
+                    _remove_from_bucket(existing, size_buckets, old_size)
+                    _add_to_bucket(existing, size_buckets)
+                    updates["size_bytes"] = size_bytes
+                if existing["codec"] != codec:
+                    existing["codec"] = codec
+                    updates["codec"] = codec
+                if existing["resolution"] != res:
+                    existing["resolution"] = res
+                    updates["resolution"] = res
+                if updates:
+                    _queue_update(existing["id"], updates)
+                    meta_updates += 1
+                existing["file_exists"] = True
+                merged_duplicates += _merge_duplicates(
+                    existing, size_buckets, path_map, obsolete_ids
+                )
+                continue
+
+            candidates = size_buckets.get(size_bytes, {})
+            candidate = _pick_candidate(candidates, path.name, obsolete_ids, seen_ids)
+            if candidate:
+                seen_ids.add(candidate["id"])
+                old_norm = candidate["norm_path"]
+                if old_norm in path_map:
+                    path_map.pop(old_norm, None)
+                candidate_updates = {
+                    "video_path": resolved_path,
+                    "video_name": path.name,
+                    "size_bytes": size_bytes,
+                    "codec": codec,
+                    "resolution": res,
+                }
+                candidate["video_path"] = resolved_path
+                candidate["video_name"] = path.name
+                candidate["video_name_lc"] = path.name.lower()
+                candidate["size_bytes"] = size_bytes
+                candidate["codec"] = codec
+                candidate["resolution"] = res
+                candidate["norm_path"] = norm_path
+                candidate["file_exists"] = True
+                path_map[norm_path] = candidate
+                _queue_update(candidate["id"], candidate_updates)
+                relocated += 1
+                relocated_paths.append(resolved_path)
+                merged_duplicates += _merge_duplicates(
+                    candidate, size_buckets, path_map, obsolete_ids
+                )
+                continue
+
+            _flush_path_updates(conn)
+            inserted_id = env.db_insert_source(
+                path, codec, res, size_bytes=size_bytes, video_name=path.name, conn=conn
+            )
+            if inserted_id:
+                entry = {
+                    "id": inserted_id,
+                    "video_path": resolved_path,
+                    "video_name": path.name,
+                    "video_name_lc": path.name.lower(),
+                    "size_bytes": size_bytes,
+                    "codec": codec,
+                    "resolution": res,
+                    "pmv_list": "",
+                    "comments": "",
+                    "date_added": date.today().isoformat(),
+                    "norm_path": norm_path,
+                    "file_exists": True,
+                }
+                path_map[norm_path] = entry
+                _add_to_bucket(entry, size_buckets)
+                seen_ids.add(inserted_id)
+                added += 1
+                added_paths.append(resolved_path)
+            else:
+                skipped += 1
 
-    delete_targets = obsolete_ids.union(stale_ids)
-    deleted_rows = env.db_delete_sources_by_ids(delete_targets) if delete_targets else 0
+        # file_exists становится True только у встреченных записей, так что проход по всем не нужен.
+        stale_ids = missing_ids - seen_ids - obsolete_ids
+        delete_targets = obsolete_ids.union(stale_ids)
+        _flush_path_updates(conn)
+        env.db_update_sources_many(field_updates.items(), conn)
+        deleted_rows = env.db_delete_sources_by_ids(delete_targets, conn) if delete_targets else 0
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
     lines = backup_lines + [
         "✅ Сканирование исходников завершено.",
@@ -340,14 +529,12 @@ def run_scan(
         lines.append("")
         last_added = added_paths[-10:]
         lines.append(f"Новых записей {len(added_paths)}. Последние {len(last_added)} из них:")
-        for path in last_added:
-            lines.append(f"- {path}")
+        lines.extend(f"- {path}" for path in last_added)
     if relocated_paths:
         lines.append("")
         last_relocated = relocated_paths[-10:]
         lines.append(f"Обновлено путей {len(relocated_paths)}. Последние {len(last_relocated)} из них:")
-        for path in last_relocated:
-            lines.append(f"- {path}")
+        lines.extend(f"- {path}" for path in last_relocated)
 
     stats = {
         "total_files": total_files,